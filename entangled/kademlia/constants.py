@@ -21,9 +21,22 @@ alpha = 3
 #: Maximum number of contacts stored in a bucket; this should be an even number
 k = 8
 
+#: Maximum number of replacement contacts kept for each full k-bucket (see
+#: section 4.1 of the 13-page version of the Kademlia paper)
+replacementCacheSize = k
+
 #: Timeout for network operations (in seconds)
 rpcTimeout = 5
 
+#: Lower bound for RPC timeouts (in seconds); RPC timeouts are derived from the
+#: round-trip times measured for each remote node, and lie between this value
+#: and C{rpcTimeout}
+rpcTimeoutMin = 0.5
+
+#: Granularity of RPC timeouts (in seconds); pending timeouts are checked in
+#: batches at this interval
+rpcTimeoutResolution = 0.05
+
 # Delay between iterations of iterative node lookups (for loose parallelism)  (in seconds)
 iterativeLookupDelay = rpcTimeout / 2
 
@@ -41,6 +54,67 @@ dataExpireTimeout = 86400 # 24 hours
 #: or whether any data needs to be republished (in seconds)
 checkRefreshInterval = refreshTimeout/5
 
+#: Contacts that were refreshed in the routing table less than this many
+#: seconds ago are not refreshed again for every message received from them;
+#: such refreshes are deferred, and applied in batches at this interval
+touchInterval = 1
+
 #: Max size of a single UDP datagram, in bytes. If a message is larger than this, it will
 #: be spread accross several UDP packets.
 udpDatagramMaxSize = 8192 # 8 KB
+
+#: Maximum rate at which UDP packets are transmitted (in packets per second)
+sendRatePackets = 1000
+#: Maximum rate at which data is transmitted (in bytes per second)
+sendRateBytes = 8388608 # 8 MB/s
+#: Time (in seconds) worth of transmission capacity that may accumulate while
+#: the send queue is idle; this limits the size of back-to-back bursts
+sendBurstTime = 0.005
+#: Maximum amount of data that may be waiting for transmission (in bytes); any
+#: packets that do not fit into the send queue are dropped
+sendQueueSize = 4194304 # 4 MB
+
+#: Time (in seconds) an incompletely received multi-datagram message is kept
+#: without any new datagrams arriving for it, before it is discarded
+reassemblyTimeout = rpcTimeout
+#: Maximum amount of data (in bytes) buffered for incompletely received
+#: multi-datagram messages; the least recently updated messages are discarded
+#: when this is exceeded
+reassemblyBufferSize = 33554432 # 32 MB
+#: Amount of memory (in bytes) charged against C{reassemblyBufferSize} for
+#: each buffered datagram in addition to its payload, to account for the
+#: bookkeeping of the datagram (and of its message); this prevents floods of
+#: tiny datagrams from using much more memory than the buffer size
+reassemblyFragmentOverhead = 512
+
+#: Time (in seconds) without new datagrams arriving for an incomplete
+#: multi-datagram message, after which its missing datagrams are requested again
+fragmentRetransmitDelay = 0.5
+#: Maximum number of times the missing datagrams of an incomplete
+#: multi-datagram message are requested from its sender
+fragmentRetransmitRequests = 3
+#: Time (in seconds) the datagrams of a sent multi-datagram message are kept
+#: available for retransmission
+retransmitBufferTimeout = rpcTimeout
+#: Maximum amount of data (in bytes) kept available for retransmission
+retransmitBufferSize = 16777216 # 16 MB
+
+#: Maximum number of remote nodes for which round-trip time statistics are kept
+rttCacheSize = 10000
+
+#: Maximum number of worker threads used to execute blocking RPC methods (those
+#: marked with the C{rpcthreaded} decorator); if 0, they are executed in the
+#: reactor thread
+rpcThreadPoolSize = 4
+
+#: Time window (in seconds) during which RPC messages sent to the same node are
+#: coalesced into a single multi-call datagram, if the node supports it; if 0,
+#: messages are never coalesced
+rpcBatchWindow = 0.005
+
+#: Maximum number of remote nodes for which the advertised capabilities are kept
+peerCapabilitiesCacheSize = 10000
+
+#: Maximum total size (in bytes) of the pre-encoded findNode/findValue RPC
+#: responses cached by each node
+responseCacheSize = 4194304 # 4 MB
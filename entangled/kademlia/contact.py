@@ -7,18 +7,47 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
+import weakref
+
+# RPC stub functions, by method name; see Contact.__getattr__()
+_rpcStubs = {}
+
+def _rpcStub(name):
+    """ Returns the (shared) function that sends the RPC C{name} to the
+    contact it is bound to """
+    try:
+        return _rpcStubs[name]
+    except KeyError:
+        def _sendRPC(self, *args, **kwargs):
+            return self._networkProtocol.sendRPC(self, name, args, **kwargs)
+        _sendRPC.__name__ = name
+        return _rpcStubs.setdefault(name, _sendRPC)
+
 class Contact(object):
     """ Encapsulation for remote contact
     
     This class contains information on a single remote contact, and also
     provides a direct RPC API to the remote node which it represents
     """
+    # Nodes may know a great many contacts; don't give each one a __dict__
+    __slots__ = ('id', 'idValue', 'address', 'port', '_networkProtocol', 'commTime', 'failedRPCs', '__weakref__')
+
     def __init__(self, id, ipAddress, udpPort, networkProtocol, firstComm=0):
         self.id = id
+        #: The node ID's integer value, as used for XOR distance calculations
+        if isinstance(id, str):
+            self.idValue = long(id.encode('hex'), 16)
+        else:
+            self.idValue = id
         self.address = ipAddress
         self.port = udpPort
         self._networkProtocol = networkProtocol
+        #: When the contact was last refreshed in the routing table; see
+        #: C{Node.addContact()}
         self.commTime = firstComm
+        #: The number of consecutive RPCs to this contact that failed; this
+        #: is maintained by the routing table
+        self.failedRPCs = 0
         
     def __eq__(self, other):
         if isinstance(other, Contact):
@@ -35,6 +64,11 @@ class Contact(object):
             return self.id != other
         else:
             return True
+
+    def __hash__(self):
+        # Consistent with __eq__(), so that contacts and their node IDs can
+        # be used interchangeably as dictionary keys
+        return hash(self.id)
         
     def __str__(self):
         return '<%s.%s object; IP address: %s, UDP port: %d>' % (self.__module__, self.__class__.__name__, self.address, self.port)
@@ -53,6 +87,43 @@ class Contact(object):
         This happens via this contact's C{_networkProtocol} object (i.e. the
         host Node's C{_protocol} object).
         """
-        def _sendRPC(*args, **kwargs):
-            return self._networkProtocol.sendRPC(self, name, args, **kwargs)
-        return _sendRPC
+        # Only a bound method is created per call; the stub itself is shared
+        return _rpcStub(name).__get__(self, Contact)
+
+
+class ContactRegistry(object):
+    """ Interns the Contact objects used by a node
+
+    Without it, a new C{Contact} would be created for every received message
+    and every contact triple in every lookup response, even for remote nodes
+    that are already in the routing table. The registry instead returns the
+    existing object for the same node ID, IP address and UDP port.
+
+    Contacts are only kept in the registry while they are referenced
+    elsewhere (e.g. by the routing table, or by an ongoing lookup).
+    """
+    def __init__(self, networkProtocol):
+        """
+        @param networkProtocol: The protocol used by the created contacts
+                                to send RPCs
+        @type networkProtocol: entangled.kademlia.protocol.KademliaProtocol
+        """
+        self._networkProtocol = networkProtocol
+        # Keyed by node ID; if a node's address changes, its new contact
+        # replaces the old one
+        self._contacts = weakref.WeakValueDictionary()
+
+    def getContact(self, id, ipAddress, udpPort):
+        """ Returns the contact for the specified node ID and address,
+        creating it if necessary
+
+        @rtype: entangled.kademlia.contact.Contact
+        """
+        contact = self._contacts.get(id)
+        if contact == None or contact.port != udpPort or contact.address != ipAddress:
+            contact = Contact(id, ipAddress, udpPort, self._networkProtocol)
+            self._contacts[id] = contact
+        return contact
+
+    def __len__(self):
+        return len(self._contacts)
@@ -12,6 +12,7 @@ import sqlite3
 import cPickle as pickle
 import time
 import os
+import threading
 
 
 class DataStore(UserDict.DictMixin):
@@ -108,6 +109,9 @@ class DictDataStore(DataStore):
 
 class SQLiteDataStore(DataStore):
     """ Example of a SQLite database-based datastore
+
+    This data store may be accessed from multiple threads (e.g. by RPC
+    methods executed in the protocol's worker threads).
     """
     def __init__(self, dbFile=':memory:'):
         """
@@ -116,21 +120,25 @@ class SQLiteDataStore(DataStore):
         @type dbFile: str
         """
         createDB = not os.path.exists(dbFile)
-        self._db = sqlite3.connect(dbFile)
+        self._db = sqlite3.connect(dbFile, check_same_thread=False)
         self._db.isolation_level = None
         self._db.text_factory = str
         if createDB:
             self._db.execute('CREATE TABLE data(key, value, lastPublished, originallyPublished, originalPublisherID)')
         self._cursor = self._db.cursor()
+        # Serializes access to the (shared) cursor
+        self._lock = threading.RLock()
 
     def keys(self):
         """ Return a list of the keys in this data store """
         keys = []
+        self._lock.acquire()
         try:
             self._cursor.execute("SELECT key FROM data")
             for row in self._cursor:
                 keys.append(row[0].decode('hex'))
         finally:
+            self._lock.release()
             return keys
 
     def lastPublished(self, key):
@@ -157,16 +165,24 @@ class SQLiteDataStore(DataStore):
     def setItem(self, key, value, lastPublished, originallyPublished, originalPublisherID):
         # Encode the key so that it doesn't corrupt the database
         encodedKey = key.encode('hex')
-        self._cursor.execute("select key from data where key=:reqKey", {'reqKey': encodedKey})
-        if self._cursor.fetchone() == None:
-            self._cursor.execute('INSERT INTO data(key, value, lastPublished, originallyPublished, originalPublisherID) VALUES (?, ?, ?, ?, ?)', (encodedKey, buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), lastPublished, originallyPublished, originalPublisherID))
-        else:
-            self._cursor.execute('UPDATE data SET value=?, lastPublished=?, originallyPublished=?, originalPublisherID=? WHERE key=?', (buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), lastPublished, originallyPublished, originalPublisherID, encodedKey))
+        self._lock.acquire()
+        try:
+            self._cursor.execute("select key from data where key=:reqKey", {'reqKey': encodedKey})
+            if self._cursor.fetchone() == None:
+                self._cursor.execute('INSERT INTO data(key, value, lastPublished, originallyPublished, originalPublisherID) VALUES (?, ?, ?, ?, ?)', (encodedKey, buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), lastPublished, originallyPublished, originalPublisherID))
+            else:
+                self._cursor.execute('UPDATE data SET value=?, lastPublished=?, originallyPublished=?, originalPublisherID=? WHERE key=?', (buffer(pickle.dumps(value, pickle.HIGHEST_PROTOCOL)), lastPublished, originallyPublished, originalPublisherID, encodedKey))
+        finally:
+            self._lock.release()
         
     def _dbQuery(self, key, columnName, unpickle=False):
+        self._lock.acquire()
         try:
             self._cursor.execute("SELECT %s FROM data WHERE key=:reqKey" % columnName, {'reqKey': key.encode('hex')})
             row = self._cursor.fetchone()
+        finally:
+            self._lock.release()
+        try:
             value = str(row[0])
         except TypeError:
             raise KeyError, key
@@ -180,4 +196,8 @@ class SQLiteDataStore(DataStore):
         return self._dbQuery(key, 'value', unpickle=True)
 
     def __delitem__(self, key):
-        self._cursor.execute("DELETE FROM data WHERE key=:reqKey", {'reqKey': key.encode('hex')})
+        self._lock.acquire()
+        try:
+            self._cursor.execute("DELETE FROM data WHERE key=:reqKey", {'reqKey': key.encode('hex')})
+        finally:
+            self._lock.release()
@@ -7,11 +7,34 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
+import socket, struct
+
 class DecodeError(Exception):
     """ Should be raised by an C{Encoding} implementation if decode operation
     fails
     """
 
+class RawData(object):
+    """ Wraps data that has already been encoded, so that it is included in
+    the encoded output verbatim
+
+    If the data was encoded by a different type of C{Encoding} than the one
+    it is included in, it is decoded and re-encoded instead.
+    """
+    __slots__ = ('data', 'encoding')
+
+    def __init__(self, data, encoding=None):
+        """
+        @param data: The encoded data
+        @type data: str
+        @param encoding: The encoding used to encode C{data}; if this is
+                         C{None}, it is assumed to be the one it will be
+                         included in
+        @type encoding: Encoding
+        """
+        self.data = data
+        self.encoding = encoding
+
 class Encoding(object):
     """ Interface for RPC message encoders/decoders
     
@@ -40,6 +63,25 @@ class Encoding(object):
         @return: The decoded data (in its correct type)
         """
 
+    def decodePrefix(self, data, count):
+        """ Decode only the first few items of the specified encoded list, or
+        key/value pairs of the specified encoded dict
+        
+        This allows inspecting e.g. the header of a message cheaply, before
+        deciding whether to decode all of it. Implementations may decode more
+        than C{count} items; this default implementation decodes everything.
+        
+        @param data: The data (byte string) to decode.
+        @type data: str
+        @param count: The number of items (or key/value pairs) to decode
+        @type count: int
+        
+        @return: The decoded items (or pairs), or the entire decoded data if
+                 it is neither a list nor a dict
+        @rtype: list or dict
+        """
+        return self.decode(data)
+
 class Bencode(Encoding):
     """ Implementation of a Bencode-based algorithm (Bencode is the encoding
     algorithm used by Bittorrent).
@@ -53,36 +95,16 @@ class Bencode(Encoding):
         """ Encoder implementation of the Bencode algorithm
         
         @param data: The data to encode
-        @type data: int, long, tuple, list, dict or str
+        @type data: int, long, tuple, list, dict, str or RawData
         
         @return: The encoded data
         @rtype: str
         """
-        if type(data) in (int, long):
-            return 'i%de' % data
-        elif type(data) == str:
-            return '%d:%s' % (len(data), data)
-        elif type(data) in (list, tuple):
-            encodedListItems = ''
-            for item in data:
-                encodedListItems += self.encode(item)
-            return 'l%se' % encodedListItems
-        elif type(data) == dict:
-            encodedDictItems = ''
-            keys = data.keys()
-            keys.sort()
-            for key in keys:
-                encodedDictItems += self.encode(key)
-                encodedDictItems += self.encode(data[key])
-            return 'd%se' % encodedDictItems
-        elif type(data) == float:
-            # This (float data type) is a non-standard extension to the original Bencode algorithm 
-            return 'f%fe' % data
-        elif data == None:
-            # This (None/NULL data type) is a non-standard extension to the original Bencode algorithm 
-            return 'n'
-        else:
-            raise TypeError, "Cannot bencode '%s' object" % type(data)
+        # Encoded fragments are collected in a single list and joined once,
+        # which keeps encoding large lists and dicts linear in their size
+        parts = []
+        _bencodeItem(data, parts)
+        return ''.join(parts)
     
     def decode(self, data):
         """ Decoder implementation of the Bencode algorithm 
@@ -90,54 +112,475 @@ class Bencode(Encoding):
         @param data: The encoded data
         @type data: str
         
-        @note: This is a convenience wrapper for the recursive decoding
-               algorithm, C{_decodeRecursive}
+        @raise DecodeError: The data is not valid Bencoded data
        
         @return: The decoded data, as a native Python type
         @rtype:  int, list, dict or str
         """
         if len(data) == 0:
             raise DecodeError, 'Cannot decode empty string'
-        return self._decodeRecursive(data)[0]
-    
-    @staticmethod
-    def _decodeRecursive(data, startIndex=0):
-        """ Actual implementation of the recursive Bencode algorithm
+        try:
+            return _bdecode(data, 0)[0]
+        except (ValueError, TypeError, IndexError), e:
+            raise DecodeError, e
+
+    def decodePrefix(self, data, count):
+        """ Decode only the first C{count} items of the specified Bencoded
+        list, or key/value pairs of the specified Bencoded dict (see
+        C{Encoding.decodePrefix()})
         
-        Do not call this; use C{decode()} instead
+        @rtype: list or dict
         """
-        if data[startIndex] == 'i':
-            endPos = data[startIndex:].find('e')+startIndex
-            return (int(data[startIndex+1:endPos]), endPos+1)
-        elif data[startIndex] == 'l':
-            startIndex += 1
-            decodedList = []
-            while data[startIndex] != 'e':
-                listData, startIndex = Bencode._decodeRecursive(data, startIndex)
-                decodedList.append(listData)
-            return (decodedList, startIndex+1)
-        elif data[startIndex] == 'd':
-            startIndex += 1
-            decodedDict = {}
-            while data[startIndex] != 'e':
-                key, startIndex = Bencode._decodeRecursive(data, startIndex)
-                value, startIndex = Bencode._decodeRecursive(data, startIndex)
-                decodedDict[key] = value
-            return (decodedDict, startIndex)
-        elif data[startIndex] == 'f':
-            # This (float data type) is a non-standard extension to the original Bencode algorithm
-            endPos = data[startIndex:].find('e')+startIndex
-            return (float(data[startIndex+1:endPos]), endPos+1)
-        elif data[startIndex] == 'n':
+        if len(data) == 0:
+            raise DecodeError, 'Cannot decode empty string'
+        try:
+            if data[0] == 'd':
+                decodedDict = {}
+                index = 1
+                while len(decodedDict) < count and data[index] != 'e':
+                    key, index = _bdecode(data, index)
+                    decodedDict[key], index = _bdecode(data, index)
+                return decodedDict
+            elif data[0] == 'l':
+                decodedList = []
+                index = 1
+                while len(decodedList) < count and data[index] != 'e':
+                    value, index = _bdecode(data, index)
+                    decodedList.append(value)
+                return decodedList
+            else:
+                return _bdecode(data, 0)[0]
+        except (ValueError, TypeError, IndexError), e:
+            raise DecodeError, e
+
+
+def _bdecode(data, index):
+    """ Iterative implementation of the Bencode decoding algorithm
+
+    Nested lists and dicts are tracked on an explicit stack, and the data
+    is scanned with C{find()} calls starting at the current position, so
+    that decoding is linear in the size of the data and no copies are made
+    other than of the decoded strings themselves.
+
+    Do not call this; use C{Bencode.decode()} instead
+
+    @return: The decoded item starting at C{index}, and the index following it
+    @rtype: tuple
+    """
+    find = data.find
+    # Partially decoded lists and dicts; a dict's keys and values are
+    # collected in a flat list, and the dict is created once it is complete
+    stack = []
+    while True:
+        c = data[index]
+        if '0' <= c <= '9':
+            splitPos = find(':', index)
+            if splitPos < 0:
+                raise DecodeError, 'String length not terminated'
+            startIndex = splitPos + 1
+            endPos = startIndex + int(data[index:splitPos])
+            if endPos > len(data):
+                raise DecodeError, 'String exceeds the end of the data'
+            value = data[startIndex:endPos]
+            index = endPos
+        elif c == 'i' or c == 'f':
+            # The float data type is a non-standard extension to the original Bencode algorithm
+            endPos = find('e', index)
+            if endPos < 0:
+                raise DecodeError, 'Number not terminated'
+            if c == 'i':
+                value = int(data[index+1:endPos])
+            else:
+                value = float(data[index+1:endPos])
+            index = endPos + 1
+        elif c == 'l' or c == 'd':
+            stack.append((c, []))
+            index += 1
+            continue
+        elif c == 'e':
+            if len(stack) == 0:
+                raise DecodeError, 'Unexpected end of list or dict'
+            containerType, items = stack.pop()
+            if containerType == 'l':
+                value = items
+            elif len(items) % 2 != 0:
+                raise DecodeError, 'Dict key without a value'
+            else:
+                value = dict(zip(items[::2], items[1::2]))
+            index += 1
+        elif c == 'n':
             # This (None/NULL data type) is a non-standard extension to the original Bencode algorithm 
-            return (None, startIndex+1)
+            value = None
+            index += 1
+        else:
+            raise DecodeError, 'Invalid data type: %r' % c
+        if len(stack) == 0:
+            return value, index
+        stack[-1][1].append(value)
+
+def _bencodeItem(data, parts):
+    """ Appends the Bencoded fragments of C{data} to the list C{parts} """
+    try:
+        encoder = _bencoders[type(data)]
+    except KeyError:
+        raise TypeError, "Cannot bencode '%s' object" % type(data)
+    encoder(data, parts)
+
+def _bencodeInt(data, parts):
+    parts.append('i%de' % data)
+
+def _bencodeStr(data, parts):
+    parts.append('%d:' % len(data))
+    parts.append(data)
+
+def _bencodeList(data, parts):
+    append = parts.append
+    append('l')
+    for item in data:
+        # Fast paths for the most common item types
+        itemType = type(item)
+        if itemType == str:
+            append('%d:' % len(item))
+            append(item)
+        elif itemType == int:
+            append('i%de' % item)
         else:
-            splitPos = data[startIndex:].find(':')+startIndex
             try:
-                length = int(data[startIndex:splitPos])
-            except ValueError, e:
-                raise DecodeError, e
-            startIndex = splitPos+1
-            endPos = startIndex+length
-            bytes = data[startIndex:endPos]
-            return (bytes, endPos)
+                encoder = _bencoders[itemType]
+            except KeyError:
+                raise TypeError, "Cannot bencode '%s' object" % itemType
+            encoder(item, parts)
+    append('e')
+
+def _bencodeDict(data, parts):
+    parts.append('d')
+    keys = data.keys()
+    keys.sort()
+    for key in keys:
+        if type(key) == str:
+            parts.append('%d:' % len(key))
+            parts.append(key)
+        else:
+            _bencodeItem(key, parts)
+        _bencodeItem(data[key], parts)
+    parts.append('e')
+
+def _bencodeFloat(data, parts):
+    # This (float data type) is a non-standard extension to the original Bencode algorithm 
+    parts.append('f%fe' % data)
+
+def _bencodeRawData(data, parts):
+    if data.encoding == None or isinstance(data.encoding, Bencode):
+        parts.append(data.data)
+    else:
+        _bencodeItem(data.encoding.decode(data.data), parts)
+
+def _bencodeNone(data, parts):
+    # This (None/NULL data type) is a non-standard extension to the original Bencode algorithm 
+    parts.append('n')
+
+# Bencode encoders, by (exact) data type
+_bencoders = {int: _bencodeInt,
+              long: _bencodeInt,
+              str: _bencodeStr,
+              list: _bencodeList,
+              tuple: _bencodeList,
+              dict: _bencodeDict,
+              float: _bencodeFloat,
+              RawData: _bencodeRawData,
+              type(None): _bencodeNone}
+
+
+class CompactEncoding(Encoding):
+    """ Compact binary encoding, which is considerably smaller and faster to
+    encode and decode than Bencode
+
+    Encoded data starts with the C{magic} byte, which distinguishes it from
+    Bencoded data (and from the fragmentation headers used by
+    C{KademliaProtocol}). It is followed by a single item, each item starting
+    with a type tag byte:
+        - C{0x80}-C{0xbf}: an integer from 0 to 63 (the tag minus C{0x80})
+        - C{0x40}-C{0x7f}: a string of up to 63 bytes (the tag minus C{0x40}
+          is its length), e.g. a 20-byte node ID
+        - C{0x01}: an integer, as a zigzag-encoded varint
+        - C{0x02}: a string, prefixed by its length as a varint
+        - C{0x03}/C{0x04}: a list/dict, prefixed by its number of items (or
+          key/value pairs) as a varint
+        - C{0x05}: a 64-bit floating point value
+        - C{0x06}: C{None}
+        - C{0x07}: a contact triple (a list or tuple of a 20-byte node ID, an
+          IPv4 address and a port number), as a 20-byte ID, 4-byte address
+          and 2-byte port number
+
+    Varints store 7 bits per byte, least significant bits first; the most
+    significant bit of each byte is set if more bytes follow.
+
+    Lists and tuples are decoded as lists, as with Bencode. Unlike Bencode,
+    dict keys are not sorted, so the encoding of a dict is not unique; and
+    floating point values are encoded exactly.
+    """
+    magic = '\xce'
+
+    def encode(self, data):
+        """ Encoder implementation of the compact encoding
+
+        @param data: The data to encode
+        @type data: int, long, float, tuple, list, dict, str, None or RawData
+
+        @return: The encoded data
+        @rtype: str
+        """
+        parts = [self.magic]
+        _cencodeItem(data, parts)
+        return ''.join(parts)
+
+    def decode(self, data):
+        """ Decoder implementation of the compact encoding
+
+        @param data: The encoded data
+        @type data: str
+
+        @raise DecodeError: The data is not valid compactly encoded data
+
+        @return: The decoded data, as a native Python type
+        @rtype:  int, long, float, list, dict, str or None
+        """
+        if data[:1] != self.magic:
+            raise DecodeError, 'Data is not compactly encoded'
+        try:
+            value, index = _cdecode(data, 1)
+        except (ValueError, TypeError, IndexError, struct.error, socket.error), e:
+            raise DecodeError, e
+        if index != len(data):
+            raise DecodeError, 'Encoded data size mismatch'
+        return value
+
+    def decodePrefix(self, data, count):
+        """ Decode only the first C{count} items of the specified compactly
+        encoded list, or key/value pairs of the specified compactly encoded
+        dict (see C{Encoding.decodePrefix()})
+
+        @rtype: list or dict
+        """
+        if data[:1] != self.magic:
+            raise DecodeError, 'Data is not compactly encoded'
+        try:
+            tag = ord(data[1])
+            if tag == _ctagDict:
+                itemCount, index = _cvarintDecode(data, 2)
+                decodedDict = {}
+                for i in xrange(min(itemCount, count)):
+                    key, index = _cdecode(data, index)
+                    decodedDict[key], index = _cdecode(data, index)
+                return decodedDict
+            elif tag == _ctagList:
+                itemCount, index = _cvarintDecode(data, 2)
+                decodedList = []
+                for i in xrange(min(itemCount, count)):
+                    value, index = _cdecode(data, index)
+                    decodedList.append(value)
+                return decodedList
+        except (ValueError, TypeError, IndexError, struct.error, socket.error), e:
+            raise DecodeError, e
+        return self.decode(data)
+
+
+_ctagInt, _ctagStr, _ctagList, _ctagDict, _ctagFloat, _ctagNone, _ctagContact = range(1, 8)
+_ctagShortStr = 0x40
+_ctagSmallInt = 0x80
+_cmaxShort = 0x3f
+
+def _cvarint(value):
+    """ Returns the varint encoding of the specified non-negative integer """
+    if value < 0x80:
+        return chr(value)
+    bytes = []
+    while value >= 0x80:
+        bytes.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    bytes.append(chr(value))
+    return ''.join(bytes)
+
+def _cvarintDecode(data, index):
+    """ Decodes the varint starting at C{index}
+
+    @return: The decoded integer, and the index following it
+    @rtype: tuple
+    """
+    byte = ord(data[index])
+    index += 1
+    number = byte & 0x7f
+    shift = 7
+    while byte >= 0x80:
+        byte = ord(data[index])
+        index += 1
+        number |= (byte & 0x7f) << shift
+        shift += 7
+    return number, index
+
+def _cencodeItem(data, parts):
+    """ Appends the compactly encoded fragments of C{data} to the list C{parts} """
+    try:
+        encoder = _cencoders[type(data)]
+    except KeyError:
+        raise TypeError, "Cannot encode '%s' object" % type(data)
+    encoder(data, parts)
+
+def _cencodeInt(data, parts):
+    if 0 <= data <= _cmaxShort:
+        parts.append(chr(_ctagSmallInt + data))
+    elif data >= 0:
+        parts.append(chr(_ctagInt) + _cvarint(data << 1))
+    else:
+        parts.append(chr(_ctagInt) + _cvarint(((-data) << 1) - 1))
+
+def _cencodeStr(data, parts):
+    if len(data) <= _cmaxShort:
+        parts.append(chr(_ctagShortStr + len(data)))
+    else:
+        parts.append(chr(_ctagStr) + _cvarint(len(data)))
+    parts.append(data)
+
+def _cpackContact(data):
+    """ Returns the packed 26-byte representation of the specified contact
+    triple, or C{None} if it is not a contact triple that can be packed """
+    contactID, address, port = data
+    if type(contactID) != str or len(contactID) != 20 or type(address) != str \
+            or type(port) != int or not 0 <= port <= 0xffff:
+        return None
+    try:
+        packedAddress = socket.inet_aton(address)
+    except socket.error:
+        return None
+    if socket.inet_ntoa(packedAddress) != address:
+        # Not a dotted-quad address; it would not be decoded identically
+        return None
+    return contactID + packedAddress + struct.pack('>H', port)
+
+def _cencodeList(data, parts):
+    if len(data) == 3:
+        packedContact = _cpackContact(data)
+        if packedContact != None:
+            parts.append(chr(_ctagContact))
+            parts.append(packedContact)
+            return
+    append = parts.append
+    append(chr(_ctagList) + _cvarint(len(data)))
+    for item in data:
+        # Fast path for the most common item type
+        if type(item) == str and len(item) <= _cmaxShort:
+            append(chr(_ctagShortStr + len(item)))
+            append(item)
+        else:
+            _cencodeItem(item, parts)
+
+def _cencodeDict(data, parts):
+    parts.append(chr(_ctagDict) + _cvarint(len(data)))
+    for key, value in data.iteritems():
+        _cencodeItem(key, parts)
+        _cencodeItem(value, parts)
+
+def _cencodeFloat(data, parts):
+    parts.append(chr(_ctagFloat) + struct.pack('>d', data))
+
+def _cencodeNone(data, parts):
+    parts.append(chr(_ctagNone))
+
+def _cencodeRawData(data, parts):
+    if data.encoding == None or isinstance(data.encoding, CompactEncoding):
+        # Strip the magic byte
+        parts.append(data.data[1:])
+    else:
+        _cencodeItem(data.encoding.decode(data.data), parts)
+
+# Compact encoders, by (exact) data type
+_cencoders = {int: _cencodeInt,
+              long: _cencodeInt,
+              str: _cencodeStr,
+              list: _cencodeList,
+              tuple: _cencodeList,
+              dict: _cencodeDict,
+              float: _cencodeFloat,
+              RawData: _cencodeRawData,
+              type(None): _cencodeNone}
+
+def _cdecode(data, index):
+    """ Iterative implementation of the compact decoding algorithm
+
+    Do not call this; use C{CompactEncoding.decode()} instead
+
+    @return: The decoded item starting at C{index}, and the index following it
+    @rtype: tuple
+    """
+    # Partially decoded lists and dicts, as [items, remainingItems, isDict]
+    # lists; a dict's keys and values are collected in a flat list, and the
+    # dict is created once it is complete
+    stack = []
+    while True:
+        tag = ord(data[index])
+        index += 1
+        if tag >= _ctagSmallInt:
+            if tag > _ctagSmallInt + _cmaxShort:
+                raise DecodeError, 'Invalid type tag: %d' % tag
+            value = tag - _ctagSmallInt
+        elif tag >= _ctagShortStr:
+            endPos = index + tag - _ctagShortStr
+            value = data[index:endPos]
+            index = endPos
+        elif tag == _ctagContact:
+            endPos = index + 26
+            value = [data[index:index+20], socket.inet_ntoa(data[index+20:index+24]),
+                     struct.unpack('>H', data[index+24:endPos])[0]]
+            index = endPos
+        elif tag == _ctagFloat:
+            value = struct.unpack('>d', data[index:index+8])[0]
+            index += 8
+        elif tag == _ctagNone:
+            value = None
+        elif _ctagInt <= tag <= _ctagDict:
+            # The tag is followed by a varint
+            byte = ord(data[index])
+            index += 1
+            number = byte & 0x7f
+            shift = 7
+            while byte >= 0x80:
+                byte = ord(data[index])
+                index += 1
+                number |= (byte & 0x7f) << shift
+                shift += 7
+            if tag == _ctagInt:
+                value = (number >> 1) ^ -(number & 1)
+            elif tag == _ctagStr:
+                endPos = index + number
+                value = data[index:endPos]
+                index = endPos
+            elif number == 0:
+                if tag == _ctagList:
+                    value = []
+                else:
+                    value = {}
+            elif tag == _ctagList:
+                stack.append([[], number, False])
+                continue
+            else:
+                stack.append([[], number * 2, True])
+                continue
+        else:
+            raise DecodeError, 'Invalid type tag: %d' % tag
+        if index > len(data):
+            raise DecodeError, 'Item exceeds the end of the data'
+        # Add the item to its list or dict, completing them as necessary
+        while len(stack) > 0:
+            container = stack[-1]
+            container[0].append(value)
+            container[1] -= 1
+            if container[1] > 0:
+                break
+            stack.pop()
+            if container[2]:
+                items = container[0]
+                value = dict(zip(items[::2], items[1::2]))
+            else:
+                value = container[0]
+        else:
+            return value, index
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+""" Support for RPC messages that are spread over several UDP datagrams """
+
+import time
+from collections import OrderedDict
+
+import constants
+
+class PartialMessage(object):
+    """ An incompletely received multi-datagram message """
+    __slots__ = ('totalPackets', 'fragments', 'received', 'size', 'dataSize', 'deadline', 'lastProgress',
+                 'address', 'retransmitRequests', 'lastRetransmitRequest')
+
+    def __init__(self, totalPackets, deadline, address=None):
+        #: The total number of fragments in the message
+        self.totalPackets = totalPackets
+        # The received fragments, by sequence number; slots are only
+        # allocated for the fragments that actually arrive, since the
+        # (unauthenticated) total may be large
+        self.fragments = {}
+        self.received = 0
+        self.size = 0
+        #: The amount of payload data received (in bytes)
+        self.dataSize = 0
+        self.deadline = deadline
+        self.lastProgress = 0
+        #: The address the fragments are being received from
+        self.address = address
+        #: The number of times the missing fragments have been requested
+        self.retransmitRequests = 0
+        self.lastRetransmitRequest = 0
+
+    def missing(self, limit=None):
+        """ Returns the sequence numbers of the fragments not yet received
+
+        @param limit: The maximum number of sequence numbers to return (the
+                      lowest ones); if C{None}, all are returned
+        @type limit: int
+        """
+        fragments = self.fragments
+        missing = []
+        for seqNumber in xrange(self.totalPackets):
+            if seqNumber not in fragments:
+                if len(missing) == limit:
+                    break
+                missing.append(seqNumber)
+        return missing
+
+    def data(self):
+        """ Returns the reassembled message data; all fragments must have
+        been received """
+        fragments = self.fragments
+        return ''.join([fragments[seqNumber] for seqNumber in xrange(self.totalPackets)])
+
+
+class ReassemblyBuffer(object):
+    """ Collects the fragments of multi-datagram messages until they are
+    complete
+
+    Incomplete messages are kept for at most C{timeout} seconds after their
+    last fragment was received, and the total amount of buffered fragment
+    data (plus C{fragmentOverhead} bytes per fragment) is limited to
+    C{maxSize} bytes; if a new fragment would exceed this limit, the
+    incomplete messages that have made no progress for the longest time are
+    discarded to make room for it. Fragments of messages claiming more than
+    C{maxPackets} fragments are rejected.
+    """
+    def __init__(self, timeout, maxSize, maxPackets=None, fragmentOverhead=constants.reassemblyFragmentOverhead, clock=time.time):
+        """
+        @param timeout: The time (in seconds) an incomplete message may go
+                        without receiving any new fragments before it is
+                        discarded
+        @type timeout: float
+        @param maxSize: The maximum amount of fragment data (in bytes) to
+                        buffer across all incomplete messages
+        @type maxSize: int
+        @param maxPackets: The maximum number of fragments per message; if
+                           C{None}, this is not limited
+        @type maxPackets: int
+        @param fragmentOverhead: The amount of memory (in bytes) charged
+                                 against C{maxSize} for each fragment, in
+                                 addition to its payload
+        @type fragmentOverhead: int
+        @param clock: Callable returning the current time (in seconds)
+        """
+        self.timeout = timeout
+        self.maxSize = maxSize
+        self.maxPackets = maxPackets
+        self.fragmentOverhead = fragmentOverhead
+        self._clock = clock
+        # Ordered from least to most recently progressed (i.e. by deadline)
+        self._messages = OrderedDict()
+        #: The amount of fragment data currently buffered (in bytes),
+        #: including the per-fragment overhead
+        self.size = 0
+
+    def addFragment(self, msgID, seqNumber, totalPackets, data, address=None):
+        """ Store a received fragment, and reassemble its message if this
+        fragment completes it
+
+        @param msgID: The RPC ID of the message the fragment belongs to
+        @type msgID: str
+        @param seqNumber: The fragment's sequence number
+        @type seqNumber: int
+        @param totalPackets: The total number of fragments in the message
+        @type totalPackets: int
+        @param data: The fragment's payload
+        @type data: str
+        @param address: The address the fragment was received from
+        @type address: tuple
+
+        @return: The reassembled message data if it is now complete,
+                 otherwise C{None}
+        @rtype: str
+        """
+        now = self._clock()
+        self.expire(now)
+        if seqNumber >= totalPackets or (self.maxPackets != None and totalPackets > self.maxPackets):
+            return None
+        if msgID in self._messages:
+            partialMsg = self._messages[msgID]
+            if partialMsg.totalPackets != totalPackets:
+                # Conflicting header; the message is corrupt
+                del self._messages[msgID]
+                self.size -= partialMsg.size
+                return None
+            if seqNumber in partialMsg.fragments:
+                # A duplicate fragment makes no progress; leave the message
+                # (and its deadline) where it is
+                return None
+            del self._messages[msgID]
+        else:
+            partialMsg = PartialMessage(totalPackets, now + self.timeout, address)
+        size = len(data) + self.fragmentOverhead
+        if partialMsg.size + size > self.maxSize:
+            # This message on its own exceeds the budget; drop it
+            self.size -= partialMsg.size
+            return None
+        # Make room for the fragment, evicting the least recently progressed messages
+        while self.size + size > self.maxSize and len(self._messages) > 0:
+            oldMsg = self._messages.popitem(last=False)[1]
+            self.size -= oldMsg.size
+        partialMsg.fragments[seqNumber] = data
+        partialMsg.received += 1
+        partialMsg.size += size
+        partialMsg.dataSize += len(data)
+        partialMsg.deadline = now + self.timeout
+        partialMsg.lastProgress = now
+        self.size += size
+        if partialMsg.received == totalPackets:
+            self.size -= partialMsg.size
+            return partialMsg.data()
+        # (Re-)insert at the tail; this keeps the messages ordered by deadline
+        self._messages[msgID] = partialMsg
+        return None
+
+    def expire(self, now=None):
+        """ Discard all incomplete messages whose deadline has passed
+
+        @return: The RPC IDs of the discarded messages
+        @rtype: list
+        """
+        if now == None:
+            now = self._clock()
+        expiredIDs = []
+        while len(self._messages) > 0:
+            msgID = next(iter(self._messages))
+            partialMsg = self._messages[msgID]
+            if partialMsg.deadline > now:
+                break
+            del self._messages[msgID]
+            self.size -= partialMsg.size
+            expiredIDs.append(msgID)
+        return expiredIDs
+
+    def nextDeadline(self):
+        """ Returns the earliest deadline of all incomplete messages, or
+        C{None} if there are none """
+        if len(self._messages) == 0:
+            return None
+        return self._messages[next(iter(self._messages))].deadline
+
+    def stalledMessages(self, lastProgress):
+        """ Finds the incomplete messages that have not received any new
+        fragments since the specified time
+
+        @return: A list of C{(msgID, PartialMessage)} tuples, ordered from
+                 least to most recently progressed
+        @rtype: list
+        """
+        stalled = []
+        for msgID, partialMsg in self._messages.iteritems():
+            if partialMsg.lastProgress > lastProgress:
+                break
+            stalled.append((msgID, partialMsg))
+        return stalled
+
+    def progress(self, msgID):
+        """ Returns the number of fragments received for the specified
+        (incomplete) message
+
+        @raise KeyError: No fragments have been buffered for C{msgID}
+        """
+        return self._messages[msgID].received
+
+    def discard(self, msgID):
+        """ Discard the fragments of the specified message, if any """
+        partialMsg = self._messages.pop(msgID, None)
+        if partialMsg != None:
+            self.size -= partialMsg.size
+
+    def __getitem__(self, msgID):
+        return self._messages[msgID]
+
+    def __contains__(self, msgID):
+        return msgID in self._messages
+
+    def __len__(self):
+        return len(self._messages)
+
+
+class RetransmitBuffer(object):
+    """ Retains the fragments of recently sent multi-datagram messages, so
+    that individual fragments can be retransmitted if the receiver reports
+    them as missing
+
+    Messages are kept for at most C{timeout} seconds after they were last
+    (re)transmitted, and the total amount of retained data is limited to
+    C{maxSize} bytes, discarding the oldest messages first. Only
+    C{maxRequests} retransmission requests are answered per message, and
+    each fragment is sent at most once per request, so that the receiver
+    cannot make this node send more data than the message itself several
+    times over.
+    """
+    def __init__(self, timeout, maxSize, maxRequests=constants.fragmentRetransmitRequests, clock=time.time):
+        """
+        @param timeout: The time (in seconds) a message's fragments are
+                        retained after its last (re)transmission
+        @type timeout: float
+        @param maxSize: The maximum amount of fragment data (in bytes) to
+                        retain across all messages
+        @type maxSize: int
+        @param maxRequests: The maximum number of retransmission requests
+                            answered for each message
+        @type maxRequests: int
+        @param clock: Callable returning the current time (in seconds)
+        """
+        self.timeout = timeout
+        self.maxSize = maxSize
+        self.maxRequests = maxRequests
+        self._clock = clock
+        # Ordered by deadline; values are (address, fragments, size,
+        # deadline, number of retransmission requests answered) tuples
+        self._messages = OrderedDict()
+        #: The amount of fragment data currently retained (in bytes)
+        self.size = 0
+
+    def put(self, msgID, address, fragments):
+        """ Retain the fragments of a message sent to the specified address
+
+        @param fragments: The message's fragments (as transmitted), in
+                          sequence number order
+        @type fragments: list
+        """
+        self.discard(msgID)
+        now = self._clock()
+        self._expire(now)
+        size = sum([len(fragment) for fragment in fragments])
+        if size > self.maxSize:
+            return
+        while self.size + size > self.maxSize:
+            self.size -= self._messages.popitem(last=False)[1][2]
+        self._messages[msgID] = (address, fragments, size, now + self.timeout, 0)
+        self.size += size
+
+    def get(self, msgID, address, seqNumbers):
+        """ Look up fragments of a message for retransmission
+
+        @param seqNumbers: The sequence numbers of the requested fragments
+        @type seqNumbers: list
+
+        @return: The requested fragments (each at most once), or an empty
+                 list if the message is unknown, was not sent to
+                 C{address}, or its retransmission requests are exhausted
+        @rtype: list
+        """
+        now = self._clock()
+        self._expire(now)
+        if msgID not in self._messages:
+            return []
+        msgAddress, fragments, size, deadline, requests = self._messages[msgID]
+        if msgAddress != address or requests >= self.maxRequests:
+            return []
+        # Keep the message around for a while longer; the retransmission might get lost as well
+        del self._messages[msgID]
+        self._messages[msgID] = (msgAddress, fragments, size, now + self.timeout, requests + 1)
+        requested = set()
+        retransmitted = []
+        for seqNumber in seqNumbers:
+            if seqNumber < len(fragments) and seqNumber not in requested:
+                requested.add(seqNumber)
+                retransmitted.append(fragments[seqNumber])
+        return retransmitted
+
+    def discard(self, msgID):
+        """ Stop retaining the fragments of the specified message, if any """
+        entry = self._messages.pop(msgID, None)
+        if entry != None:
+            self.size -= entry[2]
+
+    def _expire(self, now):
+        while len(self._messages) > 0:
+            msgID = next(iter(self._messages))
+            if self._messages[msgID][3] > now:
+                break
+            self.size -= self._messages.pop(msgID)[2]
+
+    def __contains__(self, msgID):
+        return msgID in self._messages
+
+    def __len__(self):
+        return len(self._messages)
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+""" Generation of random node and RPC IDs """
+
+import os
+
+class IDGenerator(object):
+    """ Generates random IDs by slicing them from a pool of random bytes
+
+    Reading random data from the operating system in large batches makes
+    this considerably cheaper than generating (or hashing) random data for
+    each ID. The pool is discarded when the process forks, so that parent
+    and child processes do not generate the same IDs.
+    """
+    def __init__(self, idLength=20, poolSize=256, randomSource=os.urandom):
+        """
+        @param idLength: The length of the generated IDs, in bytes
+        @type idLength: int
+        @param poolSize: The number of IDs to read from C{randomSource} at once
+        @type poolSize: int
+        @param randomSource: Callable returning the specified number of
+                             random bytes
+        """
+        self.idLength = idLength
+        self._poolBytes = idLength * poolSize
+        self._randomSource = randomSource
+        self._ids = iter(())
+        self._pid = None
+
+    def generate(self):
+        """ Returns a new random ID
+
+        @rtype: str
+        """
+        if self._pid == os.getpid():
+            # Taking the next item from a list iterator is atomic, so this is
+            # thread-safe without locking
+            for id in self._ids:
+                return id
+        return self._refill()
+
+    def _refill(self):
+        """ Replace the pool of IDs, and return the first new ID """
+        pool = self._randomSource(self._poolBytes)
+        ids = iter([pool[i:i+self.idLength] for i in xrange(0, self._poolBytes, self.idLength)])
+        id = ids.next()
+        self._ids = ids
+        self._pid = os.getpid()
+        return id
+
+
+_generator = IDGenerator()
+
+def generateID():
+    """ Generates a 160-bit random identifier, as used for node IDs and RPC
+    IDs, from a process-wide pool
+
+    @rtype: str
+    """
+    return _generator.generate()
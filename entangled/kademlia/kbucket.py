@@ -7,6 +7,8 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
+from collections import OrderedDict
+
 import constants
 
 class BucketFull(Exception):
@@ -26,7 +28,11 @@ class KBucket(object):
         self.lastAccessed = 0
         self.rangeMin = rangeMin
         self.rangeMax = rangeMax
-        self._contacts = list()
+        # The contacts by node ID, from least to most recently seen
+        self._contacts = OrderedDict()
+        # Contacts that could not be added because the k-bucket is full, by
+        # node ID, from least to most recently seen; see addReplacement()
+        self._replacements = OrderedDict()
 
     def addContact(self, contact):
         """ Add contact to _contact list in the right order. This will move the
@@ -39,20 +45,39 @@ class KBucket(object):
         @param contact: The contact to add
         @type contact: kademlia.contact.Contact
         """
-        if contact in self._contacts:
-            # Move the existing contact to the end of the list
+        if contact.id in self._contacts:
+            # Move the existing contact to the end of the k-bucket
             # - using the new contact to allow add-on data (e.g. optimization-specific stuff) to pe updated as well
-            self._contacts.remove(contact)
-            self._contacts.append(contact)
+            del self._contacts[contact.id]
+            self._contacts[contact.id] = contact
         elif len(self._contacts) < constants.k:
-            self._contacts.append(contact)
+            self._contacts[contact.id] = contact
+            if len(self._replacements) > 0:
+                self._replacements.pop(contact.id, None)
         else:
             raise BucketFull("No space in bucket to insert contact")
 
     def getContact(self, contactID):
-        """ Get the contact specified node ID"""
-        index = self._contacts.index(contactID)
-        return self._contacts[index]
+        """ Get the contact specified node ID
+        
+        @raise ValueError: The specified contact is not in this bucket
+        """
+        try:
+            return self._contacts[contactID]
+        except KeyError:
+            raise ValueError, 'Contact not in k-bucket'
+
+    def getHeadContact(self):
+        """ Returns the contact at the head of the k-bucket, i.e. the least
+        recently seen one
+        
+        @raise IndexError: The k-bucket is empty
+        
+        @rtype: kademlia.contact.Contact
+        """
+        for contact in self._contacts.itervalues():
+            return contact
+        raise IndexError, 'K-bucket is empty'
 
     def getContacts(self, count=-1, excludeContact=None):
         """ Returns a list containing up to the first count number of contacts
@@ -91,17 +116,34 @@ class KBucket(object):
             contactList = list()
 
         # length of list less than requested amount
-        elif currentLen < count:
-            contactList = self._contacts[0:currentLen]
+        elif currentLen <= count:
+            contactList = self._contacts.values()
         # enough contacts in list
         else:
-            contactList = self._contacts[0:count]
+            contactList = self._contacts.values()[0:count]
             
         if excludeContact in contactList:
             contactList.remove(excludeContact)
 
         return contactList
 
+    def getContactsUnordered(self, excludeContact=None):
+        """ Returns a list of all contacts in this k-bucket, in no particular
+        order; this is cheaper than C{getContacts()}
+        
+        @param excludeContact: A contact (or contact ID) to exclude from the
+                               returned list
+        @type excludeContact: kademlia.contact.Contact or str
+        
+        @rtype: list
+        """
+        # Skip OrderedDict's (comparatively slow) ordered iteration
+        contacts = dict.values(self._contacts)
+        if excludeContact in self._contacts:
+            excludedContact = self._contacts[excludeContact]
+            contacts = [contact for contact in contacts if contact is not excludedContact]
+        return contacts
+
     def removeContact(self, contact):
         """ Remove given contact from list
         
@@ -111,8 +153,57 @@ class KBucket(object):
         
         @raise ValueError: The specified contact is not in this bucket
         """
-        self._contacts.remove(contact)
+        try:
+            del self._contacts[contact]
+        except KeyError:
+            raise ValueError, 'Contact not in k-bucket'
     
+    def addReplacement(self, contact):
+        """ Add a contact to this k-bucket's replacement cache, or move it to
+        the end of the cache if it is already present; if the cache is full,
+        its least recently seen contact is discarded
+
+        The replacement cache holds contacts that could not be added to the
+        (full) k-bucket, so that a stale contact can be replaced immediately
+        when it is removed; see C{popReplacement()}.
+
+        @param contact: The contact to add
+        @type contact: kademlia.contact.Contact
+        """
+        if contact.id in self._replacements:
+            del self._replacements[contact.id]
+        elif len(self._replacements) >= constants.replacementCacheSize:
+            self._replacements.popitem(last=False)
+        self._replacements[contact.id] = contact
+
+    def popReplacement(self):
+        """ Remove and return the most recently seen contact from this
+        k-bucket's replacement cache
+
+        @raise KeyError: The replacement cache is empty
+
+        @rtype: kademlia.contact.Contact
+        """
+        return self._replacements.popitem()[1]
+
+    def removeReplacement(self, contact):
+        """ Remove a contact from this k-bucket's replacement cache, if it is
+        present
+
+        @param contact: The contact to remove, or a string containing the
+                        contact's node ID
+        @type contact: kademlia.contact.Contact or str
+        """
+        self._replacements.pop(contact, None)
+
+    def getReplacements(self):
+        """ Returns the contacts in this k-bucket's replacement cache, from
+        least to most recently seen
+
+        @rtype: list
+        """
+        return self._replacements.values()
+
     def keyInRange(self, key):
         """ Tests whether the specified key (i.e. node ID) is in the range
         of the 160-bit ID space covered by this k-bucket (in otherwords, it
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+import threading
+from collections import OrderedDict
+
+class LRUCache(object):
+    """ A size-bounded, thread-safe cache, which discards its least recently
+    used entries first
+
+    Each entry has a size (e.g. its length in bytes); the total size of all
+    entries is limited to C{maxSize}.
+    """
+    def __init__(self, maxSize):
+        """
+        @param maxSize: The maximum total size of the cached entries
+        @type maxSize: int
+        """
+        self.maxSize = maxSize
+        #: The total size of the cached entries
+        self.size = 0
+        #: Incremented whenever entries are invalidated; see C{put()}
+        self.version = 0
+        # Ordered from least to most recently used; values are (value, size) tuples
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Returns the value cached for the specified key (marking it as
+        recently used), or C{default} if there is none """
+        self._lock.acquire()
+        try:
+            if key not in self._entries:
+                return default
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def put(self, key, value, size=1, version=None):
+        """ Cache a value, discarding the least recently used entries if
+        necessary to make room for it
+
+        @param size: The size of the entry
+        @type size: int
+        @param version: If specified, the value is only cached if no entries
+                        were invalidated since C{version} was read from this
+                        cache's C{version} attribute; use this to prevent
+                        caching values that were computed before concurrent
+                        invalidations
+        @type version: int
+        """
+        self._lock.acquire()
+        try:
+            if version != None and version != self.version:
+                return
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+            if size > self.maxSize:
+                return
+            while self.size + size > self.maxSize:
+                self.size -= self._entries.popitem(last=False)[1][1]
+            self._entries[key] = (value, size)
+            self.size += size
+        finally:
+            self._lock.release()
+
+    def discard(self, key):
+        """ Invalidate the value cached for the specified key, if any """
+        self._lock.acquire()
+        try:
+            self.version += 1
+            if key in self._entries:
+                self.size -= self._entries.pop(key)[1]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """ Invalidate all cached values """
+        self._lock.acquire()
+        try:
+            self.version += 1
+            self._entries.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
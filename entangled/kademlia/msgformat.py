@@ -7,8 +7,107 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
+import socket, struct
+
 import msgtypes
 
+class PackedContacts(object):
+    """ A list of contact triples, packed into a single string
+    
+    This is considerably smaller, and faster to encode and decode, than the
+    list itself. Each contact takes up 26 bytes: its 20-byte node ID,
+    followed by its 4-byte IPv4 address and 2-byte port number (or 38
+    bytes, for contacts with 16-byte IPv6 addresses; all contacts in the
+    list must use the same address family).
+    
+    Use C{encodeContacts()} and C{decodeContacts()} to create and unpack
+    these.
+    """
+    __slots__ = ('data', 'addressLength')
+    
+    def __init__(self, data, addressLength):
+        """
+        @param data: The packed contacts
+        @type data: str
+        @param addressLength: The length of the contacts' addresses (4 for
+                              IPv4, or 16 for IPv6)
+        @type addressLength: int
+        """
+        self.data = data
+        self.addressLength = addressLength
+
+_addressFamilies = {4: socket.AF_INET, 16: socket.AF_INET6}
+_portFormat = struct.Struct('>H')
+
+def _packAddress(address):
+    """ Returns the packed form of the specified IPv4 or IPv6 address, or
+    C{None} if it is not an address in its canonical textual form """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            packedAddress = socket.inet_pton(family, address)
+        except (socket.error, TypeError, ValueError):
+            continue
+        if socket.inet_ntop(family, packedAddress) != address:
+            # It would not be unpacked identically
+            return None
+        return packedAddress
+    return None
+
+def encodeContacts(contactTriples):
+    """ Pack the specified contact triples into a single string
+    
+    @param contactTriples: A list of C{(node ID, address, port)} triples
+    @type contactTriples: list
+    
+    @return: The packed contacts, or C{None} if they cannot be packed
+             (e.g. because their addresses are host names, or different
+             address families are used)
+    @rtype: PackedContacts
+    """
+    parts = []
+    addressLength = None
+    for contactID, address, port in contactTriples:
+        if type(contactID) != str or len(contactID) != 20 or type(port) not in (int, long) or not 0 <= port <= 0xffff:
+            return None
+        packedAddress = _packAddress(address)
+        if packedAddress == None:
+            return None
+        if addressLength == None:
+            addressLength = len(packedAddress)
+        elif len(packedAddress) != addressLength:
+            return None
+        parts.append(contactID)
+        parts.append(packedAddress)
+        parts.append(_portFormat.pack(port))
+    return PackedContacts(''.join(parts), addressLength or 4)
+
+def decodeContacts(packedContacts):
+    """ Unpack the specified packed contact triples
+    
+    @type packedContacts: PackedContacts
+    
+    @raise ValueError: The packed data is invalid
+    
+    @return: A list of C{(node ID, address, port)} triples
+    @rtype: list
+    """
+    data = packedContacts.data
+    addressLength = packedContacts.addressLength
+    if addressLength not in _addressFamilies or type(data) != str:
+        raise ValueError, 'Invalid packed contacts'
+    contactLength = 22 + addressLength
+    if len(data) % contactLength != 0:
+        raise ValueError, 'Invalid packed contacts length'
+    family = _addressFamilies[addressLength]
+    inet_ntop = socket.inet_ntop
+    unpackPort = _portFormat.unpack_from
+    contactTriples = []
+    for i in xrange(0, len(data), contactLength):
+        portIndex = i + 20 + addressLength
+        contactTriples.append( (data[i:i+20], inet_ntop(family, data[i+20:portIndex]), unpackPort(data, portIndex)[0]) )
+    return contactTriples
+
+
 class MessageTranslator(object):
     """ Interface for RPC message translators/formatters
     
@@ -16,6 +115,13 @@ class MessageTranslator(object):
     the classes used internally by this Kademlia implementation and the actual
     data that is transmitted between nodes.
     """
+    #: Whether this translator supports C{ResponseMessage}s with a
+    #: C{PackedContacts} response
+    packedContacts = False
+    #: Whether this translator translates messages into lists (see
+    #: C{TupleFormat}), which C{DefaultFormat} cannot translate back
+    listPrimitives = False
+
     def fromPrimitive(self, msgPrimitive):
         """ Create an RPC Message from a message's string representation
         
@@ -36,13 +142,40 @@ class MessageTranslator(object):
                  messaging format
         @rtype: str, int, list or dict
         """
+
+    def responseHeader(self, data, encoder):
+        """ Decode only the header of an encoded response (or error) message
+        
+        This allows discarding unwanted responses without decoding their
+        payloads; see C{entangled.kademlia.encoding.Encoding.decodePrefix()}.
+        This default implementation does not support it.
         
+        @param data: The encoded message
+        @type data: str
+        @param encoder: The encoding used for the message
+        @type encoder: entangled.kademlia.encoding.Encoding
+        
+        @return: The message's ID and its sender's node ID, or C{None} if
+                 the message is not a response (or error) message, or its
+                 header cannot be decoded on its own
+        @rtype: tuple
+        """
+        return None
+
+
 class DefaultFormat(MessageTranslator):
     """ The default on-the-wire message format for this library """
-    typeRequest, typeResponse, typeError = range(3)
-    headerType, headerMsgID, headerNodeID, headerPayload, headerArgs = range(5)
+    typeRequest, typeResponse, typeError, typeMulti, typeContacts = range(5)
+    headerType, headerMsgID, headerNodeID, headerPayload, headerArgs, headerCapabilities = range(6)
+    packedContacts = True
     
     def fromPrimitive(self, msgPrimitive):
+        msg = self._fromPrimitive(msgPrimitive)
+        if self.headerCapabilities in msgPrimitive:
+            msg.capabilities = msgPrimitive[self.headerCapabilities]
+        return msg
+
+    def _fromPrimitive(self, msgPrimitive):
         msgType = msgPrimitive[self.headerType]
         if msgType == self.typeRequest:
             msg = msgtypes.RequestMessage(msgPrimitive[self.headerNodeID], msgPrimitive[self.headerPayload], msgPrimitive[self.headerArgs], msgPrimitive[self.headerMsgID])
@@ -50,14 +183,40 @@ class DefaultFormat(MessageTranslator):
             msg = msgtypes.ResponseMessage(msgPrimitive[self.headerMsgID], msgPrimitive[self.headerNodeID], msgPrimitive[self.headerPayload])
         elif msgType == self.typeError:
             msg = msgtypes.ErrorMessage(msgPrimitive[self.headerMsgID], msgPrimitive[self.headerNodeID], msgPrimitive[self.headerPayload], msgPrimitive[self.headerArgs])
+        elif msgType == self.typeContacts:
+            # A response containing packed contact triples; unpack them
+            packedContacts = PackedContacts(msgPrimitive[self.headerPayload], msgPrimitive[self.headerArgs])
+            msg = msgtypes.ResponseMessage(msgPrimitive[self.headerMsgID], msgPrimitive[self.headerNodeID], decodeContacts(packedContacts))
+        elif msgType == self.typeMulti:
+            # The contained messages do not repeat the sender's node ID
+            messages = []
+            for subPrimitive in msgPrimitive[self.headerPayload]:
+                subPrimitive[self.headerNodeID] = msgPrimitive[self.headerNodeID]
+                if subPrimitive[self.headerType] != self.typeMulti:
+                    messages.append(self._fromPrimitive(subPrimitive))
+            msg = msgtypes.MultiMessage(msgPrimitive[self.headerNodeID], messages, msgPrimitive[self.headerMsgID])
         else:
             # Unknown message, no payload
             msg = msgtypes.Message(msgPrimitive[self.headerMsgID], msgPrimitive[self.headerNodeID])
         return msg
     
+    def responseHeader(self, data, encoder):
+        # Encoded dicts list their keys in ascending order (or at least, the
+        # small integer keys used here), so the message type, ID and node ID
+        # come first; don't bother decoding the latter for requests
+        try:
+            if encoder.decodePrefix(data, 1).get(self.headerType) not in (self.typeResponse, self.typeError, self.typeContacts):
+                return None
+            partialPrimitive = encoder.decodePrefix(data, 3)
+            return (partialPrimitive[self.headerMsgID], partialPrimitive[self.headerNodeID])
+        except (KeyError, AttributeError, TypeError):
+            return None
+    
     def toPrimitive(self, message):    
         msg = {self.headerMsgID:  message.id,
                self.headerNodeID: message.nodeID}
+        if message.capabilities != 0:
+            msg[self.headerCapabilities] = message.capabilities
         if isinstance(message, msgtypes.RequestMessage):
             msg[self.headerType] = self.typeRequest
             msg[self.headerPayload] = message.request
@@ -67,6 +226,84 @@ class DefaultFormat(MessageTranslator):
             msg[self.headerPayload] = message.exceptionType
             msg[self.headerArgs] = message.response
         elif isinstance(message, msgtypes.ResponseMessage):
-            msg[self.headerType] = self.typeResponse
-            msg[self.headerPayload] = message.response
+            if type(message.response) == PackedContacts:
+                msg[self.headerType] = self.typeContacts
+                msg[self.headerPayload] = message.response.data
+                msg[self.headerArgs] = message.response.addressLength
+            else:
+                msg[self.headerType] = self.typeResponse
+                msg[self.headerPayload] = message.response
+        elif isinstance(message, msgtypes.MultiMessage):
+            msg[self.headerType] = self.typeMulti
+            msg[self.headerPayload] = []
+            for subMessage in message.messages:
+                subPrimitive = self.toPrimitive(subMessage)
+                del subPrimitive[self.headerNodeID]
+                if self.headerCapabilities in subPrimitive:
+                    del subPrimitive[self.headerCapabilities]
+                msg[self.headerPayload].append(subPrimitive)
+        return msg
+
+
+class TupleFormat(DefaultFormat):
+    """ A more compact variant of C{DefaultFormat}, using lists instead of dicts
+    
+    Each message's fields are stored at fixed positions in a list (the
+    positions are the dict keys used by C{DefaultFormat}); trailing optional
+    fields are omitted. This avoids building (and encoding, and sorting the
+    keys of) a dict for every message.
+    
+    Messages in the C{DefaultFormat} format are translated as well, but nodes
+    using C{DefaultFormat} cannot translate messages in this format; the
+    protocol only sends messages in this format to nodes advertising support
+    for it (see C{KademliaProtocol.capabilityListFormat}), and uses
+    C{DefaultFormat} for all others.
+    """
+    listPrimitives = True
+
+    def fromPrimitive(self, msgPrimitive):
+        if type(msgPrimitive) != list:
+            return DefaultFormat.fromPrimitive(self, msgPrimitive)
+        msg = self._fromPrimitive(msgPrimitive)
+        if len(msgPrimitive) > self.headerCapabilities:
+            msg.capabilities = msgPrimitive[self.headerCapabilities]
+        return msg
+
+    def responseHeader(self, data, encoder):
+        try:
+            partialPrimitive = encoder.decodePrefix(data, 3)
+            if type(partialPrimitive) != list:
+                return DefaultFormat.responseHeader(self, data, encoder)
+            if partialPrimitive[self.headerType] not in (self.typeResponse, self.typeError, self.typeContacts):
+                return None
+            return (partialPrimitive[self.headerMsgID], partialPrimitive[self.headerNodeID])
+        except (IndexError, AttributeError, TypeError):
+            return None
+
+    def toPrimitive(self, message):
+        if isinstance(message, msgtypes.RequestMessage):
+            msg = [self.typeRequest, message.id, message.nodeID, message.request, message.args]
+        elif isinstance(message, msgtypes.ErrorMessage):
+            msg = [self.typeError, message.id, message.nodeID, message.exceptionType, message.response]
+        elif isinstance(message, msgtypes.ResponseMessage):
+            if type(message.response) == PackedContacts:
+                msg = [self.typeContacts, message.id, message.nodeID, message.response.data, message.response.addressLength]
+            else:
+                msg = [self.typeResponse, message.id, message.nodeID, message.response]
+        elif isinstance(message, msgtypes.MultiMessage):
+            subPrimitives = []
+            for subMessage in message.messages:
+                subPrimitive = self.toPrimitive(subMessage)
+                # Contained messages do not repeat the sender's node ID (or
+                # capabilities)
+                subPrimitive[self.headerNodeID] = None
+                del subPrimitive[self.headerCapabilities:]
+                subPrimitives.append(subPrimitive)
+            msg = [self.typeMulti, message.id, message.nodeID, subPrimitives]
+        else:
+            msg = [None, message.id, message.nodeID]
+        if message.capabilities != 0:
+            if len(msg) < self.headerCapabilities:
+                msg.extend([None] * (self.headerCapabilities - len(msg)))
+            msg.append(message.capabilities)
         return msg
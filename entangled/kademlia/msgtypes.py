@@ -7,23 +7,28 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
-import hashlib
-import random
+import idgenerator
 
 class Message(object):
     """ Base class for messages - all "unknown" messages use this class """
+    # Messages are created (and discarded) in large numbers; don't give each
+    # of them an instance dictionary
+    __slots__ = ('id', 'nodeID', 'capabilities')
+
     def __init__(self, rpcID, nodeID):
         self.id = rpcID
         self.nodeID = nodeID
+        #: Bit field of the optional protocol features supported by the sender
+        self.capabilities = 0
 
 
 class RequestMessage(Message):
     """ Message containing an RPC request """
+    __slots__ = ('request', 'args')
+
     def __init__(self, nodeID, method, methodArgs, rpcID=None):
         if rpcID == None:
-            hash = hashlib.sha1()
-            hash.update(str(random.getrandbits(255)))  
-            rpcID = hash.digest()
+            rpcID = idgenerator.generateID()
         Message.__init__(self, rpcID, nodeID)
         self.request = method
         self.args = methodArgs
@@ -31,6 +36,8 @@ class RequestMessage(Message):
 
 class ResponseMessage(Message):
     """ Message containing the result from a successful RPC request """
+    __slots__ = ('response',)
+
     def __init__(self, rpcID, nodeID, response):
         Message.__init__(self, rpcID, nodeID)
         self.response = response
@@ -38,9 +45,23 @@ class ResponseMessage(Message):
 
 class ErrorMessage(ResponseMessage):
     """ Message containing the error from an unsuccessful RPC request """
+    __slots__ = ('exceptionType',)
+
     def __init__(self, rpcID, nodeID, exceptionType, errorMessage):
         ResponseMessage.__init__(self, rpcID, nodeID, errorMessage)
         if isinstance(exceptionType, type):
             self.exceptionType = '%s.%s' % (exceptionType.__module__, exceptionType.__name__)
         else:
             self.exceptionType = exceptionType
+
+
+class MultiMessage(Message):
+    """ Message carrying several requests and/or responses, sent by the same
+    node to the same recipient """
+    __slots__ = ('messages',)
+
+    def __init__(self, nodeID, messages, rpcID=None):
+        if rpcID == None:
+            rpcID = idgenerator.generateID()
+        Message.__init__(self, rpcID, nodeID)
+        self.messages = messages
@@ -7,7 +7,7 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
-import hashlib, random, time
+import time
 
 from twisted.internet import defer
 
@@ -15,9 +15,12 @@ import constants
 import routingtable
 import datastore
 import protocol
+import idgenerator
+import lrucache
+import msgformat
 import twisted.internet.reactor
 import twisted.internet.threads
-from contact import Contact
+from contact import Contact, ContactRegistry
 
 def rpcmethod(func):
     """ Decorator to expose Node methods as remote procedure calls
@@ -28,6 +31,20 @@ def rpcmethod(func):
     func.rpcmethod = True
     return func
 
+def rpcthreaded(func):
+    """ Decorator marking RPC methods that may block (e.g. on data store
+    access), and should therefore not be executed in the reactor thread
+    
+    When handling RPCs, the protocol executes methods marked with this
+    decorator in a bounded pool of worker threads, if the node's
+    C{threadedRPCs} attribute is set. Such methods must be thread-safe, and
+    must not wait for the reactor thread (e.g. to access the routing table);
+    methods that need both can run only their data store access in a worker
+    thread, via C{Node._callDataStore()}.
+    """
+    func.rpcthreaded = True
+    return func
+
 class Node(object):
     """ Local node in the Kademlia network
     
@@ -85,6 +102,10 @@ class Node(object):
             self._protocol = protocol.KademliaProtocol(self)
         else:
             self._protocol = networkProtocol
+        # Share the protocol's interned contacts, if it keeps any
+        self._contacts = getattr(self._protocol, 'contacts', None)
+        if self._contacts == None:
+            self._contacts = ContactRegistry(self._protocol)
         # Initialize the data storage mechanism used by this node
         if dataStore == None:
             self._dataStore = datastore.DictDataStore()
@@ -95,8 +116,17 @@ class Node(object):
                 state = self._dataStore['nodeState']
                 self.id = state['id']
                 for contactTriple in state['closestNodes']:
-                    contact = Contact(contactTriple[0], contactTriple[1], contactTriple[2], self._protocol)
+                    contact = self._contacts.getContact(contactTriple[0], contactTriple[1], contactTriple[2])
                     self._routingTable.addContact(contact)
+        #: Whether RPC methods marked with C{rpcthreaded} are executed in
+        #: worker threads; this is only worthwhile if the data store may block
+        self.threadedRPCs = not isinstance(self._dataStore, datastore.DictDataStore)
+        # Pre-encoded responses to findNode/findValue RPCs, keyed by (method, key)
+        self._responseCache = lrucache.LRUCache(constants.responseCacheSize)
+        # (time last seen, contact) tuples by node ID, for contacts whose
+        # routing table refreshes were deferred; see addContact()
+        self._touchedContacts = {}
+        self._touchedContactsCall = None
 
     def __del__(self):
         self._persistState()
@@ -140,7 +170,7 @@ class Node(object):
     def printContacts(self):
         print '\n\nNODE CONTACTS\n==============='
         for i in range(len(self._routingTable._buckets)):
-            for contact in self._routingTable._buckets[i]._contacts:
+            for contact in self._routingTable._buckets[i].getContacts():
                 print contact
         print '=================================='
         #twisted.internet.reactor.callLater(10, self.printContacts)
@@ -172,7 +202,7 @@ class Node(object):
             if len(nodes) >= constants.k:
                 # If this node itself is closer to the key than the last (furthest) node in the list,
                 # we should store the value at ourselves as well
-                if self._routingTable.distance(key, self.id) < self._routingTable.distance(key, nodes[-1].id):
+                if self._routingTable.distance(key, self.id) < self._routingTable.distance(key, nodes[-1].idValue):
                     nodes.pop()
                     self.store(key, value, originalPublisherID=originalPublisherID, age=age)
             else:
@@ -258,9 +288,30 @@ class Node(object):
         """ Add/update the given contact; simple wrapper for the same method
         in this object's RoutingTable object
 
+        This is done for every message received. To keep it cheap, contacts
+        that were refreshed in the routing table less than
+        C{constants.touchInterval} seconds ago are not refreshed again right
+        away; instead, the refreshes are applied in a batch, in the order in
+        which the contacts were last seen.
+
         @param contact: The contact to add to this node's k-buckets
         @type contact: kademlia.contact.Contact
         """
+        now = time.time()
+        if now - contact.commTime < constants.touchInterval:
+            self._touchedContacts[contact.id] = (now, contact)
+            # The contact is alive, even if it isn't refreshed in the routing
+            # table yet
+            contact.failedRPCs = 0
+            if self._touchedContactsCall == None:
+                # Use the protocol's timers (if available), so that this is
+                # not called once the protocol is stopped
+                callLater = getattr(self._protocol, 'callLater', twisted.internet.reactor.callLater) #IGNORE:E1101
+                self._touchedContactsCall = callLater(constants.touchInterval, self._refreshTouchedContacts)
+            return
+        if len(self._touchedContacts) > 0:
+            self._touchedContacts.pop(contact.id, None)
+        contact.commTime = now
         self._routingTable.addContact(contact)
 
     def removeContact(self, contactID):
@@ -272,6 +323,14 @@ class Node(object):
         @type contactID: str
         """
         self._routingTable.removeContact(contactID)
+        if contactID in self._touchedContacts:
+            # The deferred refresh still applies, unless the contact was
+            # actually evicted (rather than just marked as having failed to
+            # respond)
+            try:
+                self._routingTable.getContact(contactID)
+            except ValueError:
+                del self._touchedContacts[contactID]
 
     def findContact(self, contactID):
         """ Find a entangled.kademlia.contact.Contact object for the specified
@@ -308,6 +367,7 @@ class Node(object):
         return 'pong'
 
     @rpcmethod
+    @rpcthreaded
     def store(self, key, value, originalPublisherID=None, age=0, **kwargs):
         """ Store the received data in this node's local hash table
         
@@ -345,6 +405,7 @@ class Node(object):
         now = int(time.time())
         originallyPublished = now - age
         self._dataStore.setItem(key, value, now, originallyPublished, originalPublisherID)
+        self._responseCache.discard(('findValue', key))
         return 'OK'
 
     @rpcmethod
@@ -359,18 +420,49 @@ class Node(object):
                  This method will return C{k} (or C{count}, if specified)
                  contacts if at all possible; it will only return fewer if the
                  node is returning all of the contacts that it knows of.
+                 Remote nodes supporting it are sent the contact triples
+                 packed into a single string (which their protocol unpacks).
         @rtype: list
         """
         # Get the sender's ID (if any)
         if '_rpcNodeID' in kwargs:
             rpcSenderID = kwargs['_rpcNodeID']
         else:
-            rpcSenderID = None
-        contacts = self._routingTable.findCloseNodes(key, constants.k, rpcSenderID)
-        contactTriples = []
-        for contact in contacts:
-            contactTriples.append( (contact.id, contact.address, contact.port) )
-        return contactTriples
+            return self._contactTriples(self._routingTable.findCloseNodes(key, constants.k))
+        generation = getattr(self._routingTable, 'generation', None)
+        if generation == None or not hasattr(self._protocol, 'payloadEncoder'):
+            # The response cannot be cached
+            return self._contactTriples(self._routingTable.findCloseNodes(key, constants.k, rpcSenderID))
+        rpcSenderContact = kwargs.get('_rpcNodeContact')
+        packContacts = rpcSenderContact != None and self._protocol.peerSupports(rpcSenderContact, self._protocol.capabilityCompactContacts)
+        # Cache entries contain the closest contacts' IDs and triples, and the
+        # responses for the different formats used by remote nodes (packed
+        # contacts, or the contact triples pre-encoded with their encoding)
+        cacheKey = ('findNode', key)
+        entry = self._responseCache.get(cacheKey)
+        if entry == None or entry[0] != generation:
+            contacts = self._routingTable.findCloseNodes(key, constants.k)
+            entry = (generation, set([contact.id for contact in contacts]), self._contactTriples(contacts), {})
+        if rpcSenderID in entry[1]:
+            # A sender is never sent its own contact
+            contactTriples = self._contactTriples(self._routingTable.findCloseNodes(key, constants.k, rpcSenderID))
+            if packContacts:
+                return msgformat.encodeContacts(contactTriples) or contactTriples
+            return contactTriples
+        responses = entry[3]
+        if packContacts:
+            responseFormat = msgformat.PackedContacts
+        else:
+            responseFormat = self._protocol.payloadEncoder(rpcSenderContact)
+        if responseFormat not in responses:
+            response = None
+            if packContacts:
+                response = msgformat.encodeContacts(entry[2])
+            if response == None:
+                response = self._protocol.encodePayload(entry[2], rpcSenderContact)
+            responses[responseFormat] = response
+            self._responseCache.put(cacheKey, entry, self._responsesSize(responses))
+        return responses[responseFormat]
 
     @rpcmethod
     def findValue(self, key, **kwargs):
@@ -384,10 +476,89 @@ class Node(object):
                  or a list of contact triples closest to the requested key.
         @rtype: dict or list
         """
+        result = self._callDataStore(kwargs, self._findStoredValue, key, kwargs)
+        if isinstance(result, defer.Deferred):
+            result.addCallback(self._findNodeIfNotStored, key, kwargs)
+            return result
+        return self._findNodeIfNotStored(result, key, kwargs)
+
+    def _findStoredValue(self, key, kwargs):
+        """ The data store access of C{findValue()}; this may be executed in
+        a worker thread
+
+        @return: The (possibly encoded) response containing the value, or
+                 C{None} if the value is not stored by this node
+        """
+        if '_rpcNodeID' not in kwargs or not hasattr(self._protocol, 'payloadEncoder'):
+            # The response cannot be cached
+            if key in self._dataStore:
+                return {key: self._dataStore[key]}
+            else:
+                return None
+        rpcSenderContact = kwargs.get('_rpcNodeContact')
+        encoder = self._protocol.payloadEncoder(rpcSenderContact)
+        # Values that are stored (or deleted) while this executes must not be
+        # replaced by the (stale) response
+        version = self._responseCache.version
+        # Cache entries contain the responses encoded for the different
+        # encodings used by remote nodes
+        cacheKey = ('findValue', key)
+        responses = self._responseCache.get(cacheKey)
+        if responses != None and encoder in responses:
+            return responses[encoder]
         if key in self._dataStore:
-            return {key: self._dataStore[key]}
+            if responses == None:
+                responses = {}
+            responses[encoder] = self._protocol.encodePayload({key: self._dataStore[key]}, rpcSenderContact)
+            self._responseCache.put(cacheKey, responses, self._responsesSize(responses), version)
+            return responses[encoder]
         else:
+            return None
+
+    def _findNodeIfNotStored(self, response, key, kwargs):
+        """ Returns the response from C{_findStoredValue()}, or executes
+        FIND_NODE for the key if the value is not stored by this node; this
+        must be called in the reactor thread """
+        if response == None:
             return self.findNode(key, **kwargs)
+        return response
+
+    def _responsesSize(self, responses):
+        """ Returns the total size of the specified encoded responses, for
+        the response cache """
+        size = 0
+        for response in responses.itervalues():
+            size += len(response.data)
+        return size
+
+    def _contactTriples(self, contacts):
+        """ Returns the C{(id, address, port)} triples of the specified contacts
+
+        @rtype: list
+        """
+        contactTriples = []
+        for contact in contacts:
+            contactTriples.append( (contact.id, contact.address, contact.port) )
+        return contactTriples
+
+    def _callDataStore(self, rpcKwargs, func, *args):
+        """ Calls the specified function, which accesses the (possibly
+        blocking) data store on behalf of an RPC method
+
+        If the RPC method is handling a remote call (as indicated by the
+        sender information in C{rpcKwargs}) and the node's C{threadedRPCs}
+        attribute is set, the function is executed in the protocol's pool of
+        worker threads, and a deferred firing with its result is returned;
+        callbacks added to it run in the reactor thread, and may access the
+        routing table. Otherwise, the function's result is returned directly.
+
+        @param rpcKwargs: The keyword arguments passed to the RPC method
+        @type rpcKwargs: dict
+        """
+        if '_rpcNodeID' in rpcKwargs and self.threadedRPCs and constants.rpcThreadPoolSize > 0 \
+           and hasattr(self._protocol, 'callInThreadPool'):
+            return self._protocol.callInThreadPool(func, *args)
+        return func(*args)
 
 #    def _distance(self, keyOne, keyTwo):
 #        """ Calculate the XOR result between two string variables
@@ -405,9 +576,7 @@ class Node(object):
         @return: A globally unique 160-bit pseudo-random identifier
         @rtype: str
         """
-        hash = hashlib.sha1()
-        hash.update(str(random.getrandbits(255)))
-        return hash.digest()
+        return idgenerator.generateID()
 
     def _iterativeFind(self, key, startupShortlist=None, rpc='findNode'):
         """ The basic Kademlia iterative lookup operation (for nodes/values)
@@ -441,9 +610,14 @@ class Node(object):
             findValue = True
         else:
             findValue = False
+        # The key's integer value, for the many distance calculations below
+        valKey = routingtable.keyValue(key)
         shortlist = []
         if startupShortlist == None:
-            shortlist = self._routingTable.findCloseNodes(key, constants.alpha)
+            # Start with the k closest known nodes; only alpha of them are
+            # contacted at a time, but the others can take the place of
+            # those that do not respond
+            shortlist = self._routingTable.findCloseNodes(key, constants.k)
             if key != self.id:
                 # Update the "last accessed" timestamp for the appropriate k-bucket
                 self._routingTable.touchKBucket(key)
@@ -486,7 +660,7 @@ class Node(object):
             else:
                 # If it's not in the shortlist; we probably used a fake ID to reach it
                 # - reconstruct the contact, using the real node ID this time
-                aContact = Contact(responseMsg.nodeID, originAddress[0], originAddress[1], self._protocol)
+                aContact = self._contacts.getContact(responseMsg.nodeID, originAddress[0], originAddress[1])
             activeContacts.append(aContact)
             # This makes sure "bootstrap"-nodes with "fake" IDs don't get queried twice
             if responseMsg.nodeID not in alreadyContacted:
@@ -504,15 +678,14 @@ class Node(object):
                     # We are looking for a value, and the remote node didn't have it
                     # - mark it as the closest "empty" node, if it is
                     if 'closestNodeNoValue' in findValueResult:
-                        if self._routingTable.distance(key, responseMsg.nodeID) < self._routingTable.distance(key, activeContacts[0].id):
+                        if self._routingTable.distance(valKey, aContact.idValue) < self._routingTable.distance(valKey, activeContacts[0].idValue):
                             findValueResult['closestNodeNoValue'] = aContact
                     else:
                         findValueResult['closestNodeNoValue'] = aContact
                 for contactTriple in result:
                     if isinstance(contactTriple, (list, tuple)) and len(contactTriple) == 3:
-                        testContact = Contact(contactTriple[0], contactTriple[1], contactTriple[2], self._protocol)
-                        if testContact not in shortlist:
-                            shortlist.append(testContact)
+                        if contactTriple[0] not in shortlist:
+                            shortlist.append(self._contacts.getContact(contactTriple[0], contactTriple[1], contactTriple[2]))
             return responseMsg.nodeID
 
         def removeFromShortlist(failure):
@@ -537,7 +710,7 @@ class Node(object):
             #print '==> searchiteration'
             slowNodeCount[0] = len(activeProbes)
             # Sort the discovered active nodes from closest to furthest
-            activeContacts.sort(lambda firstContact, secondContact, targetKey=key: cmp(self._routingTable.distance(firstContact.id, targetKey), self._routingTable.distance(secondContact.id, targetKey)))
+            self._routingTable.sortByDistance(activeContacts, valKey)
             # This makes sure a returning probe doesn't force calling this function by mistake
             while len(pendingIterationCalls):
                 del pendingIterationCalls[0]
@@ -560,7 +733,7 @@ class Node(object):
             if len(activeContacts):
                 prevClosestNode[0] = activeContacts[0]
             contactedNow = 0
-            shortlist.sort(lambda firstContact, secondContact, targetKey=key: cmp(self._routingTable.distance(firstContact.id, targetKey), self._routingTable.distance(secondContact.id, targetKey)))
+            self._routingTable.sortByDistance(shortlist, valKey)
             # Store the current shortList length before contacting other nodes
             prevShortlistLength = len(shortlist)
             for contact in shortlist:
@@ -672,11 +845,22 @@ class Node(object):
 #        #print '_refreshKbuckets returning'
 #        return outerDf
 
+    def _refreshTouchedContacts(self):
+        """ Applies the routing table refreshes deferred by C{addContact()} """
+        self._touchedContactsCall = None
+        touchedContacts = self._touchedContacts.values()
+        self._touchedContacts = {}
+        touchedContacts.sort(key=lambda item: item[0])
+        for lastSeen, contact in touchedContacts:
+            contact.commTime = lastSeen
+            self._routingTable.addContact(contact)
+
     def _persistState(self, *args):
         state = {'id': self.id,
                  'closestNodes': self.findNode(self.id)}
         now = int(time.time())
         self._dataStore.setItem('nodeState', state, now, now, self.id)
+        self._responseCache.discard(('findValue', 'nodeState'))
 
     def _refreshNode(self):
         """ Periodically called to perform k-bucket refreshes and data
@@ -749,6 +933,7 @@ class Node(object):
         for key in expiredKeys:
             #print '    expiring key:', key
             del self._dataStore[key]
+            self._responseCache.discard(('findValue', key))
         #print 'done with threadedDataRefresh()'
 
 
@@ -7,38 +7,150 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
-import time
+import time, struct, inspect
 
-from twisted.internet import protocol, defer
-from twisted.python import failure
+from twisted.internet import protocol, defer, threads
+from twisted.python import failure, threadpool
 import twisted.internet.reactor
 
 import constants
 import encoding
 import msgtypes
 import msgformat
-from contact import Contact
+import sendqueue
+import fragmentation
+import rtt
+import timerwheel
+from contact import ContactRegistry
 
 reactor = twisted.internet.reactor
 
 class TimeoutError(Exception):
     """ Raised when a RPC times out """
 
+# The names of the keyword arguments used to pass information about the
+# sender of an RPC to the method handling it
+_rpcSenderArgs = ('_rpcNodeID', '_rpcNodeContact')
+
+def _rpcDispatchTable(node):
+    """ Builds the RPC dispatch table for the specified node
+
+    The table maps the names of all methods exposed by the C{rpcmethod}
+    decorator to C{(method, senderArgs, threaded)} tuples, where C{method}
+    is bound to C{node} (as returned by C{getattr()}, so methods overridden
+    or wrapped on the node instance are honoured), C{senderArgs} lists the
+    keyword arguments describing the RPC's sender that the method accepts,
+    and C{threaded} indicates whether the method was marked with the
+    C{rpcthreaded} decorator.
+
+    @rtype: dict
+    """
+    table = {}
+    for name in dir(node):
+        func = getattr(node, name, None)
+        if not callable(func) or not hasattr(func, 'rpcmethod'):
+            continue
+        try:
+            argNames, varArgs, varKeywords, defaults = inspect.getargspec(func)
+        except TypeError:
+            # Not a Python function; don't pass it any sender information
+            senderArgs = ()
+        else:
+            if varKeywords != None:
+                senderArgs = _rpcSenderArgs
+            else:
+                senderArgs = tuple([arg for arg in _rpcSenderArgs if arg in argNames])
+        table[name] = (func, senderArgs, hasattr(func, 'rpcthreaded'))
+    return table
+
 class KademliaProtocol(protocol.DatagramProtocol):
     """ Implements all low-level network-related functions of a Kademlia node """
     msgSizeLimit = constants.udpDatagramMaxSize-26
-    maxToSendDelay = 10**-3#0.05
-    minToSendDelay = 10**-5#0.01
+    #: Capability flag: the node accepts C{MultiMessage}s (several requests
+    #: and/or responses in a single datagram)
+    capabilityMultiCall = 0x01
+    #: Capability flag: the node accepts messages encoded with
+    #: C{encoding.CompactEncoding}
+    capabilityCompactEncoding = 0x02
+    #: Capability flag: the node accepts contact triples packed into a single
+    #: string (see C{msgformat.PackedContacts}) in response to its RPCs
+    capabilityCompactContacts = 0x04
+    #: Capability flag: the node accepts messages in the list-based
+    #: C{msgformat.TupleFormat} format
+    capabilityListFormat = 0x08
+    #: Bit field of the optional protocol features supported by this node;
+    #: this is advertised to remote nodes in all sent messages
+    capabilities = capabilityMultiCall | capabilityCompactEncoding | capabilityCompactContacts | capabilityListFormat
 
-    def __init__(self, node, msgEncoder=encoding.Bencode(), msgTranslator=msgformat.DefaultFormat()):
+    def __init__(self, node, msgEncoder=encoding.Bencode(), msgTranslator=msgformat.DefaultFormat(), compactEncoder=encoding.CompactEncoding()):
+        """
+        @param msgEncoder: The encoding used for messages sent to nodes that
+                           do not support C{compactEncoder}
+        @type msgEncoder: entangled.kademlia.encoding.Encoding
+        @param msgTranslator: The message format; if it translates messages
+                              into lists (e.g. C{msgformat.TupleFormat}),
+                              messages are only sent in this format to
+                              nodes advertising the C{capabilityListFormat}
+                              capability, and in C{msgformat.DefaultFormat}
+                              to all others
+        @type msgTranslator: entangled.kademlia.msgformat.MessageTranslator
+        @param compactEncoder: The encoding used for messages sent to nodes
+                               advertising the C{capabilityCompactEncoding}
+                               capability; if C{None}, it is not supported
+        @type compactEncoder: entangled.kademlia.encoding.CompactEncoding
+        """
         self._node = node
+        #: Interns the Contact objects of remote nodes, for this protocol's
+        #: node and its routing table
+        self.contacts = ContactRegistry(self)
         self._encoder = msgEncoder
         self._translator = msgTranslator
+        if getattr(msgTranslator, 'listPrimitives', False):
+            self._dictTranslator = msgformat.DefaultFormat()
+        else:
+            self._dictTranslator = msgTranslator
+            self.capabilities &= ~self.capabilityListFormat
+        self._compactEncoder = compactEncoder
+        if compactEncoder == None:
+            self.capabilities &= ~self.capabilityCompactEncoding
+        if not getattr(msgTranslator, 'packedContacts', False):
+            self.capabilities &= ~self.capabilityCompactContacts
         self._sentMessages = {}
-        self._partialMessages = {}
+        # The node's exposed RPC methods, by name; see _rpcDispatchTable()
+        self._dispatchTable = None
+        # Round-trip time statistics for remote nodes, by node ID
+        self._rttEstimators = {}
+        # Messages larger than the buffer can never be reassembled; their
+        # fragments are rejected outright
+        self._partialMessages = fragmentation.ReassemblyBuffer(constants.reassemblyTimeout, constants.reassemblyBufferSize,
+                                                               constants.reassemblyBufferSize / self.msgSizeLimit)
         self._partialMessagesProgress = {}
-        self._next = 0
-        self._callLaterList = {}
+        self._reassemblyCall = None
+        # Fragments of sent multi-datagram messages, kept for selective retransmission
+        self._sentFragments = fragmentation.RetransmitBuffer(constants.retransmitBufferTimeout, constants.retransmitBufferSize,
+                                                             constants.fragmentRetransmitRequests)
+        # Outbound packets are paced through this queue by a single timer
+        self._sendQueue = sendqueue.SendQueue(constants.sendRatePackets, constants.sendRateBytes,
+                                              constants.sendQueueSize, constants.sendBurstTime,
+                                              constants.udpDatagramMaxSize)
+        self._sendQueueCall = None
+        # RPC timeouts are kept in a timer wheel that is expired in batches
+        # by a single periodic timer, instead of one reactor timer per RPC
+        self._timeouts = timerwheel.TimerWheel(constants.rpcTimeoutResolution)
+        self._timeoutsCall = None
+        # Worker threads for blocking RPC methods; created when first needed
+        self._threadPool = None
+        self._threadPoolShutdownID = None
+        # Capabilities advertised by remote nodes, by address
+        self._peerCapabilities = {}
+        # Messages being coalesced into multi-call datagrams, by address
+        self._pendingBatches = {}
+        self._batchCall = None
+        # Deferreds waiting for the results of identical in-flight RPCs, by
+        # (contact ID, address, port, method, arguments, rawResponse)
+        self._inflightRPCs = {}
+        self._rpcCalls = 0
+        self._rpcCallsDeduplicated = 0
 
     def sendRPC(self, contact, method, args, rawResponse=False):
         """ Sends an RPC to the specified contact
@@ -66,21 +178,142 @@ class KademliaProtocol(protocol.DatagramProtocol):
                  message (which may be a C{ResponseMessage} or an
                  C{ErrorMessage}).
         @rtype: twisted.internet.defer.Deferred
+
+        @note: If an identical RPC (same contact, method and arguments) is
+               still in flight, no new request is sent; instead, the result
+               of the earlier RPC is passed to all callers.
         """
+        self._rpcCalls += 1
+        if isinstance(args, list):
+            callKey = (contact.id, contact.address, contact.port, method, tuple(args), rawResponse)
+        else:
+            callKey = (contact.id, contact.address, contact.port, method, args, rawResponse)
+        try:
+            waiters = self._inflightRPCs.get(callKey)
+        except TypeError:
+            # Unhashable arguments; don't bother trying to deduplicate this RPC
+            callKey = None
+            waiters = None
+        if waiters != None:
+            self._rpcCallsDeduplicated += 1
+            df = defer.Deferred()
+            waiters.append(df)
+            return df
+
         msg = msgtypes.RequestMessage(self._node.id, method, args)
-        msgPrimitive = self._translator.toPrimitive(msg)
-        encodedMsg = self._encoder.encode(msgPrimitive)
 
         df = defer.Deferred()
         if rawResponse:
             df._rpcRawResponse = True
+        if callKey != None:
+            # Let identical RPCs share this one, each receiving the result via its own deferred
+            waiters = [defer.Deferred()]
+            self._inflightRPCs[callKey] = waiters
+            def fanOut(result):
+                del self._inflightRPCs[callKey]
+                for waiter in waiters:
+                    if isinstance(result, failure.Failure):
+                        waiter.errback(result)
+                    else:
+                        waiter.callback(result)
+            df.addBoth(fanOut)
 
-        # Set the RPC timeout timer
-        timeoutCall = reactor.callLater(constants.rpcTimeout, self._msgTimeout, msg.id) #IGNORE:E1101
+        # The RPC timeout timer is only set once the request is queued for
+        # transmission; see _setRPCTimeouts()
+        self._sentMessages[msg.id] = (contact.id, df, None, time.time())
         # Transmit the data
-        self._send(encodedMsg, msg.id, (contact.address, contact.port))
-        self._sentMessages[msg.id] = (contact.id, df, timeoutCall)
-        return df
+        self._sendMessage(msg, (contact.address, contact.port))
+        if callKey != None:
+            return waiters[0]
+        else:
+            return df
+
+    def rpcTimeout(self, contactID):
+        """ Calculate the timeout for an RPC sent to the specified contact
+
+        This is derived from the round-trip times measured for previous RPCs
+        sent to the contact, and lies between C{constants.rpcTimeoutMin} and
+        C{constants.rpcTimeout}. The timer is started once the request is
+        queued for transmission, and is extended by the time it takes to
+        transmit the send queue's backlog (see C{_setRPCTimeouts()}).
+
+        @param contactID: The node ID of the remote node
+        @type contactID: str
+
+        @return: The timeout, in seconds
+        @rtype: float
+        """
+        maxTimeout = constants.rpcTimeout
+        if contactID not in self._rttEstimators:
+            return maxTimeout
+        return self._rttEstimators[contactID].timeout(min(constants.rpcTimeoutMin, maxTimeout), maxTimeout)
+
+    def rttStatistics(self, contactID):
+        """ Returns the round-trip time statistics measured for the specified
+        contact, e.g. to allow preferring fast nodes
+
+        @param contactID: The node ID of the remote node
+        @type contactID: str
+
+        @return: The contact's statistics, or C{None} if no RPCs have been
+                 sent to it
+        @rtype: entangled.kademlia.rtt.RTTEstimator
+        """
+        return self._rttEstimators.get(contactID)
+
+    def peerSupports(self, contact, capability):
+        """ Returns whether both this node and the specified contact support
+        the specified optional protocol feature, i.e. whether it can be used
+        when communicating with the contact
+
+        @param contact: The remote node
+        @type contact: entangled.kademlia.contact.Contact
+        @param capability: The capability flag of the feature, e.g.
+                           C{capabilityCompactContacts}
+        @type capability: int
+
+        @rtype: bool
+        """
+        return self._peerSupports((contact.address, contact.port), capability)
+
+    def payloadEncoder(self, contact=None):
+        """ Returns the encoding used for messages sent to the specified
+        contact, which depends on the capabilities it advertised
+
+        @param contact: The remote node; if C{None}, the default encoding
+                        is returned
+        @type contact: entangled.kademlia.contact.Contact
+
+        @rtype: entangled.kademlia.encoding.Encoding
+        """
+        if contact == None:
+            return self._encoder
+        return self._encoderFor((contact.address, contact.port))
+
+    def encodePayload(self, value, contact=None):
+        """ Encode an RPC result in advance, e.g. so that it can be cached
+        and sent repeatedly without encoding it again
+
+        @param contact: The remote node the result will be sent to; see
+                        C{payloadEncoder()}
+
+        @return: The encoded result, which may be returned from RPC methods
+                 in place of C{value}
+        @rtype: entangled.kademlia.encoding.RawData
+        """
+        encoder = self.payloadEncoder(contact)
+        return encoding.RawData(encoder.encode(value), encoder)
+
+    def rpcDeduplicationRatio(self):
+        """ Returns the fraction of RPCs (sent via C{sendRPC()}) that were
+        answered by sharing an identical in-flight RPC, instead of sending
+        a new request
+
+        @rtype: float
+        """
+        if self._rpcCalls == 0:
+            return 0.0
+        return self._rpcCallsDeduplicated / float(self._rpcCalls)
 
     def datagramReceived(self, datagram, address):
         """ Handles and parses incoming RPC messages (and responses)
@@ -88,75 +321,224 @@ class KademliaProtocol(protocol.DatagramProtocol):
         @note: This is automatically called by Twisted when the protocol
                receives a UDP datagram
         """
-        if datagram[0] == '\x00' and datagram[25] == '\x00':
+        if len(datagram) > 26 and datagram[0] == '\x00' and datagram[25] == '\x00':
             totalPackets = (ord(datagram[1]) << 8) | ord(datagram[2])
             msgID = datagram[5:25]
             seqNumber = (ord(datagram[3]) << 8) | ord(datagram[4])
-            if msgID not in self._partialMessages:
-                self._partialMessages[msgID] = {}
-            self._partialMessages[msgID][seqNumber] = datagram[26:]
-            if len(self._partialMessages[msgID]) == totalPackets:
-                keys = self._partialMessages[msgID].keys()
-                keys.sort()
-                data = ''
-                for key in keys:
-                    data += self._partialMessages[msgID][key]
-                    datagram = data
-                del self._partialMessages[msgID]
-            else:
+            datagram = self._partialMessages.addFragment(msgID, seqNumber, totalPackets, datagram[26:], address)
+            if datagram == None:
+                if seqNumber == totalPackets - 1 and msgID in self._partialMessages:
+                    # The last fragment arrived, but some of the others were lost; ask for them immediately
+                    self._requestRetransmission(msgID, self._partialMessages[msgID])
+                self._schedulePartialMessagesCheck()
                 return
+            if msgID in self._partialMessagesProgress:
+                del self._partialMessagesProgress[msgID]
+            reassembled = True
+        elif len(datagram) >= 26 and datagram[0] == '\x01' and datagram[25] == '\x00':
+            # The receiver of a multi-datagram message is requesting the retransmission of missing fragments
+            msgID = datagram[5:25]
+            missingCount = (ord(datagram[3]) << 8) | ord(datagram[4])
+            missingCount = min(missingCount, (len(datagram) - 26) / 2)
+            seqNumbers = struct.unpack('>%dH' % missingCount, datagram[26:26+2*missingCount])
+            for txData in self._sentFragments.get(msgID, address, seqNumbers):
+                self._sendNext(txData, address)
+            return
+        else:
+            reassembled = False
+        if self._compactEncoder != None and datagram[:1] == self._compactEncoder.magic:
+            encoder = self._compactEncoder
+        else:
+            encoder = self._encoder
         try:
-            msgPrimitive = self._encoder.decode(datagram)
+            # Decode the header of responses first; responses to RPCs that
+            # have timed out (or were never sent) are discarded without
+            # decoding their payloads
+            header = self._translator.responseHeader(datagram, encoder)
+            if header != None and header[0] not in self._sentMessages:
+                msgID, nodeID = header
+                # The remote node is alive, though
+                self._node.addContact(self.contacts.getContact(nodeID, address[0], address[1]))
+                return
+            msgPrimitive = encoder.decode(datagram)
         except encoding.DecodeError:
             # We received some rubbish here
             return
         
         message = self._translator.fromPrimitive(msgPrimitive)
-        remoteContact = Contact(message.nodeID, address[0], address[1], self)
+        remoteContact = self.contacts.getContact(message.nodeID, address[0], address[1])
         
         # Refresh the remote node's details in the local node's k-buckets
         self._node.addContact(remoteContact)
+        self._updatePeerCapabilities(address, message.capabilities)
 
-        if isinstance(message, msgtypes.RequestMessage):
-            # This is an RPC method request
-            self._handleRPC(remoteContact, message.id, message.request, message.args)
-        elif isinstance(message, msgtypes.ResponseMessage):
-            # Find the message that triggered this response
-            if self._sentMessages.has_key(message.id):
-                # Cancel timeout timer for this RPC
-                df, timeoutCall = self._sentMessages[message.id][1:3]
-                timeoutCall.cancel()
-                del self._sentMessages[message.id]
-
-                if hasattr(df, '_rpcRawResponse'):
-                    # The RPC requested that the raw response message and originating address be returned; do not interpret it
-                    df.callback((message, address))
-                elif isinstance(message, msgtypes.ErrorMessage):
-                    # The RPC request raised a remote exception; raise it locally
-                    if message.exceptionType.startswith('exceptions.'):
-                        exceptionClassName = message.exceptionType[11:]
-                    else:
-                        localModuleHierarchy = self.__module__.split('.')
-                        remoteHierarchy = message.exceptionType.split('.')
-                        #strip the remote hierarchy
-                        while remoteHierarchy[0] == localModuleHierarchy[0]:
-                            remoteHierarchy.pop(0)
-                            localModuleHierarchy.pop(0)
-                        exceptionClassName = '.'.join(remoteHierarchy)
-                    remoteException = None
-                    try:
-                        exec 'remoteException = %s("%s")' % (exceptionClassName, message.response)
-                    except Exception:
-                        # We could not recreate the exception; create a generic one
-                        remoteException = Exception(message.response)
-                    df.errback(remoteException)
+        if isinstance(message, msgtypes.MultiMessage):
+            messages = message.messages
+        else:
+            messages = (message,)
+        for message in messages:
+            if isinstance(message, msgtypes.RequestMessage):
+                # This is an RPC method request
+                self._handleRPC(remoteContact, message.id, message.request, message.args)
+            elif isinstance(message, msgtypes.ResponseMessage):
+                self._handleResponse(message, address, reassembled)
+
+    def _handleResponse(self, message, address, reassembled=False):
+        """ Passes a received RPC response (or error) to the deferred of the
+        RPC that triggered it """
+        # Find the message that triggered this response
+        if self._sentMessages.has_key(message.id):
+            # Cancel timeout timer for this RPC
+            remoteContactID, df, timeoutCall, sentTime = self._sentMessages[message.id]
+            timeoutCall.cancel()
+            del self._sentMessages[message.id]
+            if not reassembled:
+                # Only single-datagram responses reflect the actual round-trip
+                # time; this is recorded for the contact the RPC was sent to
+                # (as are timeouts), not the node ID claimed by the response
+                self._rttEstimator(remoteContactID).update(time.time() - sentTime)
+            # The remote node evidently received the complete request
+            self._sentFragments.discard(message.id)
+
+            if hasattr(df, '_rpcRawResponse'):
+                # The RPC requested that the raw response message and originating address be returned; do not interpret it
+                df.callback((message, address))
+            elif isinstance(message, msgtypes.ErrorMessage):
+                # The RPC request raised a remote exception; raise it locally
+                if message.exceptionType.startswith('exceptions.'):
+                    exceptionClassName = message.exceptionType[11:]
                 else:
-                    # We got a result from the RPC
-                    df.callback(message.response)
+                    localModuleHierarchy = self.__module__.split('.')
+                    remoteHierarchy = message.exceptionType.split('.')
+                    #strip the remote hierarchy
+                    while remoteHierarchy[0] == localModuleHierarchy[0]:
+                        remoteHierarchy.pop(0)
+                        localModuleHierarchy.pop(0)
+                    exceptionClassName = '.'.join(remoteHierarchy)
+                remoteException = None
+                try:
+                    exec 'remoteException = %s("%s")' % (exceptionClassName, message.response)
+                except Exception:
+                    # We could not recreate the exception; create a generic one
+                    remoteException = Exception(message.response)
+                df.errback(remoteException)
             else:
-                # If the original message isn't found, it must have timed out
-                #TODO: we should probably do something with this...
-                pass
+                # We got a result from the RPC
+                df.callback(message.response)
+        else:
+            # If the original message isn't found, it must have timed out
+            #TODO: we should probably do something with this...
+            pass
+
+    def _sendMessage(self, message, address):
+        """ Encode and transmit an RPC message (request or response)
+
+        If the remote node supports multi-call messages, messages sent to it
+        within C{constants.rpcBatchWindow} seconds of each other are coalesced:
+        the first message is transmitted immediately, and the ones following
+        it are held back and transmitted together when the window closes.
+        """
+        if constants.rpcBatchWindow > 0 and self._peerSupports(address, self.capabilityMultiCall):
+            if address in self._pendingBatches:
+                self._pendingBatches[address].append(message)
+                return
+            self._pendingBatches[address] = []
+            if self._batchCall == None:
+                self._batchCall = reactor.callLater(constants.rpcBatchWindow, self._flushBatches) #IGNORE:E1101
+        self._transmit(message, address)
+
+    def _transmit(self, message, address):
+        """ Encode and transmit a single RPC message immediately """
+        message.capabilities = self.capabilities
+        msgPrimitive = self._translatorFor(address).toPrimitive(message)
+        encodedMsg = self._encoderFor(address).encode(msgPrimitive)
+        self._send(encodedMsg, message.id, address)
+        self._setRPCTimeouts(message)
+
+    def _setRPCTimeouts(self, message):
+        """ Set the timeout timers of the RPC requests contained in the
+        specified message, which has just been queued for transmission
+
+        The timeouts are extended by the time it takes to transmit the send
+        queue's backlog (including the message itself), so that requests do
+        not time out while they are still being sent, e.g. because they are
+        large, or the queue is busy.
+        """
+        if isinstance(message, msgtypes.MultiMessage):
+            messages = message.messages
+        else:
+            messages = (message,)
+        drainTime = None
+        for message in messages:
+            if isinstance(message, msgtypes.RequestMessage) and message.id in self._sentMessages:
+                remoteContactID, df, timeoutCall, sentTime = self._sentMessages[message.id]
+                if timeoutCall == None:
+                    if drainTime == None:
+                        drainTime = self._sendQueue.drainTime()
+                    timeoutCall = self.callLater(self.rpcTimeout(remoteContactID) + drainTime, self._msgTimeout, message.id)
+                    self._sentMessages[message.id] = (remoteContactID, df, timeoutCall, sentTime)
+
+    def _encoderFor(self, address):
+        """ Returns the encoding used for messages sent to the specified address """
+        if self._peerSupports(address, self.capabilityCompactEncoding):
+            return self._compactEncoder
+        return self._encoder
+
+    def _translatorFor(self, address):
+        """ Returns the message format used for messages sent to the specified address """
+        if self._peerSupports(address, self.capabilityListFormat):
+            return self._translator
+        return self._dictTranslator
+
+    def _flushBatches(self):
+        """ Transmit all messages held back for coalescing """
+        self._batchCall = None
+        batches = self._pendingBatches
+        self._pendingBatches = {}
+        for address, messages in batches.iteritems():
+            self._sendBatch(messages, address)
+
+    def _sendBatch(self, messages, address):
+        """ Transmit the specified messages as multi-call messages, each of
+        which fits into a single datagram """
+        encoder = self._encoderFor(address)
+        translator = self._translatorFor(address)
+        emptyBatch = msgtypes.MultiMessage(self._node.id, [])
+        emptyBatch.capabilities = self.capabilities
+        sizeLimit = self.msgSizeLimit - len(encoder.encode(translator.toPrimitive(emptyBatch)))
+        batch = []
+        batchSize = 0
+        for message in messages:
+            # This slightly overestimates the size of the message within the
+            # multi-call message, since the node ID is not repeated there
+            message.capabilities = 0
+            size = len(encoder.encode(translator.toPrimitive(message)))
+            if batchSize + size > sizeLimit and len(batch) > 0:
+                self._transmitBatch(batch, address)
+                batch = []
+                batchSize = 0
+            batch.append(message)
+            batchSize += size
+        self._transmitBatch(batch, address)
+
+    def _transmitBatch(self, messages, address):
+        if len(messages) == 1:
+            self._transmit(messages[0], address)
+        else:
+            self._transmit(msgtypes.MultiMessage(self._node.id, messages), address)
+
+    def _peerSupports(self, address, capability):
+        """ Returns whether both this node and the node at the specified
+        address support the specified optional protocol feature """
+        return (self.capabilities & self._peerCapabilities.get(address, 0) & capability) != 0
+
+    def _updatePeerCapabilities(self, address, capabilities):
+        """ Record the capabilities advertised by the node at the specified
+        address """
+        if address not in self._peerCapabilities and len(self._peerCapabilities) >= constants.peerCapabilitiesCacheSize:
+            # Forget about an arbitrary node to keep memory usage bounded
+            self._peerCapabilities.popitem()
+        self._peerCapabilities[address] = capabilities
 
     def _send(self, data, rpcID, address):
         """ Transmit the specified data over UDP, breaking it up into several
@@ -170,6 +552,11 @@ class KademliaProtocol(protocol.DatagramProtocol):
             | (1 byte)  | (2 bytes)  |  (2 bytes)    |(20 bytes)| (1 byte) |
             |           |     |      |      |        ||||||||||||          |
         
+        The transmission type ID of these packets is C{0x00}. The sent packets
+        are retained for a while; if the receiver detects that some of them
+        were lost, it can request their retransmission by sending a packet
+        with transmission type ID C{0x01} - see C{_requestRetransmission()}.
+        
         @note: The header used for breaking up large data segments will
                possibly be moved out of the KademliaProtocol class in the
                future, into something similar to a message translator/encoder
@@ -184,50 +571,92 @@ class KademliaProtocol(protocol.DatagramProtocol):
             encTotalPackets = chr(totalPackets >> 8) + chr(totalPackets & 0xff)
             seqNumber = 0
             startPos = 0
+            fragments = []
             while seqNumber < totalPackets:
                 #reactor.iterate() #IGNORE:E1101
                 packetData = data[startPos:startPos+self.msgSizeLimit]
                 encSeqNumber = chr(seqNumber >> 8) + chr(seqNumber & 0xff)
                 txData = '\x00%s%s%s\x00%s' % (encTotalPackets, encSeqNumber, rpcID, packetData)
+                fragments.append(txData)
                 self._sendNext(txData, address)
 
                 startPos += self.msgSizeLimit
                 seqNumber += 1
+            self._sentFragments.put(rpcID, address, fragments)
         else:
             self._sendNext(data, address)
 
+    def _requestRetransmission(self, msgID, partialMsg):
+        """ Ask the sender of an incompletely received multi-datagram message
+        to retransmit its missing fragments
+
+        The request is sent as a single UDP datagram with the following
+        structure::
+            |           |     |      |      |        ||||||||||||   0x00   |        |
+            |Transmision|Total number| Number of     | RPC ID   |Header end|Sequence|
+            | type ID   | of packets | missing pkts  |          | indicator|numbers |
+            | (1 byte)  | (2 bytes)  |  (2 bytes)    |(20 bytes)| (1 byte) |(2 bytes|
+            |   0x01    |     |      |      |        ||||||||||||          | each)  |
+
+        Since the sender's address may be spoofed, missing fragments are
+        only requested for responses to this node's pending RPCs, and for
+        other messages of which at least half of the fragments have arrived;
+        and all requests for a message together are at most as large as the
+        data received for it.
+
+        @type partialMsg: entangled.kademlia.fragmentation.PartialMessage
+        """
+        if partialMsg.address == None:
+            return
+        if msgID not in self._sentMessages and 2 * partialMsg.received < partialMsg.totalPackets:
+            return
+        maxMissing = min(self.msgSizeLimit/2, partialMsg.dataSize / (2 * constants.fragmentRetransmitRequests))
+        if maxMissing == 0:
+            return
+        missing = partialMsg.missing(maxMissing)
+        totalPackets = partialMsg.totalPackets
+        header = '\x01%s%s%s\x00' % (struct.pack('>H', totalPackets), struct.pack('>H', len(missing)), msgID)
+        self._sendNext(header + struct.pack('>%dH' % len(missing), *missing), partialMsg.address)
+        partialMsg.retransmitRequests += 1
+        partialMsg.lastRetransmitRequest = time.time()
+
     def _sendNext(self, txData, address):
-        """ Send the next UDP packet """
-        ts = time.time()
-        delay = 0
-        if ts >= self._next:
-            delay = self.minToSendDelay
-            self._next = ts + self.minToSendDelay
-        else:
-            delay = (self._next-ts) + self.maxToSendDelay
-            self._next += self.maxToSendDelay
-        if self.transport:
-            laterCall = reactor.callLater(delay, self.transport.write, txData, address)
-            for key in self._callLaterList.keys():
-                if key <= ts:
-                    del self._callLaterList[key]
-            self._callLaterList[self._next] = laterCall
+        """ Queue the next UDP packet for transmission """
+        if not self.transport:
+            return
+        if self._sendQueue.put(txData, address) and self._sendQueueCall == None:
+            self._drainSendQueue()
+
+    def _drainSendQueue(self):
+        """ Transmit as many queued UDP packets as the send rate allows, and
+        schedule the next transmission (if any packets remain) """
+        self._sendQueueCall = None
+        if not self.transport:
+            self._sendQueue.clear()
+            return
+        packet = self._sendQueue.pop()
+        while packet != None:
+            try:
+                self.transport.write(*packet)
+            except Exception:
+                # An undeliverable packet is treated as if it was lost in transit
+                pass
+            packet = self._sendQueue.pop()
+        delay = self._sendQueue.delay()
+        if delay != None:
+            self._sendQueueCall = reactor.callLater(delay, self._drainSendQueue) #IGNORE:E1101
 
     def _sendResponse(self, contact, rpcID, response):
         """ Send a RPC response to the specified contact
         """
         msg = msgtypes.ResponseMessage(rpcID, self._node.id, response)
-        msgPrimitive = self._translator.toPrimitive(msg)
-        encodedMsg = self._encoder.encode(msgPrimitive)
-        self._send(encodedMsg, rpcID, (contact.address, contact.port))
+        self._sendMessage(msg, (contact.address, contact.port))
 
     def _sendError(self, contact, rpcID, exceptionType, exceptionMessage):
         """ Send an RPC error message to the specified contact
         """
         msg = msgtypes.ErrorMessage(rpcID, self._node.id, exceptionType, exceptionMessage)
-        msgPrimitive = self._translator.toPrimitive(msg)
-        encodedMsg = self._encoder.encode(msgPrimitive)
-        self._send(encodedMsg, rpcID, (contact.address, contact.port))
+        self._sendMessage(msg, (contact.address, contact.port))
 
     def _handleRPC(self, senderContact, rpcID, method, args):
         """ Executes a local function in response to an RPC request """
@@ -238,49 +667,86 @@ class KademliaProtocol(protocol.DatagramProtocol):
         def handleResult(result):
             self._sendResponse(senderContact, rpcID, result)
 
-        df = defer.Deferred()
-        df.addCallback(handleResult)
-        df.addErrback(handleError)
-
         # Execute the RPC
-        func = getattr(self._node, method, None)
-        if callable(func) and hasattr(func, 'rpcmethod'):
-            # Call the exposed Node method and return the result to the deferred callback chain
-            try:
-                try:
-                    # Try to pass the sender's node id to the function...
-                    result = func(*args, **{'_rpcNodeID': senderContact.id, '_rpcNodeContact': senderContact})
-                except TypeError:
-                    # ...or simply call it if that fails
-                    result = func(*args)
-            except Exception, e:
-                df.errback(failure.Failure(e))
+        if self._dispatchTable == None:
+            # Built when the first RPC arrives, once the node is fully set up
+            self._dispatchTable = _rpcDispatchTable(self._node)
+        if method in self._dispatchTable:
+            func, senderArgs, threaded = self._dispatchTable[method]
+            kwargs = {}
+            if len(senderArgs) > 0:
+                # Pass information about the sender to methods accepting it
+                senderInfo = {'_rpcNodeID': senderContact.id, '_rpcNodeContact': senderContact}
+                for arg in senderArgs:
+                    kwargs[arg] = senderInfo[arg]
+            # Call the exposed Node method and return the result (which may
+            # be a deferred) to the deferred callback chain
+            if threaded and constants.rpcThreadPoolSize > 0 and getattr(self._node, 'threadedRPCs', False):
+                df = self.callInThreadPool(func, *args, **kwargs)
             else:
-                df.callback(result)
+                df = defer.maybeDeferred(func, *args, **kwargs)
         else:
             # No such exposed method
-            df.errback( failure.Failure( AttributeError('Invalid method: %s' % method) ) )
+            df = defer.fail( failure.Failure( AttributeError('Invalid method: %s' % method) ) )
+        df.addCallback(handleResult)
+        df.addErrback(handleError)
+
+    def callInThreadPool(self, func, *args, **kwargs):
+        """ Calls the specified (blocking) function in the pool of worker
+        threads used for RPC methods marked with C{rpcthreaded}
+
+        The function must not wait for the reactor thread; the worker threads
+        are joined when the protocol is stopped.
+
+        @return: A deferred firing with the function's result
+        @rtype: twisted.internet.defer.Deferred
+        """
+        return threads.deferToThreadPool(reactor, self._getThreadPool(), func, *args, **kwargs)
+
+    def _getThreadPool(self):
+        """ Returns the pool of worker threads for executing blocking RPC
+        methods, starting it if necessary """
+        if self._threadPool == None:
+            self._threadPool = threadpool.ThreadPool(0, constants.rpcThreadPoolSize, 'KademliaProtocol')
+            self._threadPool.start()
+            self._threadPoolShutdownID = reactor.addSystemEventTrigger('during', 'shutdown', self._stopThreadPool, True) #IGNORE:E1101
+        return self._threadPool
+
+    def _stopThreadPool(self, reactorShutdown=False):
+        """ Stops the worker threads (if running), waiting for them to finish
+        their current RPC methods """
+        if self._threadPool != None:
+            self._threadPool.stop()
+            self._threadPool = None
+            if not reactorShutdown:
+                reactor.removeSystemEventTrigger(self._threadPoolShutdownID) #IGNORE:E1101
+            self._threadPoolShutdownID = None
 
     def _msgTimeout(self, messageID):
         """ Called when an RPC request message times out """
         # Find the message that timed out
         if self._sentMessages.has_key(messageID):
-            remoteContactID, df = self._sentMessages[messageID][0:2]
-            if self._partialMessages.has_key(messageID):
+            remoteContactID, df, timeoutCall, sentTime = self._sentMessages[messageID]
+            if messageID in self._partialMessages:
                 # We are still receiving this message
                 # See if any progress has been made; if not, kill the message
-                if self._partialMessagesProgress.has_key(messageID):
-                    if len(self._partialMessagesProgress[messageID]) == len(self._partialMessages[messageID]):
-                        # No progress has been made
-                        del self._partialMessagesProgress[messageID]
-                        del self._partialMessages[messageID]
-                        df.errback(failure.Failure(TimeoutError(remoteContactID)))
-                        return
+                progress = self._partialMessages.progress(messageID)
+                if self._partialMessagesProgress.get(messageID) == progress:
+                    # No progress has been made
+                    del self._partialMessagesProgress[messageID]
+                    del self._sentMessages[messageID]
+                    self._partialMessages.discard(messageID)
+                    df.errback(failure.Failure(TimeoutError(remoteContactID)))
+                    return
+                self._partialMessagesProgress[messageID] = progress
                 # Reset the RPC timeout timer
-                timeoutCall = reactor.callLater(constants.rpcTimeout, self._msgTimeout, messageID) #IGNORE:E1101
-                self._sentMessages[messageID] = (remoteContactID, df, timeoutCall)
+                timeoutCall = self.callLater(constants.rpcTimeout, self._msgTimeout, messageID)
+                self._sentMessages[messageID] = (remoteContactID, df, timeoutCall, sentTime)
                 return
             del self._sentMessages[messageID]
+            if messageID in self._partialMessagesProgress:
+                del self._partialMessagesProgress[messageID]
+            self._rttEstimator(remoteContactID).timedOut()
             # The message's destination node is now considered to be dead;
             # raise an (asynchronous) TimeoutError exception and update the host node
             self._node.removeContact(remoteContactID)
@@ -289,17 +755,77 @@ class KademliaProtocol(protocol.DatagramProtocol):
             # This should never be reached
             print "ERROR: deferred timed out, but is not present in sent messages list!"
 
+    def callLater(self, delay, func, *args):
+        """ Schedule a (timeout) call in the protocol's timer wheel
+
+        The wheel has a resolution of C{constants.rpcTimeoutResolution}
+        seconds; its pending calls are not made once the protocol is stopped.
+
+        @return: An object which can be used to cancel the call
+        @rtype: entangled.kademlia.timerwheel.Timer
+        """
+        timer = self._timeouts.callLater(delay, func, *args)
+        if self._timeoutsCall == None:
+            self._timeoutsCall = reactor.callLater(self._timeouts.resolution, self._expireTimeouts) #IGNORE:E1101
+        return timer
+
+    def _expireTimeouts(self):
+        """ Periodic tick making all due calls in the timer wheel """
+        self._timeoutsCall = None
+        self._timeouts.expire()
+        if len(self._timeouts) > 0 and self._timeoutsCall == None:
+            self._timeoutsCall = reactor.callLater(self._timeouts.resolution, self._expireTimeouts) #IGNORE:E1101
+
+    def _rttEstimator(self, contactID):
+        """ Returns the round-trip time statistics for the specified contact,
+        creating them if necessary """
+        if contactID not in self._rttEstimators:
+            if len(self._rttEstimators) >= constants.rttCacheSize:
+                # Forget about an arbitrary node to keep memory usage bounded
+                self._rttEstimators.popitem()
+            self._rttEstimators[contactID] = rtt.RTTEstimator()
+        return self._rttEstimators[contactID]
+
+    def _schedulePartialMessagesCheck(self):
+        """ Make sure incomplete multi-datagram messages get checked for
+        stalled transfers, and discarded once their deadlines pass, even if no
+        further datagrams arrive """
+        if self._reassemblyCall == None:
+            deadline = self._partialMessages.nextDeadline()
+            if deadline != None:
+                delay = min(deadline - time.time(), constants.fragmentRetransmitDelay)
+                self._reassemblyCall = reactor.callLater(max(0, delay), self._checkPartialMessages) #IGNORE:E1101
+
+    def _checkPartialMessages(self):
+        """ Discard incomplete multi-datagram messages that have timed out,
+        and request the missing fragments of those that have stalled """
+        self._reassemblyCall = None
+        now = time.time()
+        self._partialMessages.expire(now)
+        retryTime = now - constants.fragmentRetransmitDelay
+        for msgID, partialMsg in self._partialMessages.stalledMessages(retryTime):
+            if partialMsg.retransmitRequests < constants.fragmentRetransmitRequests \
+                    and partialMsg.lastRetransmitRequest <= retryTime:
+                self._requestRetransmission(msgID, partialMsg)
+        self._schedulePartialMessagesCheck()
+
     def stopProtocol(self):
         """ Called when the transport is disconnected.
         
         Will only be called once, after all ports are disconnected.
         """
-        for key in self._callLaterList.keys():
-            try:
-                if key > time.time():
-                    self._callLaterList[key].cancel()
-            except Exception, e:
-                print e
-            del self._callLaterList[key]
-            #TODO: test: do we really need the reactor.iterate() call?
-            reactor.iterate()
+        if self._sendQueueCall != None:
+            self._sendQueueCall.cancel()
+            self._sendQueueCall = None
+        self._sendQueue.clear()
+        if self._reassemblyCall != None:
+            self._reassemblyCall.cancel()
+            self._reassemblyCall = None
+        if self._timeoutsCall != None:
+            self._timeoutsCall.cancel()
+            self._timeoutsCall = None
+        if self._batchCall != None:
+            self._batchCall.cancel()
+            self._batchCall = None
+        self._pendingBatches.clear()
+        self._stopThreadPool()
@@ -5,12 +5,28 @@
 # The docstrings in this module contain epytext markup; API documentation
 # may be created by processing this file with epydoc: http://epydoc.sf.net
 
-import time, random
+import time, random, bisect
 
 import constants
 import kbucket
 from protocol import TimeoutError
 
+def keyValue(key):
+    """ Returns the integer value of the specified key (or node ID)
+    
+    Convert keys once and then pass their values around (instead of
+    repeatedly converting them), if they are used in many distance
+    calculations; C{Contact} objects provide their ID's value as C{idValue}.
+    
+    @param key: The key, or its integer value (which is returned as-is)
+    @type key: str, int or long
+    
+    @rtype: long
+    """
+    if isinstance(key, str):
+        return long(key.encode('hex'), 16)
+    return key
+
 class RoutingTable(object):
     """ Interface for RPC message translators/formatters
     
@@ -32,14 +48,25 @@ class RoutingTable(object):
         """
     
     def distance(self, keyOne, keyTwo):
-        """ Calculate the XOR result between two string variables
+        """ Calculate the XOR result between two string variables (or their
+        integer values; see C{keyValue()})
         
         @return: XOR result of two long variables
         @rtype: long
         """
-        valKeyOne = long(keyOne.encode('hex'), 16)
-        valKeyTwo = long(keyTwo.encode('hex'), 16)
-        return valKeyOne ^ valKeyTwo
+        return keyValue(keyOne) ^ keyValue(keyTwo)
+
+    def sortByDistance(self, contacts, key):
+        """ Sort the specified list of contacts by their distance to the
+        specified key, closest first
+        
+        @param contacts: The list of contacts to sort (in place)
+        @type contacts: list
+        @param key: The key, or its integer value (see C{keyValue()})
+        @type key: str, int or long
+        """
+        valKey = keyValue(key)
+        contacts.sort(key=lambda contact: contact.idValue ^ valKey)
 
     def findCloseNodes(self, key, count, _rpcNodeID=None):
         """ Finds a number of known nodes closest to the node/value with the
@@ -127,7 +154,19 @@ class TreeRoutingTable(RoutingTable):
         """
         # Create the initial (single) k-bucket covering the range of the entire 160-bit ID space
         self._buckets = [kbucket.KBucket(rangeMin=0, rangeMax=2**160)]
+        # The lower range boundaries of the k-buckets, in the same (ascending)
+        # order; used to find a key's k-bucket by binary search
+        self._bucketRangeMins = [0]
         self._parentNodeID = parentNodeID
+        self._parentNodeValue = keyValue(parentNodeID)
+        #: Incremented whenever contacts are added to or removed from the
+        #: routing table (or their addresses change), but not when known
+        #: contacts are merely refreshed; results derived from the routing
+        #: table's contents remain valid while this stays the same
+        self.generation = 0
+        # The node IDs of the head contacts being pinged to see if they can
+        # be evicted, by k-bucket; see _probeHeadContact()
+        self._evictionProbes = {}
 
     def addContact(self, contact):
         """ Add the given contact to the correct k-bucket; if it already
@@ -139,7 +178,8 @@ class TreeRoutingTable(RoutingTable):
         if contact.id == self._parentNodeID:
             return
 
-        bucketIndex = self._kbucketIndex(contact.id)
+        bucketIndex = self._kbucketIndex(contact.idValue)
+        changed = self._contactChanged(bucketIndex, contact)
         try:
             self._buckets[bucketIndex].addContact(contact)
         except kbucket.BucketFull:
@@ -156,32 +196,17 @@ class TreeRoutingTable(RoutingTable):
                 # it states that the head contact in the k-bucket (i.e. the least-recently seen node)
                 # should be pinged - if it does not reply, it should be dropped, and the new contact
                 # added to the tail of the k-bucket. This implementation follows section 2.2 regarding
-                # this point.            
-                headContact = self._buckets[bucketIndex]._contacts[0]
-    
-                def replaceContact(failure):
-                    """ Callback for the deferred PING RPC to see if the head
-                    node in the k-bucket is still responding
-                    
-                    @type failure: twisted.python.failure.Failure
-                    """
-                    failure.trap(TimeoutError)
-                    print '==replacing contact=='
-                    # Remove the old contact...
-                    deadContactID = failure.getErrorMessage()
-                    try:
-                        self._buckets[bucketIndex].removeContact(deadContactID)
-                    except ValueError:
-                        # The contact has already been removed (probably due to a timeout)
-                        pass
-                    # ...and add the new one at the tail of the bucket
-                    self.addContact(contact)
-                
-                # Ping the least-recently seen contact in this k-bucket
-                headContact = self._buckets[bucketIndex]._contacts[0]
-                df = headContact.ping()
-                # If there's an error (i.e. timeout), remove the head contact, and append the new one
-                df.addErrback(replaceContact)
+                # this point.
+                # New contacts wait in the k-bucket's replacement cache while
+                # its head contact is pinged; no matter how many arrive, only
+                # one PING is outstanding per k-bucket
+                bucket = self._buckets[bucketIndex]
+                bucket.addReplacement(contact)
+                if bucket not in self._evictionProbes:
+                    self._probeHeadContact(bucket)
+        else:
+            if changed:
+                self.generation += 1
                 
     def findCloseNodes(self, key, count, _rpcNodeID=None):
         """ Finds a number of known nodes closest to the node/value with the
@@ -197,32 +222,21 @@ class TreeRoutingTable(RoutingTable):
         @type _rpcNodeID: str
         
         @return: A list of node contacts (C{kademlia.contact.Contact instances})
-                 closest to the specified key. 
-                 This method will return C{k} (or C{count}, if specified)
-                 contacts if at all possible; it will only return fewer if the
-                 node is returning all of the contacts that it knows of.
+                 closest to the specified key (in terms of XOR distance),
+                 sorted by their distance to it, closest first.
+                 This method will return C{count} contacts if at all
+                 possible; it will only return fewer if the node is returning
+                 all of the contacts that it knows of.
         @rtype: list
         """
-        #if key == self.id:
-        #    bucketIndex = 0 #TODO: maybe not allow this to continue?
-        #else:
-        bucketIndex = self._kbucketIndex(key)
-        closestNodes = self._buckets[bucketIndex].getContacts(constants.k, _rpcNodeID)
-        # This method must return k contacts (even if we have the node with the specified key as node ID), 
-        # unless there is less than k remote nodes in the routing table
-        i = 1
-        canGoLower = bucketIndex-i >= 0
-        canGoHigher = bucketIndex+i < len(self._buckets)
-        # Fill up the node list to k nodes, starting with the closest neighbouring nodes known 
-        while len(closestNodes) < constants.k and (canGoLower or canGoHigher):
-            #TODO: this may need to be optimized
-            if canGoLower:
-                closestNodes.extend(self._buckets[bucketIndex-i].getContacts(constants.k - len(closestNodes), _rpcNodeID))
-                canGoLower = bucketIndex-(i+1) >= 0
-            if canGoHigher:
-                closestNodes.extend(self._buckets[bucketIndex+i].getContacts(constants.k - len(closestNodes), _rpcNodeID))
-                canGoHigher = bucketIndex+(i+1) < len(self._buckets)
-            i += 1
+        valKey = keyValue(key)
+        closestNodes = []
+        for bucketIndex in self._kbucketIndicesByDistance(valKey):
+            contacts = self._buckets[bucketIndex].getContactsUnordered(_rpcNodeID)
+            self.sortByDistance(contacts, valKey)
+            closestNodes.extend(contacts[:count - len(closestNodes)])
+            if len(closestNodes) >= count:
+                break
         return closestNodes
 
     def getContact(self, contactID):
@@ -282,6 +296,7 @@ class TreeRoutingTable(RoutingTable):
         except ValueError:
             #print 'removeContact(): Contact not in routing table'
             return
+        self.generation += 1
 
     def touchKBucket(self, key):
         """ Update the "last accessed" timestamp of the k-bucket which covers
@@ -293,24 +308,109 @@ class TreeRoutingTable(RoutingTable):
         bucketIndex = self._kbucketIndex(key)
         self._buckets[bucketIndex].lastAccessed = int(time.time())
 
+    def _probeHeadContact(self, bucket):
+        """ Ping the head contact (i.e. the least recently seen one) of the
+        specified full k-bucket; if it does not respond, it is replaced by the
+        most recently seen of the k-bucket's waiting contacts (its replacement
+        contacts), and the new head contact is pinged if more are waiting
+
+        @param bucket: The k-bucket
+        @type bucket: kademlia.kbucket.KBucket
+        """
+        headContact = bucket.getHeadContact()
+        self._evictionProbes[bucket] = headContact.id
+
+        def headContactAlive(result):
+            # The waiting contacts stay in the (bounded) replacement cache,
+            # but are not added for now
+            del self._evictionProbes[bucket]
+            return result
+
+        def replaceHeadContact(failure):
+            del self._evictionProbes[bucket]
+            failure.trap(TimeoutError)
+            try:
+                bucket.removeContact(headContact.id)
+                self.generation += 1
+            except ValueError:
+                # The contact has already been removed (probably due to a timeout)
+                pass
+            try:
+                replacement = bucket.popReplacement()
+            except KeyError:
+                return
+            self.addContact(replacement)
+            if len(bucket.getReplacements()) > 0 and len(bucket) >= constants.k and bucket not in self._evictionProbes:
+                self._probeHeadContact(bucket)
+
+        df = headContact.ping()
+        df.addCallback(headContactAlive)
+        df.addErrback(replaceHeadContact)
+
+    def _contactChanged(self, bucketIndex, contact):
+        """ Returns whether adding the specified contact to the specified
+        k-bucket changes the routing table's contents, rather than merely
+        refreshing a known contact """
+        try:
+            knownContact = self._buckets[bucketIndex].getContact(contact.id)
+        except ValueError:
+            return True
+        return knownContact.address != contact.address or knownContact.port != contact.port
+
     def _kbucketIndex(self, key):
         """ Calculate the index of the k-bucket which is responsible for the
         specified key (or ID)
         
         @param key: The key for which to find the appropriate k-bucket index
-        @type key: str
+                    (or its integer value; see C{keyValue()})
+        @type key: str, int or long
         
         @return: The index of the k-bucket responsible for the specified key
         @rtype: int
         """
-        valKey = long(key.encode('hex'), 16)
-        i = 0
-        for bucket in self._buckets:
-            if bucket.keyInRange(valKey):
-                return i
-            else:
-                i += 1
-        return i
+        valKey = keyValue(key)
+        # The k-buckets' ranges are contiguous, so the responsible k-bucket
+        # is the last one starting at or below the key
+        return bisect.bisect_right(self._bucketRangeMins, valKey) - 1
+
+    def _kbucketIndicesByDistance(self, valKey):
+        """ Generates the indices of all k-buckets, ordered by the distance of
+        their contacts to the specified key, closest first
+        
+        K-buckets are only split if they contain the parent node's ID, so
+        apart from that k-bucket, there is one k-bucket for each length of
+        the prefix its IDs share with the parent node's ID; it covers the IDs
+        that share exactly this many leading bits with it. Each k-bucket's
+        range of distances from the key is determined by the bits that differ
+        between the key and the parent node's ID, and these ranges do not
+        overlap. The k-buckets closest to the key are those for prefix lengths
+        at which the key differs from the parent node's ID (in ascending
+        order), followed by the parent node's k-bucket, and the remaining
+        k-buckets (in descending order of prefix length).
+        
+        @param valKey: The key's integer value (see C{keyValue()})
+        @type valKey: long
+        
+        @rtype: generator
+        """
+        parentNodeValue = self._parentNodeValue
+        rangeMins = self._bucketRangeMins
+        parentBucketIndex = bisect.bisect_right(rangeMins, parentNodeValue) - 1
+        parentBucket = self._buckets[parentBucketIndex]
+        # The parent node's k-bucket covers IDs sharing at least this many bits with it
+        splitDepth = 161 - (parentBucket.rangeMax - parentBucket.rangeMin).bit_length()
+        differingBits = valKey ^ parentNodeValue
+        # Visit the differing bits from the most significant one
+        remainingBits = differingBits
+        while remainingBits.bit_length() > 160 - splitDepth:
+            bit = 1L << (remainingBits.bit_length() - 1)
+            remainingBits ^= bit
+            yield bisect.bisect_right(rangeMins, parentNodeValue ^ bit) - 1
+        yield parentBucketIndex
+        for prefixLength in xrange(splitDepth - 1, -1, -1):
+            bit = 1L << (159 - prefixLength)
+            if not differingBits & bit:
+                yield bisect.bisect_right(rangeMins, parentNodeValue ^ bit) - 1
 
     def _randomIDInBucketRange(self, bucketIndex):
         """ Returns a random ID in the specified k-bucket's range
@@ -344,24 +444,26 @@ class TreeRoutingTable(RoutingTable):
         oldBucket.rangeMax = splitPoint
         # Now, add the new bucket into the routing table tree
         self._buckets.insert(oldBucketIndex + 1, newBucket)
+        self._bucketRangeMins.insert(oldBucketIndex + 1, splitPoint)
         # Finally, copy all nodes that belong to the new k-bucket into it...
-        for contact in oldBucket._contacts:
-            if newBucket.keyInRange(contact.id):
+        for contact in oldBucket.getContacts():
+            if newBucket.keyInRange(contact.idValue):
                 newBucket.addContact(contact)
         # ...and remove them from the old bucket
-        for contact in newBucket._contacts:
-            oldBucket.removeContact(contact)
+        for contactID in newBucket._contacts:
+            oldBucket.removeContact(contactID)
+        # Replacement contacts follow the k-bucket covering their node IDs
+        for contact in oldBucket.getReplacements():
+            if newBucket.keyInRange(contact.idValue):
+                oldBucket.removeReplacement(contact.id)
+                newBucket.addReplacement(contact)
+        self.generation += 1
 
 class OptimizedTreeRoutingTable(TreeRoutingTable):
     """ A version of the "tree"-type routing table specified by Kademlia,
     along with contact accounting optimizations specified in section 4.1 of
     of the 13-page version of the Kademlia paper.
     """
-    def __init__(self, parentNodeID):
-        TreeRoutingTable.__init__(self, parentNodeID)
-        # Cache containing nodes eligible to replace stale k-bucket entries
-        self._replacementCache = {}
-        
     def addContact(self, contact):
         """ Add the given contact to the correct k-bucket; if it already
         exists, its status will be updated
@@ -375,7 +477,8 @@ class OptimizedTreeRoutingTable(TreeRoutingTable):
         # Initialize/reset the "successively failed RPC" counter
         contact.failedRPCs = 0
 
-        bucketIndex = self._kbucketIndex(contact.id)
+        bucketIndex = self._kbucketIndex(contact.idValue)
+        changed = self._contactChanged(bucketIndex, contact)
         try:
             self._buckets[bucketIndex].addContact(contact)
         except kbucket.BucketFull:
@@ -390,15 +493,11 @@ class OptimizedTreeRoutingTable(TreeRoutingTable):
                 # of the Kademlia paper (optimized contact accounting without PINGs
                 #- results in much less network traffic, at the expense of some memory)
 
-                # Put the new contact in our replacement cache for the corresponding k-bucket (or update it's position if it exists already)
-                if not self._replacementCache.has_key(bucketIndex):
-                    self._replacementCache[bucketIndex] = []
-                if contact in self._replacementCache[bucketIndex]:
-                    self._replacementCache[bucketIndex].remove(contact)
-                #TODO: Using k to limit the size of the contact replacement cache - maybe define a seperate value for this in constants.py?
-                elif len(self._replacementCache) >= constants.k:
-                    self._replacementCache.pop(0)
-                self._replacementCache[bucketIndex].append(contact)
+                # Put the new contact in the k-bucket's replacement cache (or update its position if it exists already)
+                self._buckets[bucketIndex].addReplacement(contact)
+        else:
+            if changed:
+                self.generation += 1
     
     def removeContact(self, contactID):
         """ Remove the contact with the specified node ID from the routing
@@ -407,16 +506,21 @@ class OptimizedTreeRoutingTable(TreeRoutingTable):
         @param contactID: The node ID of the contact to remove
         @type contactID: str
         """
-        bucketIndex = self._kbucketIndex(contactID)
+        bucket = self._buckets[self._kbucketIndex(contactID)]
         try:
-            contact = self._buckets[bucketIndex].getContact(contactID)
+            contact = bucket.getContact(contactID)
         except ValueError:
-            #print 'removeContact(): Contact not in routing table'
+            # A replacement contact that fails to respond is not worth keeping
+            bucket.removeReplacement(contactID)
             return
         contact.failedRPCs += 1
         if contact.failedRPCs >= 5:        
-            self._buckets[bucketIndex].removeContact(contactID)
-            # Replace this stale contact with one from our replacemnent cache, if we have any
-            if self._replacementCache.has_key(bucketIndex):
-                if len(self._replacementCache[bucketIndex]) > 0:
-                    self._buckets[bucketIndex].addContact( self._replacementCache[bucketIndex].pop() )
+            bucket.removeContact(contactID)
+            self.generation += 1
+            # Replace this stale contact with the most recently seen one from
+            # the k-bucket's replacement cache, if we have any
+            try:
+                replacement = bucket.popReplacement()
+            except KeyError:
+                return
+            bucket.addContact(replacement)
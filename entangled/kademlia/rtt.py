@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+class RTTEstimator(object):
+    """ Round-trip time statistics for a single remote node
+
+    The smoothed round-trip time and its variance are maintained as
+    described in RFC 6298 (the algorithm used by TCP to calculate its
+    retransmission timeout), and are used to derive the RPC timeout for the
+    node.
+    """
+    # Smoothing factors for the round-trip time and its variance
+    alpha = 0.125
+    beta = 0.25
+    # Maximum factor by which the timeout is increased after RPCs time out
+    maxBackoff = 64
+
+    def __init__(self):
+        #: The smoothed round-trip time (in seconds), or C{None} if no
+        #: round-trip time has been measured yet
+        self.srtt = None
+        #: The round-trip time variation (in seconds)
+        self.rttvar = None
+        #: The number of round-trip times measured
+        self.samples = 0
+        self._backoff = 1
+
+    def update(self, rtt):
+        """ Update the statistics with a newly measured round-trip time
+
+        @param rtt: The measured round-trip time, in seconds
+        @type rtt: float
+        """
+        if self.srtt == None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.samples += 1
+        self._backoff = 1
+
+    def timedOut(self):
+        """ Back off (double) the timeout after an RPC to the node timed out """
+        self._backoff = min(self._backoff * 2, self.maxBackoff)
+
+    def timeout(self, minTimeout, maxTimeout):
+        """ Calculate the RPC timeout for the node
+
+        @param minTimeout: The lower bound for the timeout (in seconds)
+        @type minTimeout: float
+        @param maxTimeout: The upper bound for the timeout (in seconds); this
+                           is also used if no round-trip times have been
+                           measured yet
+        @type maxTimeout: float
+
+        @return: The timeout, in seconds
+        @rtype: float
+        """
+        if self.srtt == None:
+            return maxTimeout
+        rto = (self.srtt + 4 * self.rttvar) * self._backoff
+        return max(minTimeout, min(rto, maxTimeout))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+import time
+from collections import deque
+
+class SendQueue(object):
+    """ Bounded FIFO queue of outbound UDP packets, rate-limited by a token
+    bucket
+
+    Two token buckets are maintained: one limiting the number of packets sent
+    per second, and one limiting the number of bytes sent per second. A packet
+    may only leave the queue if both buckets hold enough tokens for it.
+
+    This class performs no scheduling itself; the owner (normally a
+    C{KademliaProtocol}) should call C{pop()} until it returns C{None}, and
+    then use C{delay()} to determine when to try again. This allows an entire
+    queue to be drained using a single timer.
+    """
+    def __init__(self, packetRate, byteRate, maxSize, burstTime=0.05, minBurstBytes=0, clock=time.time):
+        """
+        @param packetRate: The maximum number of packets to send per second
+        @type packetRate: int
+        @param byteRate: The maximum number of bytes to send per second
+        @type byteRate: int
+        @param maxSize: The maximum number of bytes that may be queued;
+                        packets that do not fit into the queue are dropped
+        @type maxSize: int
+        @param burstTime: The time (in seconds) worth of tokens that may
+                          accumulate while the queue is idle; this determines
+                          the size of bursts that may be sent back-to-back
+        @type burstTime: float
+        @param minBurstBytes: The minimum capacity of the byte bucket; this
+                              should be at least the size of the largest
+                              packet that will be queued
+        @type minBurstBytes: int
+        @param clock: Callable returning the current time (in seconds)
+        """
+        self.packetRate = float(packetRate)
+        self.byteRate = float(byteRate)
+        self.maxSize = maxSize
+        self._clock = clock
+        self._maxPacketTokens = max(1.0, self.packetRate * burstTime)
+        self._maxByteTokens = max(float(minBurstBytes), self.byteRate * burstTime)
+        self._packetTokens = self._maxPacketTokens
+        self._byteTokens = self._maxByteTokens
+        self._lastUpdate = clock()
+        self._queue = deque()
+        self._size = 0
+        #: The number of packets that were dropped because the queue was full
+        self.dropped = 0
+
+    def put(self, data, address):
+        """ Add a packet to the tail of the queue
+
+        @param data: The packet data
+        @type data: str
+        @param address: The destination address, as an (IP address, UDP port)
+                        tuple
+        @type address: tuple
+
+        @return: C{True} if the packet was queued, or C{False} if it was
+                 dropped because the queue is full
+        @rtype: bool
+        """
+        if self._size + len(data) > self.maxSize:
+            self.dropped += 1
+            return False
+        self._queue.append((data, address))
+        self._size += len(data)
+        return True
+
+    def pop(self):
+        """ Remove the packet at the head of the queue, if the rate limit
+        allows it to be sent now
+
+        @return: A C{(data, address)} tuple, or C{None} if the queue is empty
+                 or the head packet may not be sent yet
+        @rtype: tuple
+        """
+        if not self._queue:
+            return None
+        self._refill()
+        dataLen = len(self._queue[0][0])
+        if self._packetTokens < 1 or self._byteTokens < dataLen:
+            return None
+        self._packetTokens -= 1
+        self._byteTokens -= dataLen
+        self._size -= dataLen
+        return self._queue.popleft()
+
+    def delay(self):
+        """ Calculate how long the head packet has to wait before it may be
+        sent
+
+        @return: The delay in seconds (C{0} if the packet may be sent
+                 immediately), or C{None} if the queue is empty
+        @rtype: float
+        """
+        if not self._queue:
+            return None
+        self._refill()
+        dataLen = len(self._queue[0][0])
+        packetWait = (1 - self._packetTokens) / self.packetRate
+        byteWait = (dataLen - self._byteTokens) / self.byteRate
+        return max(0, packetWait, byteWait)
+
+    def drainTime(self):
+        """ Estimate how long it will take to transmit all queued packets
+
+        This ignores any accumulated burst capacity, so it errs on the side
+        of overestimating.
+
+        @return: The time in seconds
+        @rtype: float
+        """
+        return max(len(self._queue) / self.packetRate, self._size / self.byteRate)
+
+    def clear(self):
+        """ Discard all queued packets """
+        self._queue.clear()
+        self._size = 0
+
+    def _refill(self):
+        now = self._clock()
+        elapsed = now - self._lastUpdate
+        if elapsed > 0:
+            self._packetTokens = min(self._maxPacketTokens, self._packetTokens + elapsed * self.packetRate)
+            self._byteTokens = min(self._maxByteTokens, self._byteTokens + elapsed * self.byteRate)
+        self._lastUpdate = now
+
+    def __len__(self):
+        return len(self._queue)
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+#
+# The docstrings in this module contain epytext markup; API documentation
+# may be created by processing this file with epydoc: http://epydoc.sf.net
+
+""" Cheap, coarse-grained timers for large numbers of pending RPCs """
+
+import time
+
+from twisted.python import log
+
+class Timer(object):
+    """ A call scheduled in a C{TimerWheel}
+
+    This provides the subset of Twisted's C{IDelayedCall} interface used by
+    this library, so it can be used in place of the object returned by
+    C{reactor.callLater()}.
+    """
+    __slots__ = ('_wheel', '_tick', '_func', '_args', '_kwargs', 'cancelled', 'called')
+
+    def __init__(self, wheel, tick, func, args, kwargs):
+        self._wheel = wheel
+        self._tick = tick
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self.cancelled = False
+        self.called = False
+
+    def cancel(self):
+        """ Unschedule the call """
+        if not self.cancelled and not self.called:
+            self.cancelled = True
+            self._wheel._active -= 1
+
+    def active(self):
+        """ Returns C{True} if the call has not yet been made or cancelled """
+        return not (self.cancelled or self.called)
+
+    def getTime(self):
+        """ Returns the (approximate) time at which the call will be made """
+        return self._tick * self._wheel.resolution
+
+
+class TimerWheel(object):
+    """ Bucketed deadline structure for large numbers of short-lived timers
+
+    Scheduled calls are grouped into buckets of C{resolution} seconds; all
+    due buckets are processed in one batch by C{expire()}, which the owner
+    should call periodically (every C{resolution} seconds) while there are
+    active timers. Scheduling and cancelling calls are O(1) operations, and
+    calls may be made up to C{resolution} seconds later than requested.
+    """
+    def __init__(self, resolution, clock=time.time):
+        """
+        @param resolution: The granularity of the scheduled times, in seconds
+        @type resolution: float
+        @param clock: Callable returning the current time (in seconds)
+        """
+        self.resolution = resolution
+        self._clock = clock
+        self._buckets = {}
+        self._lastTick = int(clock() / resolution)
+        self._active = 0
+
+    def callLater(self, delay, func, *args, **kwargs):
+        """ Schedule a call to be made after the specified delay
+
+        @param delay: The delay, in seconds
+        @type delay: float
+
+        @return: An object which can be used to cancel the call
+        @rtype: entangled.kademlia.timerwheel.Timer
+        """
+        # Round up, so that calls are never made early
+        tick = -int(-(self._clock() + delay) // self.resolution)
+        if tick <= self._lastTick:
+            tick = self._lastTick + 1
+        timer = Timer(self, tick, func, args, kwargs)
+        if tick in self._buckets:
+            self._buckets[tick].append(timer)
+        else:
+            self._buckets[tick] = [timer]
+        self._active += 1
+        return timer
+
+    def expire(self, now=None):
+        """ Make all calls that are due
+
+        @return: The number of calls made
+        @rtype: int
+        """
+        if now == None:
+            now = self._clock()
+        nowTick = int(now / self.resolution)
+        if nowTick - self._lastTick <= len(self._buckets):
+            dueTicks = [tick for tick in xrange(self._lastTick + 1, nowTick + 1) if tick in self._buckets]
+        else:
+            # Sparse wheel; it is cheaper to inspect the buckets directly
+            dueTicks = sorted([tick for tick in self._buckets if tick <= nowTick])
+        self._lastTick = max(self._lastTick, nowTick)
+        calls = 0
+        for tick in dueTicks:
+            for timer in self._buckets.pop(tick):
+                if timer.active():
+                    timer.called = True
+                    self._active -= 1
+                    # Like reactor.callLater(), isolate the calls from each
+                    # other; an exception must not lose the rest of the bucket
+                    try:
+                        timer._func(*timer._args, **timer._kwargs)
+                    except Exception:
+                        log.err(None, 'Exception in timer wheel call')
+                    calls += 1
+        return calls
+
+    def __len__(self):
+        """ Returns the number of active (not yet made or cancelled) calls """
+        return self._active
@@ -239,6 +239,7 @@ class EntangledNode(kademlia.node.Node):
         # Delete our own copy of the data
         if key in self._dataStore:
             del self._dataStore[key]
+            self._responseCache.discard(('findValue', key))
         df = self._iterativeFind(key, rpc='delete')
         return df
 
@@ -257,11 +258,20 @@ class EntangledNode(kademlia.node.Node):
         @rtype: list
         """
         # Delete our own copy of the data (if we have one)...
-        if key in self._dataStore:
-            del self._dataStore[key]
+        result = self._callDataStore(kwargs, self._deleteStoredValue, key)
         # ...and make this RPC propagate through the network (like a FIND_VALUE for a non-existant value)
+        if isinstance(result, defer.Deferred):
+            result.addCallback(lambda result: self.findNode(key, **kwargs))
+            return result
         return self.findNode(key, **kwargs)
 
+    def _deleteStoredValue(self, key):
+        """ The data store access of C{delete()}; this may be executed in a
+        worker thread """
+        if key in self._dataStore:
+            del self._dataStore[key]
+            self._responseCache.discard(('findValue', key))
+
     def _keywordHashesFromString(self, text):
         """ Create hash keys for the keywords contained in the specified text string """
         keywordKeys = []
@@ -104,7 +104,7 @@ class EntangledViewer(gtk.DrawingArea):
         blips = []
         kbucket = {}
         for i in range(len(self.node._routingTable._buckets)):
-            for contact in self.node._routingTable._buckets[i]._contacts:    
+            for contact in self.node._routingTable._buckets[i].getContacts():    
                 blips.append(contact)
                 kbucket[contact.id] = i
         # ...and now circles for all the other nodes
@@ -0,0 +1,687 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+""" Micro-benchmarks for the performance-sensitive parts of Entangled
+
+These are not part of the unit test suite; run them with::
+
+    PYTHONPATH=. python tests/benchmarks.py [name ...]
+
+If no names are given, all benchmarks are run.
+"""
+
+import sys, time, hashlib, random
+
+import twisted.internet.defer
+import twisted.internet.reactor
+import twisted.python.failure
+
+import entangled.kademlia.constants
+import entangled.kademlia.contact
+import entangled.kademlia.encoding
+import entangled.kademlia.idgenerator
+import entangled.kademlia.kbucket
+import entangled.kademlia.msgformat
+import entangled.kademlia.msgtypes
+import entangled.kademlia.node
+import entangled.kademlia.protocol
+import entangled.kademlia.routingtable
+import entangled.kademlia.timerwheel
+
+benchmarks = []
+
+def benchmark(func):
+    """ Decorator registering a benchmark function; the function should
+    return a list of C{(description, value, unit)} tuples """
+    benchmarks.append(func)
+    return func
+
+def timeIt(func, *args):
+    """ Returns the wall-clock time (in seconds) taken by the specified call """
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+class LoopbackTransport(object):
+    """ Fake UDP transport; queues written datagrams for delivery by the
+    C{Loopback} they belong to """
+    def __init__(self, loopback, address):
+        self._loopback = loopback
+        self._address = address
+
+    def write(self, data, address):
+        self._loopback.queue.append((data, self._address, address))
+        self._loopback.datagrams += 1
+
+
+class Loopback(object):
+    """ Connects several Kademlia nodes' protocols without using the network """
+    def __init__(self):
+        self.queue = []
+        self.datagrams = 0
+        self._protocols = {}
+
+    def addNode(self, node):
+        address = ('127.0.0.1', node.port)
+        self._protocols[address] = node._protocol
+        node._protocol.transport = LoopbackTransport(self, address)
+
+    def pump(self):
+        """ Deliver all queued datagrams (including the ones queued while
+        doing this), closing the protocols' multi-call batching windows
+        whenever the network is idle """
+        while len(self.queue) > 0:
+            while len(self.queue) > 0:
+                queue = self.queue
+                self.queue = []
+                for data, srcAddress, dstAddress in queue:
+                    self._protocols[dstAddress].datagramReceived(data, srcAddress)
+            for protocol in self._protocols.values():
+                if getattr(protocol, '_batchCall', None) != None:
+                    protocol._batchCall.cancel()
+                    protocol._flushBatches()
+
+
+def createNodes(count, firstPort=4000):
+    """ Returns a list of nodes connected to the same C{Loopback} """
+    # Don't let outbound traffic shaping dominate the measurements
+    entangled.kademlia.constants.sendRatePackets = 10**9
+    entangled.kademlia.constants.sendRateBytes = 10**12
+    loopback = Loopback()
+    nodes = []
+    for i in range(count):
+        node = entangled.kademlia.node.Node(udpPort=firstPort+i)
+        loopback.addNode(node)
+        nodes.append(node)
+    return loopback, nodes
+
+
+@benchmark
+def timers(count=100000):
+    """ Scheduling and cancelling RPC timeout timers """
+    def reactorTimers():
+        calls = [twisted.internet.reactor.callLater(5, lambda: None) for i in xrange(count)]
+        for call in calls:
+            call.cancel()
+    def wheelTimers():
+        wheel = entangled.kademlia.timerwheel.TimerWheel(entangled.kademlia.constants.rpcTimeoutResolution)
+        calls = [wheel.callLater(5, lambda: None) for i in xrange(count)]
+        for call in calls:
+            call.cancel()
+    return [('reactor.callLater() + cancel()', count / timeIt(reactorTimers), 'timers/s'),
+            ('TimerWheel.callLater() + cancel()', count / timeIt(wheelTimers), 'timers/s')]
+
+@benchmark
+def rpcs(count=20000, outstanding=1000):
+    """ Round trips of findNode RPCs between two nodes, over a loopback transport """
+    loopback, (client, server) = createNodes(2)
+    contact = entangled.kademlia.contact.Contact(server.id, '127.0.0.1', server.port, client._protocol)
+    # Use distinct keys, so that no RPCs are identical
+    keys = [entangled.kademlia.idgenerator.generateID() for i in xrange(outstanding)]
+    def findNode():
+        for i in xrange(count / outstanding):
+            for key in keys:
+                client._protocol.sendRPC(contact, 'findNode', (key,))
+            loopback.pump()
+    duration = timeIt(findNode)
+    client._protocol.stopProtocol()
+    server._protocol.stopProtocol()
+    return [('findNode RPCs (%d outstanding)' % outstanding, count / duration, 'RPCs/s')]
+
+@benchmark
+def messages(count=100000):
+    """ Construction of RPC request messages (including their IDs) """
+    def sha1ID():
+        hash = hashlib.sha1()
+        hash.update(str(random.getrandbits(255)))
+        return hash.digest()
+    def generateIDs(generateID):
+        for i in xrange(count):
+            generateID()
+    def createMessages():
+        for i in xrange(count):
+            entangled.kademlia.msgtypes.RequestMessage('node1', 'ping', ())
+    msg = entangled.kademlia.msgtypes.RequestMessage('node1', 'ping', ())
+    msgSize = sys.getsizeof(msg) + sys.getsizeof(getattr(msg, '__dict__', None))
+    return [('sha1(str(random.getrandbits(255)))', count / timeIt(generateIDs, sha1ID), 'IDs/s'),
+            ('idgenerator.generateID()', count / timeIt(generateIDs, entangled.kademlia.idgenerator.generateID), 'IDs/s'),
+            ('RequestMessage()', count / timeIt(createMessages), 'messages/s'),
+            ('RequestMessage() memory (excluding field values)', msgSize, 'bytes')]
+
+@benchmark
+def requests(count=20000):
+    """ Handling of incoming RPC requests (decoding, dispatch and response) """
+    loopback, (client, server) = createNodes(2)
+    results = []
+    for method, args in (('ping', ()), ('findNode', (client.id,)), ('store', ('key', 'value', client.id, 0))):
+        msg = entangled.kademlia.msgtypes.RequestMessage(client.id, method, args)
+        datagram = client._protocol._encoder.encode(client._protocol._translator.toPrimitive(msg))
+        address = ('127.0.0.1', client.port)
+        def handleRequests():
+            for i in xrange(count):
+                server._protocol.datagramReceived(datagram, address)
+            del loopback.queue[:]
+        results.append(('%s requests' % method, count / timeIt(handleRequests), 'requests/s'))
+    server._protocol.stopProtocol()
+    return results
+
+@benchmark
+def batching(count=20000, burst=50):
+    """ Bursts of store RPCs to the same node (as when republishing data) """
+    results = []
+    batchWindow = entangled.kademlia.constants.rpcBatchWindow
+    for window in (0, batchWindow):
+        entangled.kademlia.constants.rpcBatchWindow = window
+        loopback, (client, server) = createNodes(2)
+        contact = entangled.kademlia.contact.Contact(server.id, '127.0.0.1', server.port, client._protocol)
+        # Let the nodes learn about each other's capabilities
+        client._protocol.sendRPC(contact, 'ping', ())
+        loopback.pump()
+        loopback.datagrams = 0
+        def store():
+            for i in xrange(count / burst):
+                for j in xrange(burst):
+                    client._protocol.sendRPC(contact, 'store', ('key%d' % j, 'value', client.id, 0))
+                loopback.pump()
+        duration = timeIt(store)
+        client._protocol.stopProtocol()
+        server._protocol.stopProtocol()
+        results.append(('rpcBatchWindow=%s: store RPCs' % window, count / duration, 'RPCs/s'))
+        results.append(('rpcBatchWindow=%s: datagrams' % window, loopback.datagrams / float(count), 'per RPC'))
+    entangled.kademlia.constants.rpcBatchWindow = batchWindow
+    return results
+
+@benchmark
+def hotKey(count=20000):
+    """ Handling of incoming findValue requests for the same (popular) key """
+    loopback, (client, server) = createNodes(2)
+    results = []
+    for description, key, value in (('small value', 'key1', 'x' * 100), ('large value', 'key2', range(500))):
+        server.store(key, value, server.id)
+        msg = entangled.kademlia.msgtypes.RequestMessage(client.id, 'findValue', (key,))
+        datagram = client._protocol._encoder.encode(client._protocol._translator.toPrimitive(msg))
+        address = ('127.0.0.1', client.port)
+        def handleRequests():
+            for i in xrange(count):
+                server._protocol.datagramReceived(datagram, address)
+            del loopback.queue[:]
+        results.append(('findValue requests (%s)' % description, count / timeIt(handleRequests), 'requests/s'))
+    server._protocol.stopProtocol()
+    return results
+def deepRoutingTable(parentNodeID=None):
+    """ Returns a routing table (with about 160 k-buckets) and the contacts
+    in it, which share prefixes of every length with the parent node's ID """
+    if parentNodeID == None:
+        parentNodeID = entangled.kademlia.idgenerator.generateID()
+    routingTable = entangled.kademlia.routingtable.OptimizedTreeRoutingTable(parentNodeID)
+    parentValue = long(parentNodeID.encode('hex'), 16)
+    contacts = []
+    for prefixLength in range(160):
+        suffixBits = 159 - prefixLength
+        contactValues = set()
+        for i in range(min(entangled.kademlia.constants.k, 2**suffixBits)):
+            contactValues.add(((parentValue >> suffixBits) ^ 1) << suffixBits | random.randrange(2**suffixBits))
+        for contactValue in contactValues:
+            contactID = ('%040x' % contactValue).decode('hex')
+            contact = entangled.kademlia.contact.Contact(contactID, '127.0.0.1', 4000 + len(contacts), None)
+            routingTable.addContact(contact)
+            contacts.append(contact)
+    return routingTable, contacts
+
+@benchmark
+def routingTable(count=100000):
+    """ Routing table operations, with about 160 k-buckets """
+    table, contacts = deepRoutingTable()
+    contactIDs = [contact.id for contact in contacts]
+    # Received datagrams create new Contact objects; alternate between two
+    # sets of them, so that the added contacts are never the (identical) ones
+    # already in the routing table
+    contactCopies = [[entangled.kademlia.contact.Contact(contact.id, contact.address, contact.port, None) for contact in contacts] for j in range(2)]
+    touchOrder = [random.randrange(len(contacts)) for i in xrange(count)]
+    def addContacts():
+        for i in xrange(count):
+            table.addContact(contactCopies[i % 2][touchOrder[i]])
+    def getContacts():
+        for i in xrange(count):
+            table.getContact(contactIDs[i % len(contactIDs)])
+    def findCloseNodes():
+        for i in xrange(count / 10):
+            table.findCloseNodes(contactIDs[i % len(contactIDs)], entangled.kademlia.constants.k)
+    return [('k-buckets', len(table._buckets), 'buckets'),
+            ('addContact() (known contacts)', count / timeIt(addContacts), 'calls/s'),
+            ('getContact()', count / timeIt(getContacts), 'calls/s'),
+            ('findCloseNodes()', count / 10 / timeIt(findCloseNodes), 'calls/s')]
+
+@benchmark
+def churn(count=2000, candidates=20000):
+    """ Replacing stale contacts from the routing table's replacement caches """
+    table, contacts = deepRoutingTable()
+    generateID = entangled.kademlia.idgenerator.generateID
+    for i in xrange(candidates):
+        table.addContact(entangled.kademlia.contact.Contact(generateID(), '127.0.0.2', 4000 + i, None))
+    def bucketContacts():
+        return sum([len(bucket) for bucket in table._buckets])
+    initialContacts = bucketContacts()
+    replacements = sum([len(bucket.getReplacements()) for bucket in table._buckets])
+    # Contacts in the most distant k-buckets, which are the ones with
+    # replacement candidates
+    staleContacts = []
+    for bucket in table._buckets:
+        if len(bucket.getReplacements()) > 0:
+            staleContacts.extend(bucket.getContacts())
+    random.shuffle(staleContacts)
+    staleContacts = staleContacts[:count]
+    def removeContacts():
+        for contact in staleContacts:
+            # Contacts are removed after 5 consecutive failed RPCs
+            for i in range(5):
+                table.removeContact(contact.id)
+    duration = timeIt(removeContacts)
+    return [('replacement contacts held (%d candidates)' % candidates, replacements, 'contacts'),
+            ('%d stale contacts removed' % len(staleContacts), len(staleContacts) / duration, 'contacts/s'),
+            ('k-bucket occupancy after removals', 100.0 * bucketContacts() / initialContacts, '%')]
+
+class PingingProtocol(object):
+    """ Stand-in for a protocol whose RPCs are answered in batches, by
+    C{respond()}; a fraction of the remote nodes is dead """
+    def __init__(self, table, deadFraction):
+        self.table = table
+        self.deadFraction = deadFraction
+        self.pings = 0
+        self._pending = []
+    def sendRPC(self, contact, method, args, **kwargs):
+        self.pings += 1
+        df = twisted.internet.defer.Deferred()
+        self._pending.append((contact, df))
+        return df
+    def respond(self):
+        while len(self._pending) > 0:
+            pending = self._pending
+            self._pending = []
+            for contact, df in pending:
+                if random.random() < self.deadFraction:
+                    # As done by KademliaProtocol when an RPC times out
+                    self.table.removeContact(contact.id)
+                    df.errback(twisted.python.failure.Failure(entangled.kademlia.protocol.TimeoutError(contact.id)))
+                else:
+                    self.table.addContact(contact)
+                    df.callback('pong')
+
+@benchmark
+def evictionPings(count=20000, window=200):
+    """ PINGs sent to the head contacts of full k-buckets, when new contacts arrive faster than the PINGs are answered """
+    results = []
+    for deadFraction in (0.0, 0.5):
+        random.seed(1)
+        table = entangled.kademlia.routingtable.TreeRoutingTable('\x00' * 20)
+        protocol = PingingProtocol(table, deadFraction)
+        contacts = [entangled.kademlia.contact.Contact(('%040x' % random.getrandbits(160)).decode('hex'), '127.0.0.1', 4000 + i, protocol) for i in xrange(count)]
+        def addContacts():
+            for i in xrange(count):
+                table.addContact(contacts[i])
+                # New contacts arrive during the PINGs' round-trip time
+                if i % window == window - 1:
+                    protocol.respond()
+            protocol.respond()
+        duration = timeIt(addContacts)
+        name = '%d%% dead nodes' % (deadFraction * 100)
+        results.append(('%s: PINGs sent (%d new contacts)' % (name, count), protocol.pings, 'PINGs'))
+        results.append(('%s: addContact()' % name, count / duration, 'calls/s'))
+    random.seed()
+    return results
+
+@benchmark
+def touches(count=100000):
+    """ Refreshing known contacts on the receive path, with about 160 k-buckets """
+    loopback, (node,) = createNodes(1)
+    node._routingTable, contacts = deepRoutingTable(node.id)
+    protocol = node._protocol
+    peers = [(contact.id, contact.address, contact.port) for contact in contacts]
+    touchOrder = [random.randrange(len(peers)) for i in xrange(count)]
+    def touchContacts():
+        for i in xrange(count):
+            contactID, address, port = peers[touchOrder[i]]
+            node.addContact(protocol.contacts.getContact(contactID, address, port))
+    datagrams = []
+    for contactID, address, port in peers:
+        msg = entangled.kademlia.msgtypes.RequestMessage(contactID, 'ping', ())
+        datagrams.append((protocol._encoder.encode(protocol._translator.toPrimitive(msg)), (address, port)))
+    def handleRequests():
+        for i in xrange(count):
+            datagram, address = datagrams[touchOrder[i]]
+            protocol.datagramReceived(datagram, address)
+            if i % 1000 == 999:
+                del loopback.queue[:]
+        del loopback.queue[:]
+    # Replace the routing table's contacts with the protocol's own
+    touchContacts()
+    results = [('addContact() (%d known contacts)' % len(contacts), count / timeIt(touchContacts), 'calls/s'),
+               ('ping requests from known contacts', count / timeIt(handleRequests), 'requests/s')]
+    protocol.stopProtocol()
+    return results
+
+@benchmark
+def kbuckets(count=100000):
+    """ Operations on full k-buckets, for different values of k """
+    results = []
+    k = entangled.kademlia.constants.k
+    for bucketSize in (8, 20):
+        entangled.kademlia.constants.k = bucketSize
+        try:
+            bucket = entangled.kademlia.kbucket.KBucket(0, 2**160)
+            contacts = [entangled.kademlia.contact.Contact(entangled.kademlia.idgenerator.generateID(), '127.0.0.1', 4000 + i, None) for i in range(bucketSize)]
+            for contact in contacts:
+                bucket.addContact(contact)
+            contactIDs = [contact.id for contact in contacts]
+            # Received datagrams create new Contact objects; alternate between
+            # two sets of them, so that the added contacts are never the
+            # (identical) ones already in the k-bucket
+            contactCopies = [[entangled.kademlia.contact.Contact(contact.id, contact.address, contact.port, None) for contact in contacts] for j in range(2)]
+            # Touch contacts in random order (i.e. at random positions in the k-bucket)
+            touchOrder = [random.randrange(bucketSize) for i in xrange(count)]
+            def touchContacts():
+                for i in xrange(count):
+                    bucket.addContact(contactCopies[i % 2][touchOrder[i]])
+            def getContacts():
+                for i in xrange(count):
+                    bucket.getContact(contactIDs[i % bucketSize])
+            def replaceHeadContacts():
+                for i in xrange(count):
+                    bucket.removeContact(bucket.getHeadContact().id)
+                    bucket.addContact(contacts[i % bucketSize])
+            results.append(('k=%d: addContact() (known contacts)' % bucketSize, count / timeIt(touchContacts), 'calls/s'))
+            results.append(('k=%d: getContact()' % bucketSize, count / timeIt(getContacts), 'calls/s'))
+            results.append(('k=%d: replacing the head contact' % bucketSize, count / timeIt(replaceHeadContacts), 'replacements/s'))
+        finally:
+            entangled.kademlia.constants.k = k
+    return results
+
+@benchmark
+def distances(count=2000, shortlistLength=100):
+    """ Sorting an iterative lookup's shortlist by distance to the key """
+    table, contacts = deepRoutingTable()
+    shortlist = random.sample(contacts, shortlistLength)
+    key = entangled.kademlia.idgenerator.generateID()
+    def sortShortlist():
+        for i in xrange(count):
+            table.sortByDistance(list(shortlist), key)
+    def calculateDistances():
+        for i in xrange(count):
+            for contact in shortlist:
+                table.distance(key, contact.id)
+    return [('sortByDistance() (%d contacts)' % shortlistLength, count / timeIt(sortShortlist), 'sorts/s'),
+            ('distance() (str keys)', count * shortlistLength / timeIt(calculateDistances), 'calls/s')]
+
+class SilentProtocol(object):
+    """ Stand-in for a protocol whose RPCs never receive a response """
+    def sendRPC(self, contact, method, args, **kwargs):
+        return twisted.internet.defer.Deferred()
+
+def neighbouringBucketsSelection(table, key, count, excludeID=None):
+    """ Approximate selection of the contacts closest to a key, for
+    comparison: contacts from the key's k-bucket, topped up with those from
+    k-buckets with neighbouring indices """
+    bucketIndex = table._kbucketIndex(key)
+    closestNodes = table._buckets[bucketIndex].getContacts(count, excludeID)
+    i = 1
+    while len(closestNodes) < count and (bucketIndex-i >= 0 or bucketIndex+i < len(table._buckets)):
+        if bucketIndex-i >= 0:
+            closestNodes.extend(table._buckets[bucketIndex-i].getContacts(count - len(closestNodes), excludeID))
+        if bucketIndex+i < len(table._buckets):
+            closestNodes.extend(table._buckets[bucketIndex+i].getContacts(count - len(closestNodes), excludeID))
+        i += 1
+    return closestNodes
+
+def exactSelection(table, key, count, excludeID=None):
+    return table.findCloseNodes(key, count, excludeID)
+
+def simulateLookup(tables, originID, key, selectContacts):
+    """ Simulates an iterative lookup, in rounds of (up to) alpha parallel
+    RPCs, until the k closest contacts found have all been queried
+
+    @return: The number of rounds, the number of RPCs, and the IDs of the k
+             closest contacts found
+    @rtype: tuple
+    """
+    k = entangled.kademlia.constants.k
+    valKey = long(key.encode('hex'), 16)
+    shortlist = dict([(contact.id, contact) for contact in selectContacts(tables[originID], key, k)])
+    queried = set()
+    rounds = rpcs = 0
+    while True:
+        closest = sorted(shortlist.itervalues(), key=lambda contact: contact.idValue ^ valKey)[:k]
+        contactsToQuery = [contact for contact in closest if contact.id not in queried][:entangled.kademlia.constants.alpha]
+        if len(contactsToQuery) == 0:
+            return rounds, rpcs, [contact.id for contact in closest]
+        rounds += 1
+        for contact in contactsToQuery:
+            queried.add(contact.id)
+            rpcs += 1
+            for foundContact in selectContacts(tables[contact.id], key, k, originID):
+                if foundContact.id != originID:
+                    shortlist.setdefault(foundContact.id, foundContact)
+
+@benchmark
+def lookupHops(nodeCount=1000, knownNodes=50, lookups=500):
+    """ Iterative lookups in a simulated network, with exact and approximate selection of the closest contacts """
+    random.seed(1)
+    nodeIDs = [('%040x' % random.getrandbits(160)).decode('hex') for i in range(nodeCount)]
+    # Full k-buckets ping their least-recently seen contacts, which never reply
+    contacts = [entangled.kademlia.contact.Contact(nodeID, '127.0.0.1', 4000, SilentProtocol()) for nodeID in nodeIDs]
+    tables = {}
+    for contact in contacts:
+        # Each node knows its closest neighbours, and a few random other nodes
+        table = entangled.kademlia.routingtable.TreeRoutingTable(contact.id)
+        neighbours = sorted(contacts, key=lambda otherContact: otherContact.idValue ^ contact.idValue)[1:entangled.kademlia.constants.k*2+1]
+        for knownContact in random.sample(contacts, knownNodes) + neighbours:
+            table.addContact(knownContact)
+        tables[contact.id] = table
+    searches = []
+    for i in range(lookups):
+        originID = random.choice(nodeIDs)
+        key = ('%040x' % random.getrandbits(160)).decode('hex')
+        valKey = long(key.encode('hex'), 16)
+        closestIDs = sorted([nodeID for nodeID in nodeIDs if nodeID != originID], key=lambda nodeID: long(nodeID.encode('hex'), 16) ^ valKey)[:entangled.kademlia.constants.k]
+        searches.append((originID, key, closestIDs))
+    results = []
+    for description, selectContacts in (('neighbouring k-buckets', neighbouringBucketsSelection), ('exact', exactSelection)):
+        totalRounds = totalRPCs = exactResults = 0
+        for originID, key, closestIDs in searches:
+            rounds, rpcs, foundIDs = simulateLookup(tables, originID, key, selectContacts)
+            totalRounds += rounds
+            totalRPCs += rpcs
+            if foundIDs == closestIDs:
+                exactResults += 1
+        results.append(('%s: rounds per lookup' % description, float(totalRounds) / lookups, 'rounds'))
+        results.append(('%s: RPCs per lookup' % description, float(totalRPCs) / lookups, 'RPCs'))
+        results.append(('%s: lookups finding the k closest nodes' % description, 100.0 * exactResults / lookups, '%'))
+    return results
+
+def largePayloads():
+    """ Returns a list of C{(description, data)} tuples of large RPC payloads """
+    generateID = entangled.kademlia.idgenerator.generateID
+    return [('10k-entry list of keys', [generateID() for i in xrange(10000)]),
+            ('10k-entry list of contact triples', [(generateID(), '127.0.0.1', 4000+i) for i in xrange(10000)]),
+            ('10k-entry dict', dict([(generateID(), i) for i in xrange(10000)])),
+            ('1MB value', {'key': 'x' * 2**20}),
+            ('1MB message of 1k values', [generateID(), 'findValue', {'key': ['x' * 1000] * 1000}])]
+
+@benchmark
+def encoding(count=10):
+    """ Bencoding large payloads (such as inverted indexes and stored values) """
+    encoder = entangled.kademlia.encoding.Bencode()
+    results = []
+    for description, data in largePayloads():
+        def encode():
+            for i in xrange(count):
+                encoder.encode(data)
+        results.append(('Bencode.encode(): %s' % description, count / timeIt(encode), 'payloads/s'))
+    return results
+
+@benchmark
+def decoding(count=10):
+    """ Decoding large Bencoded payloads (such as reassembled multi-packet messages) """
+    encoder = entangled.kademlia.encoding.Bencode()
+    results = []
+    for description, data in largePayloads():
+        encodedData = encoder.encode(data)
+        def decode():
+            for i in xrange(count):
+                encoder.decode(encodedData)
+        results.append(('Bencode.decode(): %s' % description, count / timeIt(decode), 'payloads/s'))
+    return results
+@benchmark
+def wireEncodings(count=20000):
+    """ Encoding and decoding RPC messages with Bencode and the compact encoding """
+    generateID = entangled.kademlia.idgenerator.generateID
+    translator = entangled.kademlia.msgformat.DefaultFormat()
+    contactTriples = [(generateID(), '192.168.%d.%d' % (i, i), 4000+i) for i in range(entangled.kademlia.constants.k)]
+    messages = (('findNode request', entangled.kademlia.msgtypes.RequestMessage(generateID(), 'findNode', [generateID()])),
+                ('findNode response', entangled.kademlia.msgtypes.ResponseMessage(generateID(), generateID(), contactTriples)),
+                ('store request (1KB value)', entangled.kademlia.msgtypes.RequestMessage(generateID(), 'store', [generateID(), 'x' * 1024, generateID(), 0])))
+    results = []
+    for encoder in (entangled.kademlia.encoding.Bencode(), entangled.kademlia.encoding.CompactEncoding()):
+        name = encoder.__class__.__name__
+        for description, message in messages:
+            msgPrimitive = translator.toPrimitive(message)
+            encodedMsg = encoder.encode(msgPrimitive)
+            def encode():
+                for i in xrange(count):
+                    encoder.encode(msgPrimitive)
+            def decode():
+                for i in xrange(count):
+                    encoder.decode(encodedMsg)
+            results.append(('%s: %s: encode' % (name, description), count / timeIt(encode), 'messages/s'))
+            results.append(('%s: %s: decode' % (name, description), count / timeIt(decode), 'messages/s'))
+            results.append(('%s: %s: size' % (name, description), len(encodedMsg), 'bytes'))
+        for description, data in largePayloads()[:2]:
+            encodedData = encoder.encode(data)
+            def decode():
+                for i in xrange(10):
+                    encoder.decode(encodedData)
+            results.append(('%s: %s: decode' % (name, description), 10 / timeIt(decode), 'payloads/s'))
+    return results
+
+@benchmark
+def lateResponses(count=20000):
+    """ Handling of incoming responses to RPCs that have already timed out """
+    generateID = entangled.kademlia.idgenerator.generateID
+    loopback, (client, server) = createNodes(2)
+    contactTriples = [(generateID(), '192.168.%d.%d' % (i, i), 4000+i) for i in range(entangled.kademlia.constants.k)]
+    responses = (('findNode response', entangled.kademlia.msgtypes.ResponseMessage(generateID(), server.id, contactTriples)),
+                 ('findValue response (100 values)', entangled.kademlia.msgtypes.ResponseMessage(generateID(), server.id, {generateID(): ['x' * 10] * 100})))
+    address = ('127.0.0.1', server.port)
+    results = []
+    for encoder in (client._protocol._encoder, client._protocol._compactEncoder):
+        for description, message in responses:
+            datagram = encoder.encode(client._protocol._translator.toPrimitive(message))
+            def handleResponses():
+                for i in xrange(count):
+                    client._protocol.datagramReceived(datagram, address)
+            results.append(('%s: %s' % (encoder.__class__.__name__, description), count / timeIt(handleResponses), 'responses/s'))
+    client._protocol.stopProtocol()
+    return results
+
+@benchmark
+def contactResponses(count=20000):
+    """ Encoding and parsing findNode responses, with and without packed contact triples """
+    generateID = entangled.kademlia.idgenerator.generateID
+    translator = entangled.kademlia.msgformat.DefaultFormat()
+    contactTriples = [(generateID(), '192.168.%d.%d' % (i, i), 4000+i) for i in range(entangled.kademlia.constants.k)]
+    results = []
+    for encoder in (entangled.kademlia.encoding.Bencode(), entangled.kademlia.encoding.CompactEncoding()):
+        for description, packContacts in (('contact triples', False), ('packed contacts', True)):
+            def encode():
+                for i in xrange(count):
+                    if packContacts:
+                        response = entangled.kademlia.msgformat.encodeContacts(contactTriples)
+                    else:
+                        response = contactTriples
+                    msg = entangled.kademlia.msgtypes.ResponseMessage('r' * 20, 'n' * 20, response)
+                    encoder.encode(translator.toPrimitive(msg))
+            msg = entangled.kademlia.msgtypes.ResponseMessage('r' * 20, 'n' * 20, contactTriples)
+            if packContacts:
+                msg.response = entangled.kademlia.msgformat.encodeContacts(contactTriples)
+            encodedMsg = encoder.encode(translator.toPrimitive(msg))
+            def parse():
+                for i in xrange(count):
+                    translator.fromPrimitive(encoder.decode(encodedMsg))
+            name = '%s: %s' % (encoder.__class__.__name__, description)
+            results.append(('%s: encode' % name, count / timeIt(encode), 'responses/s'))
+            results.append(('%s: parse' % name, count / timeIt(parse), 'responses/s'))
+            results.append(('%s: size' % name, len(encodedMsg), 'bytes'))
+    return results
+
+@benchmark
+def translators(count=20000):
+    """ Translating and encoding RPC messages with the dict- and list-based message formats """
+    generateID = entangled.kademlia.idgenerator.generateID
+    encoder = entangled.kademlia.encoding.Bencode()
+    messages = (('ping request', entangled.kademlia.msgtypes.RequestMessage(generateID(), 'ping', [])),
+                ('findValue response', entangled.kademlia.msgtypes.ResponseMessage(generateID(), generateID(), {generateID(): 'value'})))
+    for description, message in messages:
+        message.capabilities = 7
+    results = []
+    for translator in (entangled.kademlia.msgformat.DefaultFormat(), entangled.kademlia.msgformat.TupleFormat()):
+        for description, message in messages:
+            encodedMsg = encoder.encode(translator.toPrimitive(message))
+            def send():
+                for i in xrange(count):
+                    encoder.encode(translator.toPrimitive(message))
+            def receive():
+                for i in xrange(count):
+                    translator.fromPrimitive(encoder.decode(encodedMsg))
+            name = '%s: %s' % (translator.__class__.__name__, description)
+            results.append(('%s: send' % name, count / timeIt(send), 'messages/s'))
+            results.append(('%s: receive' % name, count / timeIt(receive), 'messages/s'))
+            results.append(('%s: size' % name, len(encodedMsg), 'bytes'))
+    return results
+
+def contactSize(contact):
+    """ Returns the memory used by a contact object itself, in bytes """
+    try:
+        return sys.getsizeof(contact) + sys.getsizeof(object.__getattribute__(contact, '__dict__'))
+    except AttributeError:
+        return sys.getsizeof(contact)
+
+@benchmark
+def contacts(count=100000, peers=200):
+    """ Memory used by contacts, RPC stubs, and handling of requests from known peers """
+    generateID = entangled.kademlia.idgenerator.generateID
+    contacts = [entangled.kademlia.contact.Contact(generateID(), '10.0.%d.%d' % (i / 256 % 256, i % 256), 4000, None) for i in xrange(count)]
+    results = [('memory per contact', sum([contactSize(contact) for contact in contacts]) / float(count), 'bytes')]
+    def getStubs():
+        for contact in contacts:
+            contact.ping
+    results.append(('RPC stub lookups', count / timeIt(getStubs), 'stubs/s'))
+    loopback, (node,) = createNodes(1)
+    protocol = node._protocol
+    datagrams = []
+    for i in range(peers):
+        msg = entangled.kademlia.msgtypes.RequestMessage(generateID(), 'ping', ())
+        datagrams.append((protocol._encoder.encode(protocol._translator.toPrimitive(msg)), ('10.1.%d.%d' % (i / 256, i % 256), 4000)))
+    def handleRequests():
+        for i in xrange(count / peers):
+            for datagram, address in datagrams:
+                protocol.datagramReceived(datagram, address)
+            del loopback.queue[:]
+    handleRequests()
+    results.append(('ping requests from %d peers' % peers, count / timeIt(handleRequests), 'requests/s'))
+    protocol.stopProtocol()
+    return results
+
+
+def runBenchmarks(names):
+    for func in benchmarks:
+        if len(names) > 0 and func.__name__ not in names:
+            continue
+        print '%s: %s' % (func.__name__, func.__doc__.strip())
+        for description, value, unit in func():
+            print '    %-50s %12.1f %s' % (description, value, unit)
+
+if __name__ == '__main__':
+    runBenchmarks(sys.argv[1:])
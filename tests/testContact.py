@@ -4,7 +4,7 @@
 # the GNU Lesser General Public License Version 3, or any later version.
 # See the COPYING file included in this archive
 
-import unittest
+import unittest, gc
 
 import entangled.kademlia.contact
 
@@ -33,9 +33,96 @@ class ContactOperatorsTest(unittest.TestCase):
             self.failIfEqual(self.firstContact, item, '"eq" operator: Contact object should not be equal to %s type' % type(item).__name__)
             self.failUnless(self.firstContact != item, '"ne" operator: Contact object should not be equal to %s type' % type(item).__name__)
 
+    def testHash(self):
+        """ Tests if contacts can be used as dictionary keys, interchangeably with their node IDs """
+        contacts = {self.secondContact: 1}
+        self.failUnless(self.secondContactCopy in contacts)
+        self.failUnless('2ndContactID' in contacts)
+        self.failIf(self.firstContact in contacts)
+        self.failUnless(self.secondContact in {'2ndContactID': 1})
+
+    def testIDValue(self):
+        """ Tests if contacts provide their node ID's integer value """
+        contact = entangled.kademlia.contact.Contact('\x00' * 18 + '\x01\x02', '127.0.0.1', 1000, None)
+        self.failUnlessEqual(contact.idValue, 0x0102)
+        self.failUnlessEqual(self.firstContact.idValue, long('firstContactID'.encode('hex'), 16))
+
+    def testSlots(self):
+        """ Tests if contacts do not have a per-instance attribute dictionary """
+        self.failUnlessRaises(AttributeError, setattr, self.firstContact, 'someAttribute', 1)
+        self.failUnlessEqual(self.firstContact.failedRPCs, 0)
+
+
+class FakeProtocol(object):
+    """ Records the RPCs sent to contacts """
+    def __init__(self):
+        self.rpcs = []
+    def sendRPC(self, contact, method, args, **kwargs):
+        self.rpcs.append((contact, method, args, kwargs))
+        return len(self.rpcs)
+
+class ContactRPCTest(unittest.TestCase):
+    """ Test case for calling RPCs via Contact objects """
+    def setUp(self):
+        self.protocol = FakeProtocol()
+        self.contact = entangled.kademlia.contact.Contact('contactID', '127.0.0.1', 1000, self.protocol)
+
+    def testRPC(self):
+        """ Tests if calling a method of a contact sends the RPC via its protocol """
+        self.failUnlessEqual(self.contact.ping(), 1)
+        self.failUnlessEqual(self.contact.store('key', 'value', rawResponse=True), 2)
+        self.failUnlessEqual(self.protocol.rpcs, [(self.contact, 'ping', (), {}),
+                                                  (self.contact, 'store', ('key', 'value'), {'rawResponse': True})])
+
+    def testStubsShared(self):
+        """ Tests if the RPC stubs are shared between calls and contacts """
+        otherContact = entangled.kademlia.contact.Contact('otherID', '127.0.0.1', 1001, self.protocol)
+        self.failUnless(self.contact.ping.im_func is otherContact.ping.im_func)
+        self.failUnless(self.contact.ping.im_func is self.contact.ping.im_func)
+        self.failIf(self.contact.ping.im_func is self.contact.store.im_func)
+        otherContact.ping()
+        self.failUnless(self.protocol.rpcs[0][0] is otherContact)
+
+
+class ContactRegistryTest(unittest.TestCase):
+    """ Test case for the ContactRegistry class """
+    def setUp(self):
+        self.protocol = FakeProtocol()
+        self.registry = entangled.kademlia.contact.ContactRegistry(self.protocol)
+
+    def testInterning(self):
+        """ Tests if the same contact object is returned for the same node details """
+        contact = self.registry.getContact('contactID', '127.0.0.1', 1000)
+        self.failUnless(isinstance(contact, entangled.kademlia.contact.Contact))
+        self.failUnless(contact._networkProtocol is self.protocol)
+        self.failUnless(self.registry.getContact('contactID', '127.0.0.1', 1000) is contact)
+        self.failIf(self.registry.getContact('otherID', '127.0.0.1', 1000) is contact)
+        self.failUnlessEqual(len(self.registry), 1, 'Unreferenced contacts should not be kept')
+
+    def testAddressChange(self):
+        """ Tests if a node's contact is replaced if its address changes """
+        contact = self.registry.getContact('contactID', '127.0.0.1', 1000)
+        for address, port in (('127.0.0.1', 1001), ('127.0.0.2', 1001)):
+            newContact = self.registry.getContact('contactID', address, port)
+            self.failIf(newContact is contact)
+            self.failUnlessEqual((newContact.address, newContact.port), (address, port))
+            self.failUnless(self.registry.getContact('contactID', address, port) is newContact)
+            contact = newContact
+
+    def testWeakReferences(self):
+        """ Tests if contacts are dropped from the registry once they are no longer used """
+        contacts = [self.registry.getContact('contactID%d' % i, '127.0.0.1', 1000 + i) for i in range(10)]
+        self.failUnlessEqual(len(self.registry), 10)
+        del contacts[5:]
+        gc.collect()
+        self.failUnlessEqual(len(self.registry), 5)
+        self.failUnless(self.registry.getContact('contactID0', '127.0.0.1', 1000) is contacts[0])
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ContactOperatorsTest))
+    suite.addTest(unittest.makeSuite(ContactRPCTest))
+    suite.addTest(unittest.makeSuite(ContactRegistryTest))
     return suite
 
 if __name__ == '__main__':
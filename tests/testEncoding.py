@@ -17,11 +17,21 @@ class BencodeTest(unittest.TestCase):
                       ('spam', '4:spam'),
                       (['spam',42], 'l4:spami42ee'),
                       ({'foo':42, 'bar':'spam'}, 'd3:bar4:spam3:fooi42ee'),
+                      ([{'foo':42}, {'bar':{'spam':1}, 'foo':2}], 'ld3:fooi42eed3:bard4:spami1ee3:fooi2eee'),
                       # ...and now the "real life" tests
-                      ([['abc', '127.0.0.1', 1919], ['def', '127.0.0.1', 1921]], 'll3:abc9:127.0.0.1i1919eel3:def9:127.0.0.1i1921eee'))
+                      ([['abc', '127.0.0.1', 1919], ['def', '127.0.0.1', 1921]], 'll3:abc9:127.0.0.1i1919eel3:def9:127.0.0.1i1921eee'),
+                      ({'key': [None, 2**70, 1.5, '', []]}, 'd3:keylni1180591620717411303424ef1.500000e0:leee'))
         # The following test cases are "bad"; i.e. sending rubbish into the decoder to test what exceptions get thrown
         self.badDecoderCases = ('abcdefghijklmnopqrstuvwxyz',
-                                '')                        
+                                '',
+                                'i42',
+                                'ixe',
+                                '10:spam',
+                                '4spam',
+                                'l4:spam',
+                                'd3:fooe',
+                                'dli1ee3:fooe',
+                                'e')                        
                       
     def testEncoder(self):
         """ Tests the bencode encoder """
@@ -29,6 +39,13 @@ class BencodeTest(unittest.TestCase):
             result = self.encoding.encode(value)
             self.failUnlessEqual(result, encodedValue, 'Value "%s" not correctly encoded! Expected "%s", got "%s"' % (value, encodedValue, result))
         
+    def testEncoderTypes(self):
+        """ Tests the bencode encoder with unsupported and pre-encoded data """
+        for value in (object(), u'unicode', ['spam', set()], {'foo': object()}):
+            self.failUnlessRaises(TypeError, self.encoding.encode, value)
+        rawData = entangled.kademlia.encoding.RawData(self.encoding.encode({'foo': 42}))
+        self.failUnlessEqual(self.encoding.encode(['spam', rawData]), 'l4:spamd3:fooi42eee')
+        
     def testDecoder(self):
         """ Tests the bencode decoder """
         for value, encodedValue in self.cases:
@@ -37,9 +54,106 @@ class BencodeTest(unittest.TestCase):
         for encodedValue in self.badDecoderCases:
             self.failUnlessRaises(entangled.kademlia.encoding.DecodeError, self.encoding.decode, encodedValue)
 
+    def testDecodePrefix(self):
+        """ Tests decoding of the first items of lists and dicts """
+        self.failUnlessEqual(self.encoding.decodePrefix('li1ei2ei3ee', 2), [1, 2])
+        self.failUnlessEqual(self.encoding.decodePrefix('li1ee', 2), [1])
+        self.failUnlessEqual(self.encoding.decodePrefix('di0ei1ei1e4:spami2el', 2), {0: 1, 1: 'spam'})
+        self.failUnlessEqual(self.encoding.decodePrefix('4:spam', 2), 'spam')
+        # The rest of the data is not decoded (nor validated)
+        self.failUnlessEqual(self.encoding.decodePrefix('li1ei2ex', 2), [1, 2])
+        for encodedValue in ('', 'li1e', 'di0ee'):
+            self.failUnlessRaises(entangled.kademlia.encoding.DecodeError, self.encoding.decodePrefix, encodedValue, 2)
+
+    def testDeepNesting(self):
+        """ Tests if deeply nested data can be decoded """
+        depth = 10000
+        value = self.encoding.decode('l' * depth + 'i1e' + 'e' * depth)
+        for i in range(depth):
+            self.failUnlessEqual(len(value), 1)
+            value = value[0]
+        self.failUnlessEqual(value, 1)
+
+    def testLargeData(self):
+        """ Tests decoding of large data """
+        value = {'key': ['x' * 1000] * 1000, 'index': range(10000)}
+        self.failUnlessEqual(self.encoding.decode(self.encoding.encode(value)), value)
+
+class CompactEncodingTest(unittest.TestCase):
+    """ Test case for the compact binary encoding """
+    def setUp(self):
+        self.encoding = entangled.kademlia.encoding.CompactEncoding()
+        self.cases = ((42, '\xce\xaa'),
+                      (1000, '\xce\x01\xd0\x0f'),
+                      (-1, '\xce\x01\x01'),
+                      ('spam', '\xceDspam'),
+                      (['spam', 42], '\xce\x03\x02Dspam\xaa'),
+                      ({'foo': None}, '\xce\x04\x01Cfoo\x06'),
+                      ([], '\xce\x03\x00'),
+                      # Contact triples are packed into 26 bytes
+                      ([['a'*20, '127.0.0.1', 4000]], '\xce\x03\x01\x07' + 'a'*20 + '\x7f\x00\x00\x01\x0f\xa0'))
+        self.badDecoderCases = ('',
+                                'i42e',
+                                '\xce',
+                                '\xce\xff',
+                                '\xce\x02\x05spam',
+                                '\xce\x03\x02\xaa',
+                                '\xce\x04\x01\xaa',
+                                '\xce\x07' + 'a'*20,
+                                '\xce\xaa\xaa')
+
+    def testEncoder(self):
+        """ Tests the compact encoder """
+        for value, encodedValue in self.cases:
+            result = self.encoding.encode(value)
+            self.failUnlessEqual(result, encodedValue, 'Value "%s" not correctly encoded! Expected %r, got %r' % (value, encodedValue, result))
+
+    def testDecoder(self):
+        """ Tests the compact decoder """
+        for value, encodedValue in self.cases:
+            result = self.encoding.decode(encodedValue)
+            self.failUnlessEqual(result, value, 'Value %r not correctly decoded! Expected "%s", got "%s"' % (encodedValue, value, result))
+        for encodedValue in self.badDecoderCases:
+            self.failUnlessRaises(entangled.kademlia.encoding.DecodeError, self.encoding.decode, encodedValue)
+
+    def testDecodePrefix(self):
+        """ Tests decoding of the first items of lists and dicts """
+        self.failUnlessEqual(self.encoding.decodePrefix(self.encoding.encode([1, 2, 3]), 2), [1, 2])
+        self.failUnlessEqual(self.encoding.decodePrefix(self.encoding.encode([1]), 2), [1])
+        self.failUnlessEqual(self.encoding.decodePrefix(self.encoding.encode({0: 1, 1: 'spam', 2: []}), 2), {0: 1, 1: 'spam'})
+        self.failUnlessEqual(self.encoding.decodePrefix(self.encoding.encode('spam'), 2), 'spam')
+        # The rest of the data is not decoded (nor validated)
+        self.failUnlessEqual(self.encoding.decodePrefix(self.encoding.encode([1, 2, 3])[:-1] + '\xff', 2), [1, 2])
+        for encodedValue in ('', '\xce', '\xce\x03\x02\x81'):
+            self.failUnlessRaises(entangled.kademlia.encoding.DecodeError, self.encoding.decodePrefix, encodedValue, 2)
+
+    def testBencodeCompatibility(self):
+        """ Tests if data is decoded identically to Bencoded data """
+        bencode = entangled.kademlia.encoding.Bencode()
+        for value in (0, 63, 64, -64, 2**70, -2**70, 1.5, None, '', 'x' * 63, 'x' * 64, 'x' * 100000,
+                      [1, [2, [3, []]]], ('a', ('b',)), {'a': {}, 1: [None, {}]},
+                      [('a'*20, '127.0.0.1', 4000), ('b'*20, '10.0.0.1', 65535)],
+                      # These cannot be packed as contact triples
+                      [('a'*19, '127.0.0.1', 4000), ('a'*20, '127.1', 4000), ('a'*20, 'localhost', 4000), ('a'*20, '127.0.0.1', 65536)]):
+            self.failUnlessEqual(self.encoding.decode(self.encoding.encode(value)), bencode.decode(bencode.encode(value)))
+        for value in (object(), u'unicode', True):
+            self.failUnlessRaises(TypeError, self.encoding.encode, value)
+
+    def testRawData(self):
+        """ Tests if pre-encoded data is included verbatim, or re-encoded if it uses another encoding """
+        bencode = entangled.kademlia.encoding.Bencode()
+        value = {'foo': [1, 2]}
+        rawData = entangled.kademlia.encoding.RawData(self.encoding.encode(value), self.encoding)
+        self.failUnlessEqual(self.encoding.encode(['spam', rawData]), self.encoding.encode(['spam', value]))
+        self.failUnlessEqual(bencode.encode(['spam', rawData]), bencode.encode(['spam', value]))
+        rawData = entangled.kademlia.encoding.RawData(bencode.encode(value), bencode)
+        self.failUnlessEqual(self.encoding.encode(['spam', rawData]), self.encoding.encode(['spam', value]))
+
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(BencodeTest))
+    suite.addTest(unittest.makeSuite(CompactEncodingTest))
     return suite
 
 if __name__ == '__main__':
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+import unittest
+
+from twisted.internet import task
+
+import entangled.kademlia.fragmentation
+
+class ReassemblyBufferTest(unittest.TestCase):
+    """ Test case for the ReassemblyBuffer class """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.buffer = entangled.kademlia.fragmentation.ReassemblyBuffer(5, 100, fragmentOverhead=0, clock=self.clock.seconds)
+
+    def testReassembly(self):
+        """ Tests if fragments received out of order are reassembled correctly """
+        self.failUnlessEqual(self.buffer.addFragment('msg1', 2, 3, 'ghi'), None)
+        self.failUnlessEqual(self.buffer.addFragment('msg1', 0, 3, 'abc'), None)
+        # Duplicates should not count towards completion
+        self.failUnlessEqual(self.buffer.addFragment('msg1', 0, 3, 'abc'), None)
+        self.failUnlessEqual(self.buffer.progress('msg1'), 2)
+        self.failUnlessEqual(self.buffer.addFragment('msg1', 1, 3, 'def'), 'abcdefghi')
+        self.failIf('msg1' in self.buffer, 'Completed message should have been removed from the buffer')
+        self.failUnlessEqual(self.buffer.size, 0)
+
+    def testInvalidFragments(self):
+        """ Tests if fragments with inconsistent headers are rejected """
+        self.failUnlessEqual(self.buffer.addFragment('msg1', 3, 3, 'abc'), None)
+        self.failIf('msg1' in self.buffer, 'Fragment with an out-of-range sequence number should be ignored')
+        self.buffer.addFragment('msg1', 0, 3, 'abc')
+        self.failUnlessEqual(self.buffer.addFragment('msg1', 1, 4, 'def'), None)
+        self.failIf('msg1' in self.buffer, 'Message with conflicting fragment headers should be discarded')
+        self.failUnlessEqual(self.buffer.size, 0)
+
+    def testExpiry(self):
+        """ Tests if incomplete messages are discarded after their deadline """
+        self.buffer.addFragment('msg1', 0, 3, 'abc')
+        self.clock.advance(3)
+        self.buffer.addFragment('msg2', 0, 3, 'abc')
+        self.failUnlessEqual(self.buffer.nextDeadline(), 1005.0)
+        self.clock.advance(2)
+        self.failUnlessEqual(self.buffer.expire(), ['msg1'])
+        self.failUnless('msg2' in self.buffer)
+        # Progress should extend a message's deadline
+        self.clock.advance(2)
+        self.buffer.addFragment('msg2', 1, 3, 'def')
+        self.clock.advance(2)
+        self.failUnlessEqual(self.buffer.expire(), [])
+        self.failUnless('msg2' in self.buffer)
+
+    def testExpiryAfterDuplicate(self):
+        """ Tests if duplicate fragments neither extend a message's deadline nor delay the expiry of others """
+        self.buffer.addFragment('msg1', 0, 3, 'abc')
+        self.clock.advance(1)
+        self.buffer.addFragment('msg2', 0, 3, 'abc')
+        self.clock.advance(1)
+        self.buffer.addFragment('msg1', 0, 3, 'abc')
+        self.failUnlessEqual(self.buffer.nextDeadline(), 1005.0)
+        self.clock.advance(3)
+        self.failUnlessEqual(self.buffer.expire(), ['msg1'])
+        self.clock.advance(1)
+        self.failUnlessEqual(self.buffer.expire(), ['msg2'])
+        self.failUnlessEqual(self.buffer.size, 0)
+
+    def testByteBudget(self):
+        """ Tests if the least recently progressed messages are evicted when the buffer is full """
+        self.buffer.addFragment('msg1', 0, 3, 40*'a')
+        self.buffer.addFragment('msg2', 0, 3, 40*'b')
+        self.buffer.addFragment('msg1', 1, 3, 10*'a')
+        self.buffer.addFragment('msg3', 0, 3, 40*'c')
+        self.failIf('msg2' in self.buffer, 'Least recently progressed message should have been evicted')
+        self.failUnless('msg1' in self.buffer and 'msg3' in self.buffer)
+        self.failUnlessEqual(self.buffer.size, 90)
+        # A message that can never fit should not evict anything
+        self.buffer.addFragment('msg4', 0, 3, 200*'d')
+        self.failIf('msg4' in self.buffer)
+        self.failUnlessEqual(len(self.buffer), 2)
+
+    def testFragmentFlood(self):
+        """ Tests if messages claiming huge numbers of fragments are rejected, and if tiny fragments are charged their overhead """
+        buffer = entangled.kademlia.fragmentation.ReassemblyBuffer(5, 100000, maxPackets=100, fragmentOverhead=500, clock=self.clock.seconds)
+        self.failUnlessEqual(buffer.addFragment('msg1', 0, 65535, 'a'), None)
+        self.failIf('msg1' in buffer, 'Message claiming more fragments than allowed should have been rejected')
+        for i in range(2000):
+            buffer.addFragment('msg%d' % i, 0, 100, 'a')
+        self.failUnlessEqual(len(buffer), 100000 / 501)
+        self.failUnlessEqual(buffer.size, len(buffer) * 501)
+        # Memory is only allocated for the fragments that were received
+        self.failUnlessEqual(len(buffer['msg1999'].fragments), 1)
+        self.failUnlessEqual(len(buffer['msg1999'].missing()), 99)
+
+    def testStalledMessages(self):
+        """ Tests if messages without recent progress, and their missing fragments, are reported """
+        self.buffer.addFragment('msg1', 1, 4, 'abc', ('127.0.0.1', 4000))
+        self.clock.advance(1)
+        self.buffer.addFragment('msg2', 0, 2, 'abc')
+        stalled = self.buffer.stalledMessages(self.clock.seconds() - 0.5)
+        self.failUnlessEqual([msgID for msgID, partialMsg in stalled], ['msg1'])
+        self.failUnlessEqual(stalled[0][1].missing(), [0, 2, 3])
+        self.failUnlessEqual(stalled[0][1].missing(2), [0, 2])
+        self.failUnlessEqual(stalled[0][1].address, ('127.0.0.1', 4000))
+
+
+class RetransmitBufferTest(unittest.TestCase):
+    """ Test case for the RetransmitBuffer class """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.address = ('127.0.0.1', 4000)
+        self.buffer = entangled.kademlia.fragmentation.RetransmitBuffer(5, 100, clock=self.clock.seconds)
+
+    def testRetransmission(self):
+        """ Tests if retained fragments can be looked up by sequence number """
+        self.buffer.put('msg1', self.address, ['abc', 'def', 'ghi'])
+        self.failUnlessEqual(self.buffer.get('msg1', self.address, [2, 0, 7]), ['ghi', 'abc'])
+        self.failUnlessEqual(self.buffer.get('msg1', ('127.0.0.1', 4001), [0]), [], 'Fragments should only be retransmitted to the original receiver')
+        self.failUnlessEqual(self.buffer.get('msg2', self.address, [0]), [])
+
+    def testAmplification(self):
+        """ Tests if retransmission requests cannot make the buffer return more than the message's fragments, a few times """
+        self.buffer.put('msg1', self.address, ['abc', 'def'])
+        self.failUnlessEqual(self.buffer.get('msg1', self.address, [1] * 1000 + [0, 2, 65535]), ['def', 'abc'])
+        for i in range(self.buffer.maxRequests - 1):
+            self.failUnlessEqual(len(self.buffer.get('msg1', self.address, [0, 1])), 2)
+        self.failUnlessEqual(self.buffer.get('msg1', self.address, [0, 1]), [], 'Retransmission requests should be limited per message')
+
+    def testWrongAddressNoRefresh(self):
+        """ Tests if requests from other addresses do not keep a message's fragments around """
+        self.buffer.put('msg1', self.address, ['abc'])
+        self.clock.advance(4)
+        self.buffer.get('msg1', ('127.0.0.1', 4001), [0])
+        self.clock.advance(2)
+        self.failUnlessEqual(self.buffer.get('msg1', self.address, [0]), [])
+        self.failIf('msg1' in self.buffer)
+        self.failUnlessEqual(self.buffer.size, 0)
+
+    def testExpiry(self):
+        """ Tests if fragments are discarded after their deadline, unless retransmitted """
+        self.buffer.put('msg1', self.address, ['abc'])
+        self.buffer.put('msg2', self.address, ['abc'])
+        self.clock.advance(4)
+        self.buffer.get('msg2', self.address, [0])
+        self.clock.advance(2)
+        self.failUnlessEqual(self.buffer.get('msg1', self.address, [0]), [])
+        self.failUnlessEqual(self.buffer.get('msg2', self.address, [0]), ['abc'])
+        self.failUnlessEqual(self.buffer.size, 3)
+
+    def testByteBudget(self):
+        """ Tests if the oldest messages are discarded when the buffer is full """
+        self.buffer.put('msg1', self.address, [40*'a'])
+        self.buffer.put('msg2', self.address, [40*'b'])
+        self.buffer.put('msg3', self.address, [40*'c'])
+        self.failIf('msg1' in self.buffer)
+        self.failUnlessEqual(len(self.buffer), 2)
+        self.failUnlessEqual(self.buffer.size, 80)
+        self.buffer.put('msg4', self.address, [200*'d'])
+        self.failIf('msg4' in self.buffer)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(ReassemblyBufferTest))
+    suite.addTest(unittest.makeSuite(RetransmitBufferTest))
+    return suite
+
+if __name__ == '__main__':
+    # If this module is executed from the commandline, run all its tests
+    unittest.TextTestRunner().run(suite())
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+import unittest, os
+
+import entangled.kademlia.idgenerator
+
+class IDGeneratorTest(unittest.TestCase):
+    """ Test case for the IDGenerator class """
+    def setUp(self):
+        self.requests = []
+        self.generator = entangled.kademlia.idgenerator.IDGenerator(idLength=4, poolSize=3, randomSource=self.randomSource)
+
+    def randomSource(self, size):
+        """ Deterministic stand-in for os.urandom() """
+        self.requests.append(size)
+        return ''.join([chr((len(self.requests) * 16 + i) % 256) for i in range(size)])
+
+    def testPool(self):
+        """ Tests if IDs are sliced from the pool, which is refilled in batches """
+        ids = [self.generator.generate() for i in range(7)]
+        self.failUnlessEqual(self.requests, [12, 12, 12])
+        self.failUnlessEqual(ids[0], '\x10\x11\x12\x13')
+        self.failUnlessEqual(ids[3], '\x20\x21\x22\x23')
+        for id in ids:
+            self.failUnlessEqual(len(id), 4)
+        self.failUnlessEqual(len(set(ids)), 7, 'Generated IDs should be unique')
+
+    def testFork(self):
+        """ Tests if the pool is discarded in a forked (child) process """
+        self.generator.generate()
+        getpid = os.getpid
+        os.getpid = lambda: getpid() + 1
+        try:
+            self.generator.generate()
+        finally:
+            os.getpid = getpid
+        self.failUnlessEqual(len(self.requests), 2, 'Pool should have been refilled after the process ID changed')
+
+    def testGenerateID(self):
+        """ Tests the process-wide 160-bit ID generator """
+        ids = [entangled.kademlia.idgenerator.generateID() for i in range(1000)]
+        for id in ids:
+            self.failUnlessEqual(type(id), str)
+            self.failUnlessEqual(len(id), 20)
+        self.failUnlessEqual(len(set(ids)), 1000, 'Generated IDs should be unique')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(IDGeneratorTest))
+    return suite
+
+if __name__ == '__main__':
+    # If this module is executed from the commandline, run all its tests
+    unittest.TextTestRunner().run(suite())
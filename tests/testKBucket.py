@@ -22,7 +22,7 @@ class KBucketTest(unittest.TestCase):
         for i in range(entangled.kademlia.constants.k):
             tmpContact = contact.Contact('tempContactID%d' % i, str(i), i, i)
             self.kbucket.addContact(tmpContact)
-            self.failUnlessEqual(self.kbucket._contacts[i], tmpContact, "Contact in position %d not the same as the newly-added contact" % i)
+            self.failUnlessEqual(self.kbucket.getContacts()[i], tmpContact, "Contact in position %d not the same as the newly-added contact" % i)
 
         # Test if contact is not added to full list
         i += 1
@@ -30,9 +30,15 @@ class KBucketTest(unittest.TestCase):
         self.failUnlessRaises(entangled.kademlia.kbucket.BucketFull, self.kbucket.addContact, tmpContact)
         
         # Test if an existing contact is updated correctly if added again
-        existingContact = self.kbucket._contacts[0]
+        existingContact = self.kbucket.getHeadContact()
         self.kbucket.addContact(existingContact)
-        self.failUnlessEqual(self.kbucket._contacts.index(existingContact), len(self.kbucket._contacts)-1, 'Contact not correctly updated; it should be at the end of the list of contacts')
+        self.failUnlessEqual(self.kbucket.getContacts().index(existingContact), len(self.kbucket)-1, 'Contact not correctly updated; it should be at the end of the list of contacts')
+        self.failIfEqual(self.kbucket.getHeadContact(), existingContact, 'Contact not correctly updated; it should no longer be at the head of the k-bucket')
+        # The updated contact should replace the previous instance
+        updatedContact = contact.Contact(existingContact.id, '127.0.0.2', 4000, None)
+        self.kbucket.addContact(updatedContact)
+        self.failUnless(self.kbucket.getContact(existingContact.id) is updatedContact, 'Contact not correctly updated; the new contact object should be stored')
+        self.failUnlessEqual(len(self.kbucket), entangled.kademlia.constants.k)
 
     def testGetContacts(self):
         # try and get 2 contacts from empty list
@@ -58,7 +64,7 @@ class KBucketTest(unittest.TestCase):
 
         # verify returned contacts in list
         for i in range(entangled.kademlia.constants.k-2):
-            self.failIf(self.kbucket._contacts[i].id != i, "Contact in position %s not same as added contact" % (str(i)))
+            self.failIf(self.kbucket.getContacts()[i].id != i, "Contact in position %s not same as added contact" % (str(i)))
         
         # try to get too many contacts
         # requested count one greater than number of contacts
@@ -76,6 +82,18 @@ class KBucketTest(unittest.TestCase):
             result = self.kbucket.getContacts(entangled.kademlia.constants.k-3)
             self.failIf(len(result) != entangled.kademlia.constants.k-3, "Too many contacts in returned list %s - should be %s" % (len(result), entangled.kademlia.constants.k-3))
 
+    def testGetContactsUnordered(self):
+        """ Tests if all contacts are returned, except the excluded one """
+        contacts = [contact.Contact('tmpTestContactID%d' % i, str(i), i, i) for i in range(entangled.kademlia.constants.k)]
+        for tmpContact in contacts:
+            self.kbucket.addContact(tmpContact)
+        result = self.kbucket.getContactsUnordered()
+        self.failUnlessEqual(sorted(result, key=lambda tmpContact: tmpContact.id), contacts)
+        result = self.kbucket.getContactsUnordered('tmpTestContactID1')
+        self.failUnlessEqual(sorted(result, key=lambda tmpContact: tmpContact.id), contacts[:1] + contacts[2:])
+        result = self.kbucket.getContactsUnordered('unknownContactID')
+        self.failUnlessEqual(len(result), entangled.kademlia.constants.k)
+
     def testRemoveContact(self):
         # try remove contact from empty list
         rmContact = contact.Contact('TestContactID1','127.0.0.1',1, 1)
@@ -90,6 +108,32 @@ class KBucketTest(unittest.TestCase):
         self.kbucket.addContact(rmContact)
         result = self.kbucket.removeContact(rmContact)
         self.failIf(rmContact in self.kbucket._contacts, "Could not remove contact from bucket")
+        self.failUnlessRaises(ValueError, self.kbucket.getContact, rmContact.id)
+        # Contacts can also be removed by their node ID
+        self.kbucket.removeContact('tmpTestContactID0')
+        self.failUnlessRaises(ValueError, self.kbucket.removeContact, 'tmpTestContactID0')
+        self.failUnlessEqual(len(self.kbucket), entangled.kademlia.constants.k-3)
+
+    def testReplacements(self):
+        """ Tests if the replacement cache is bounded, and returns the most recently seen contacts first """
+        size = entangled.kademlia.constants.replacementCacheSize
+        contacts = [contact.Contact('tmpTestContactID%d' % i, str(i), i, i) for i in range(size + 2)]
+        for tmpContact in contacts:
+            self.kbucket.addReplacement(tmpContact)
+        self.failUnlessEqual(self.kbucket.getReplacements(), contacts[2:], 'The least recently seen replacements should have been discarded')
+        # Seeing a replacement contact again should move it to the end
+        self.kbucket.addReplacement(contacts[2])
+        self.failUnless(self.kbucket.popReplacement() is contacts[2])
+        self.failUnless(self.kbucket.popReplacement() is contacts[-1])
+        self.kbucket.removeReplacement(contacts[3].id)
+        self.kbucket.removeReplacement('unknownContactID')
+        self.failUnlessEqual(self.kbucket.getReplacements(), contacts[4:-1])
+        # Contacts that are added to the k-bucket itself are no longer replacements
+        self.kbucket.addContact(contacts[4])
+        self.failUnlessEqual(self.kbucket.getReplacements(), contacts[5:-1])
+        for i in range(size - 4):
+            self.kbucket.popReplacement()
+        self.failUnlessRaises(KeyError, self.kbucket.popReplacement)
 
 
 def suite():
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+import unittest
+
+import entangled.kademlia.lrucache
+
+class LRUCacheTest(unittest.TestCase):
+    """ Test case for the LRUCache class """
+    def setUp(self):
+        self.cache = entangled.kademlia.lrucache.LRUCache(10)
+
+    def testGetPut(self):
+        """ Tests if cached values can be retrieved """
+        self.failUnlessEqual(self.cache.get('a'), None)
+        self.failUnlessEqual(self.cache.get('a', 'default'), 'default')
+        self.cache.put('a', 'value a', 3)
+        self.failUnless('a' in self.cache)
+        self.failUnlessEqual(self.cache.get('a'), 'value a')
+        self.cache.put('a', 'new value a', 4)
+        self.failUnlessEqual(self.cache.get('a'), 'new value a')
+        self.failUnlessEqual(len(self.cache), 1)
+        self.failUnlessEqual(self.cache.size, 4)
+
+    def testEviction(self):
+        """ Tests if the least recently used entries are discarded first """
+        self.cache.put('a', 1, 4)
+        self.cache.put('b', 2, 4)
+        self.cache.get('a')
+        self.cache.put('c', 3, 4)
+        self.failIf('b' in self.cache, 'Least recently used entry should have been discarded')
+        self.failUnless('a' in self.cache)
+        self.failUnless('c' in self.cache)
+        self.failUnlessEqual(self.cache.size, 8)
+        self.cache.put('d', 4, 11)
+        self.failIf('d' in self.cache, 'Entries larger than the cache should not be cached')
+        self.failUnlessEqual(len(self.cache), 2)
+
+    def testInvalidation(self):
+        """ Tests if invalidated entries are discarded, and stale entries are not cached """
+        self.cache.put('a', 1)
+        self.cache.put('b', 2)
+        version = self.cache.version
+        self.cache.discard('a')
+        self.failIf('a' in self.cache)
+        self.cache.put('a', 'stale', version=version)
+        self.failIf('a' in self.cache, 'Value computed before the invalidation should not be cached')
+        self.cache.put('a', 'fresh', version=self.cache.version)
+        self.failUnlessEqual(self.cache.get('a'), 'fresh')
+        self.cache.clear()
+        self.failUnlessEqual(len(self.cache), 0)
+        self.failUnlessEqual(self.cache.size, 0)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(LRUCacheTest))
+    return suite
+
+if __name__ == '__main__':
+    # If this module is executed from the commandline, run all its tests
+    unittest.TextTestRunner().run(suite())
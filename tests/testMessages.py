@@ -6,8 +6,17 @@
 
 import unittest
 
-from entangled.kademlia.msgtypes import Message, RequestMessage, ResponseMessage, ErrorMessage
-from entangled.kademlia.msgformat import MessageTranslator, DefaultFormat
+from entangled.kademlia.msgtypes import Message, RequestMessage, ResponseMessage, ErrorMessage, MultiMessage
+from entangled.kademlia.msgformat import MessageTranslator, DefaultFormat, TupleFormat, PackedContacts, encodeContacts, decodeContacts
+from entangled.kademlia.encoding import Bencode, CompactEncoding
+
+def messageFields(msg):
+    """ Returns a dict of the specified message's instance variables """
+    fields = {}
+    for cls in type(msg).__mro__:
+        for name in getattr(cls, '__slots__', ()):
+            fields[name] = getattr(msg, name)
+    return fields
 
 class DefaultFormatTranslatorTest(unittest.TestCase):
     """ Test case for the default message translator """
@@ -54,13 +63,156 @@ class DefaultFormatTranslatorTest(unittest.TestCase):
         for msg, msgPrimitive in self.cases:
             translatedObj = self.translator.fromPrimitive(msgPrimitive)
             self.failUnlessEqual(type(translatedObj), type(msg), 'Message type incorrectly translated; expected "%s", got "%s"' % (type(msg), type(translatedObj))) 
-            for key in msg.__dict__:
-                self.failUnlessEqual(msg.__dict__[key], translatedObj.__dict__[key], 'Message instance variable "%s" not translated correctly; expected "%s", got "%s"' % (key, msg.__dict__[key], translatedObj.__dict__[key]))
+            msgFields = messageFields(msg)
+            translatedFields = messageFields(translatedObj)
+            for key in msgFields:
+                self.failUnlessEqual(msgFields[key], translatedFields[key], 'Message instance variable "%s" not translated correctly; expected "%s", got "%s"' % (key, msgFields[key], translatedFields[key]))
+
+    def testMultiMessage(self):
+        """ Tests translation of multi-call messages, and of advertised capabilities """
+        msg = MultiMessage('node1', [RequestMessage('node1', 'ping', [], 'rpc1'),
+                                     ResponseMessage('rpc2', 'node1', 'pong'),
+                                     ErrorMessage('rpc3', 'node1', 'exceptions.ValueError', 'error')], 'rpc4')
+        msg.capabilities = 5
+        msgPrimitive = self.translator.toPrimitive(msg)
+        self.failUnlessEqual(msgPrimitive[DefaultFormat.headerType], DefaultFormat.typeMulti)
+        self.failUnlessEqual(msgPrimitive[DefaultFormat.headerCapabilities], 5)
+        for subPrimitive in msgPrimitive[DefaultFormat.headerPayload]:
+            self.failIf(DefaultFormat.headerNodeID in subPrimitive, 'Contained messages should not repeat the sender node ID')
+        translatedObj = self.translator.fromPrimitive(msgPrimitive)
+        self.failUnlessEqual(type(translatedObj), MultiMessage)
+        self.failUnlessEqual((translatedObj.id, translatedObj.nodeID, translatedObj.capabilities), ('rpc4', 'node1', 5))
+        self.failUnlessEqual(len(translatedObj.messages), 3)
+        for subMsg, translatedSubMsg in zip(msg.messages, translatedObj.messages):
+            self.failUnlessEqual(type(translatedSubMsg), type(subMsg))
+            self.failUnlessEqual(translatedSubMsg.id, subMsg.id)
+            self.failUnlessEqual(translatedSubMsg.nodeID, 'node1')
+        self.failUnlessEqual(translatedObj.messages[0].request, 'ping')
+        self.failUnlessEqual(translatedObj.messages[1].response, 'pong')
+        self.failUnlessEqual(translatedObj.messages[2].exceptionType, 'exceptions.ValueError')
+
+    def testPackedContacts(self):
+        """ Tests translation of responses containing packed contact triples """
+        contactTriples = [('a'*20, '127.0.0.1', 4000), ('b'*20, '10.1.2.3', 65535)]
+        packedContacts = encodeContacts(contactTriples)
+        msg = ResponseMessage('rpc1', 'node1', packedContacts)
+        msgPrimitive = self.translator.toPrimitive(msg)
+        self.failUnlessEqual(msgPrimitive[DefaultFormat.headerType], DefaultFormat.typeContacts)
+        self.failUnlessEqual(type(msgPrimitive[DefaultFormat.headerPayload]), str)
+        translatedObj = self.translator.fromPrimitive(msgPrimitive)
+        self.failUnlessEqual(type(translatedObj), ResponseMessage)
+        self.failUnlessEqual(translatedObj.response, contactTriples)
+
+
+class TupleFormatTranslatorTest(unittest.TestCase):
+    """ Test case for the list-based message translator """
+    def setUp(self):
+        self.translator = TupleFormat()
+        self.messages = (RequestMessage('node1', 'rpcMethod', {'arg1': 'a string', 'arg2': 123}, 'rpc1'),
+                         ResponseMessage('rpc2', 'node2', 'response'),
+                         ErrorMessage('rpc3', 'node3', 'exceptions.ValueError', 'this is a test exception'),
+                         ResponseMessage('rpc4', 'node4', [('a'*20, '127.0.0.1', 1919), ('b'*20, '127.0.0.1', 1921)]),
+                         MultiMessage('node5', [RequestMessage('node5', 'ping', [], 'rpc5'),
+                                                ResponseMessage('rpc6', 'node5', 'pong')], 'rpc7'),
+                         Message('rpc8', 'node6'))
+
+    def testToPrimitive(self):
+        """ Tests if messages are translated into lists, with fields at fixed positions """
+        self.failUnlessEqual(self.translator.toPrimitive(self.messages[0]), [TupleFormat.typeRequest, 'rpc1', 'node1', 'rpcMethod', {'arg1': 'a string', 'arg2': 123}])
+        self.failUnlessEqual(self.translator.toPrimitive(self.messages[1]), [TupleFormat.typeResponse, 'rpc2', 'node2', 'response'])
+        self.failUnlessEqual(self.translator.toPrimitive(self.messages[2]), [TupleFormat.typeError, 'rpc3', 'node3', 'exceptions.ValueError', 'this is a test exception'])
+        msg = ResponseMessage('rpc2', 'node2', 'response')
+        msg.capabilities = 5
+        self.failUnlessEqual(self.translator.toPrimitive(msg), [TupleFormat.typeResponse, 'rpc2', 'node2', 'response', None, 5])
+        multiPrimitive = self.translator.toPrimitive(self.messages[4])
+        self.failUnlessEqual(multiPrimitive[TupleFormat.headerPayload][1], [TupleFormat.typeResponse, 'rpc6', None, 'pong'])
+
+    def testRoundTrip(self):
+        """ Tests if messages survive translation to primitives and back, including encoding """
+        for encoder in (Bencode(), CompactEncoding()):
+            for msg in self.messages:
+                msg.capabilities = 3
+                translatedObj = self.translator.fromPrimitive(encoder.decode(encoder.encode(self.translator.toPrimitive(msg))))
+                self.failUnlessEqual(type(translatedObj), type(msg))
+                if isinstance(msg, MultiMessage):
+                    self.failUnlessEqual(len(translatedObj.messages), len(msg.messages))
+                    for subMsg, translatedSubMsg in zip(msg.messages, translatedObj.messages):
+                        self.failUnlessEqual(messageFields(translatedSubMsg), messageFields(subMsg))
+                    translatedObj.messages = msg.messages
+                msgFields = messageFields(msg)
+                if isinstance(msg, ResponseMessage) and type(msg.response) == list:
+                    # Encoders return tuples as lists
+                    translatedObj.response = [tuple(item) for item in translatedObj.response]
+                self.failUnlessEqual(messageFields(translatedObj), msgFields)
+
+    def testPackedContacts(self):
+        """ Tests translation of responses containing packed contact triples """
+        contactTriples = [('a'*20, '127.0.0.1', 4000), ('b'*20, '10.1.2.3', 65535)]
+        msgPrimitive = self.translator.toPrimitive(ResponseMessage('rpc1', 'node1', encodeContacts(contactTriples)))
+        self.failUnlessEqual(msgPrimitive[TupleFormat.headerType], TupleFormat.typeContacts)
+        translatedObj = self.translator.fromPrimitive(msgPrimitive)
+        self.failUnlessEqual(type(translatedObj), ResponseMessage)
+        self.failUnlessEqual(translatedObj.response, contactTriples)
+
+    def testDefaultFormat(self):
+        """ Tests if messages in the default (dict-based) format are still understood """
+        defaultFormat = DefaultFormat()
+        for msg in self.messages[:3]:
+            translatedObj = self.translator.fromPrimitive(defaultFormat.toPrimitive(msg))
+            self.failUnlessEqual(messageFields(translatedObj), messageFields(msg))
+        encoder = Bencode()
+        data = encoder.encode(defaultFormat.toPrimitive(self.messages[1]))
+        self.failUnlessEqual(self.translator.responseHeader(data, encoder), ('rpc2', 'node2'))
+
+    def testResponseHeader(self):
+        """ Tests if the IDs of response and error messages can be decoded on their own """
+        for encoder in (Bencode(), CompactEncoding()):
+            headers = [self.translator.responseHeader(encoder.encode(self.translator.toPrimitive(msg)), encoder) for msg in self.messages]
+            self.failUnlessEqual(headers, [None, ('rpc2', 'node2'), ('rpc3', 'node3'), ('rpc4', 'node4'), None, None])
+            self.failUnlessEqual(self.translator.responseHeader(encoder.encode([]), encoder), None)
+
+
+class PackedContactsTest(unittest.TestCase):
+    """ Test case for packing contact triples into strings """
+    def testIPv4(self):
+        """ Tests packing of contacts with IPv4 addresses """
+        contactTriples = [('a'*20, '127.0.0.1', 4000), ('b'*20, '10.1.2.3', 65535)]
+        packedContacts = encodeContacts(contactTriples)
+        self.failUnlessEqual(packedContacts.data, 'a'*20 + '\x7f\x00\x00\x01\x0f\xa0' + 'b'*20 + '\x0a\x01\x02\x03\xff\xff')
+        self.failUnlessEqual(packedContacts.addressLength, 4)
+        self.failUnlessEqual(decodeContacts(packedContacts), contactTriples)
+        packedContacts = encodeContacts([])
+        self.failUnlessEqual(decodeContacts(packedContacts), [])
+
+    def testIPv6(self):
+        """ Tests packing of contacts with IPv6 addresses """
+        contactTriples = [('a'*20, '::1', 4000), ('b'*20, 'fe80::1:2', 4001)]
+        packedContacts = encodeContacts(contactTriples)
+        self.failUnlessEqual(len(packedContacts.data), 2 * 38)
+        self.failUnlessEqual(packedContacts.addressLength, 16)
+        self.failUnlessEqual(decodeContacts(packedContacts), contactTriples)
+
+    def testUnpackable(self):
+        """ Tests if contacts which cannot be packed (without altering them) are rejected """
+        for contactTriple in (('a'*19, '127.0.0.1', 4000),
+                              ('a'*20, 'localhost', 4000),
+                              ('a'*20, '127.1', 4000),
+                              ('a'*20, 'FE80::1', 4000),
+                              ('a'*20, '127.0.0.1', 65536),
+                              ('a'*20, '127.0.0.1', '4000')):
+            self.failUnlessEqual(encodeContacts([contactTriple]), None, 'Contact should not have been packed: %s' % (contactTriple,))
+        mixedTriples = [('a'*20, '127.0.0.1', 4000), ('b'*20, '::1', 4000)]
+        self.failUnlessEqual(encodeContacts(mixedTriples), None, 'Contacts with different address families should not be packed')
+        for data, addressLength in (('a'*25, 4), ('a'*26, 6)):
+            packedContacts = PackedContacts(data, addressLength)
+            self.failUnlessRaises(ValueError, decodeContacts, packedContacts)
 
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(DefaultFormatTranslatorTest))
+    suite.addTest(unittest.makeSuite(TupleFormatTranslatorTest))
+    suite.addTest(unittest.makeSuite(PackedContactsTest))
     return suite
 
 if __name__ == '__main__':
@@ -5,8 +5,12 @@
 # See the COPYING file included in this archive
 
 import hashlib
+import threading
+import time
 import unittest
 
+from twisted.internet import defer
+
 import entangled.kademlia.node
 import entangled.kademlia.constants
 
@@ -55,10 +59,108 @@ class NodeDataTest(unittest.TestCase):
         for key, value in self.cases:
             self.failUnless(key in self.node._dataStore, 'Stored key not found in node\'s DataStore: "%s"' % key)
 
+    def testFindValueCache(self):
+        """ Tests if findValue RPC responses are cached, and invalidated when the data changes """
+        senderID = self.node._generateID()
+        self.node.store('a', 'first value', self.node.id)
+        response = self.node.findValue('a', _rpcNodeID=senderID)
+        self.failUnlessEqual(self.node._protocol._encoder.decode(response.data), {'a': 'first value'})
+        self.failUnless(self.node.findValue('a', _rpcNodeID=senderID) is response, 'Response should have been cached')
+        self.failUnlessEqual(self.node.findValue('a'), {'a': 'first value'}, 'Local calls should not return encoded responses')
+        self.node.store('a', 'second value', self.node.id)
+        response = self.node.findValue('a', _rpcNodeID=senderID)
+        self.failUnlessEqual(self.node._protocol._encoder.decode(response.data), {'a': 'second value'}, 'Cached response should have been invalidated by store()')
+
+    def testThreadedFindValue(self):
+        """ Tests if findValue accesses the data store in a worker thread, but executes FIND_NODE in the reactor thread """
+        senderID = self.node._generateID()
+        self.node.store('a', 'first value', self.node.id)
+        workerThreads = []
+        def callInThreadPool(func, *args):
+            results = []
+            thread = threading.Thread(target=lambda: results.append(func(*args)))
+            workerThreads.append(thread)
+            thread.start()
+            thread.join()
+            return defer.succeed(results[0])
+        self.node._protocol.callInThreadPool = callInThreadPool
+        self.node.threadedRPCs = True
+        findNodeThreads = []
+        originalFindNode = self.node.findNode
+        def findNode(key, **kwargs):
+            findNodeThreads.append(threading.currentThread())
+            return originalFindNode(key, **kwargs)
+        self.node.findNode = findNode
+        responses = []
+        self.node.findValue('a', _rpcNodeID=senderID).addCallback(responses.append)
+        self.node.findValue('b', _rpcNodeID=senderID).addCallback(responses.append)
+        self.failUnlessEqual(len(workerThreads), 2, 'The data store should have been accessed in worker threads')
+        self.failUnlessEqual(self.node._protocol._encoder.decode(responses[0].data), {'a': 'first value'})
+        self.failUnlessEqual(len(responses), 2)
+        self.failUnlessEqual(findNodeThreads, [threading.currentThread()], 'FIND_NODE should have been executed (only) for the missing key, in the reactor thread')
+
+    def testFindNodeCache(self):
+        """ Tests if findNode RPC responses are cached, and invalidated when the routing table changes """
+        import entangled.kademlia.contact
+        contacts = []
+        for i in range(3):
+            h = hashlib.sha1()
+            h.update('remote node %d' % i)
+            contacts.append(entangled.kademlia.contact.Contact(h.digest(), '127.0.0.1', 91824+i, self.node._protocol))
+        self.node.addContact(contacts[0])
+        self.node.addContact(contacts[1])
+        senderID = self.node._generateID()
+        response = self.node.findNode('a', _rpcNodeID=senderID)
+        self.failUnlessEqual(len(self.node._protocol._encoder.decode(response.data)), 2)
+        self.failUnless(self.node.findNode('a', _rpcNodeID=senderID) is response, 'Response should have been cached')
+        # The sender should never receive its own contact
+        result = self.node.findNode('a', _rpcNodeID=contacts[0].id)
+        self.failUnlessEqual(result, [(contacts[1].id, '127.0.0.1', 91825)])
+        self.node.addContact(contacts[2])
+        response = self.node.findNode('a', _rpcNodeID=senderID)
+        self.failUnlessEqual(len(self.node._protocol._encoder.decode(response.data)), 3, 'Cached response should have been invalidated by the new contact')
+
+    def testFindNodePackedContacts(self):
+        """ Tests if findNode RPC responses to nodes supporting it contain packed contact triples """
+        import entangled.kademlia.contact
+        import entangled.kademlia.msgformat
+        contactTriples = []
+        for i in range(2):
+            h = hashlib.sha1()
+            h.update('remote node %d' % i)
+            contactTriples.append((h.digest(), '127.0.0.1', 4100+i))
+            self.node.addContact(entangled.kademlia.contact.Contact(contactTriples[-1][0], '127.0.0.1', 4100+i, self.node._protocol))
+        sender = entangled.kademlia.contact.Contact(self.node._generateID(), '127.0.0.1', 4001, self.node._protocol)
+        response = self.node.findNode('a', _rpcNodeID=sender.id, _rpcNodeContact=sender)
+        self.failIf(isinstance(response, entangled.kademlia.msgformat.PackedContacts), 'Contacts should only be packed for nodes supporting it')
+        self.node._protocol._updatePeerCapabilities(('127.0.0.1', 4001), self.node._protocol.capabilityCompactContacts)
+        response = self.node.findNode('a', _rpcNodeID=sender.id, _rpcNodeContact=sender)
+        self.failUnless(isinstance(response, entangled.kademlia.msgformat.PackedContacts))
+        self.failUnlessEqual(sorted(entangled.kademlia.msgformat.decodeContacts(response)), sorted(contactTriples))
+        # The sender should never receive its own contact
+        response = self.node.findNode('a', _rpcNodeID=contactTriples[0][0], _rpcNodeContact=sender)
+        self.failUnlessEqual(entangled.kademlia.msgformat.decodeContacts(response), contactTriples[1:])
+
+class SteppingClock(object):
+    """ Stand-in for the time module, whose time() advances on every call """
+    def __init__(self, now):
+        self.now = now
+    def time(self):
+        self.now += 0.01
+        return self.now
+
 class NodeContactTest(unittest.TestCase):
     """ Test case for the Node class's contact management-related functions """
     def setUp(self):
         self.node = entangled.kademlia.node.Node()
+
+    def tearDown(self):
+        self.node._protocol.stopProtocol()
+
+    def _expireTimers(self):
+        """ Makes the calls scheduled in the protocol's timer wheel, as if
+        C{constants.touchInterval} seconds had passed """
+        self.node._protocol._timeouts.expire(time.time() + entangled.kademlia.constants.touchInterval + 1)
     
     def testAddContact(self):
         """ Tests if a contact can be added and retrieved correctly """
@@ -86,6 +188,72 @@ class NodeContactTest(unittest.TestCase):
         closestNodes = self.node._routingTable.findCloseNodes(self.node.id, entangled.kademlia.constants.k)
         self.failIf(contact in closestNodes, 'Node added itself as a contact')
 
+    def testDeferredRefresh(self):
+        """ Tests if contacts that were refreshed recently are only refreshed again in batches """
+        import entangled.kademlia.contact
+        contacts = []
+        for i in range(3):
+            h = hashlib.sha1()
+            h.update('remote node %d' % i)
+            contact = entangled.kademlia.contact.Contact(h.digest(), '127.0.0.1', 4000+i, self.node._protocol)
+            self.node.addContact(contact)
+            contacts.append(contact)
+        bucket = self.node._routingTable._buckets[0]
+        # Make sure that the contacts are seen at different times
+        realTime = entangled.kademlia.node.time
+        entangled.kademlia.node.time = SteppingClock(realTime.time())
+        try:
+            self.node.addContact(contacts[1])
+            self.node.addContact(contacts[0])
+            self.node.addContact(contacts[2])
+        finally:
+            entangled.kademlia.node.time = realTime
+        # A failed RPC does not cancel the deferred refresh of a contact that is not evicted
+        self.node.removeContact(contacts[2].id)
+        self.failUnlessEqual(bucket.getContacts(), contacts, 'Recently refreshed contacts should not have been refreshed again yet')
+        self.failIfEqual(self.node._touchedContactsCall, None)
+        self._expireTimers()
+        self.failUnlessEqual(self.node._touchedContactsCall, None)
+        self.failUnlessEqual(bucket.getContacts(), [contacts[1], contacts[0], contacts[2]], 'Contacts should have been refreshed in the order they were last seen')
+        self.failUnlessEqual(self.node._touchedContacts, {})
+        # Contacts with changed addresses are updated right away
+        movedContact = entangled.kademlia.contact.Contact(contacts[1].id, '127.0.0.2', 4001, self.node._protocol)
+        self.node.addContact(contacts[1])
+        self.node.addContact(movedContact)
+        self.failUnless(bucket.getContacts()[-1] is movedContact)
+        self.failUnlessEqual(self.node._touchedContacts, {})
+
+    def testAlternatingFailedRPCs(self):
+        """ Tests if a contact that fails to respond to every other RPC is kept, and if evicted contacts are not refreshed """
+        import entangled.kademlia.contact
+        h = hashlib.sha1()
+        h.update('remote node')
+        contact = entangled.kademlia.contact.Contact(h.digest(), '127.0.0.1', 4000, self.node._protocol)
+        self.node.addContact(contact)
+        for i in range(10):
+            self.node.addContact(contact)
+            self.node.removeContact(contact.id)
+        self.failUnlessEqual(self.node._routingTable.getContact(contact.id), contact, 'Contact answering every other RPC should not have been evicted')
+        # Five successive failed RPCs evict it
+        for i in range(5):
+            self.node.removeContact(contact.id)
+        self.failUnlessRaises(ValueError, self.node._routingTable.getContact, contact.id)
+        self.failUnlessEqual(self.node._touchedContacts, {}, 'The deferred refresh of an evicted contact should have been cancelled')
+        self._expireTimers()
+        self.failUnlessRaises(ValueError, self.node._routingTable.getContact, contact.id)
+
+    def testStoppedProtocol(self):
+        """ Tests if deferred refreshes are not made once the node's protocol is stopped """
+        import entangled.kademlia.contact
+        h = hashlib.sha1()
+        h.update('remote node')
+        contact = entangled.kademlia.contact.Contact(h.digest(), '127.0.0.1', 4000, self.node._protocol)
+        self.node.addContact(contact)
+        self.node.addContact(contact)
+        self.failIfEqual(self.node._protocol._timeoutsCall, None)
+        self.node._protocol.stopProtocol()
+        self.failUnlessEqual(self.node._protocol._timeoutsCall, None, 'Stopping the protocol should have stopped its timers')
+
 
 #class NodeLookupTest(unittest.TestCase):
 #    """ Test case for the Node class's iterative node lookup algorithm """
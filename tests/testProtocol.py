@@ -4,8 +4,10 @@
 # the GNU Lesser General Public License Version 3, or any later version.
 # See the COPYING file included in this archive
 
+import struct
 import time
 import unittest
+import threading
 
 from twisted.internet import defer
 from twisted.python import failure
@@ -13,10 +15,11 @@ import twisted.internet.selectreactor
 from twisted.internet.protocol import DatagramProtocol
 
 import entangled.kademlia.protocol
+import entangled.kademlia.encoding
 import entangled.kademlia.contact
 import entangled.kademlia.constants
 import entangled.kademlia.msgtypes
-from entangled.kademlia.node import rpcmethod
+from entangled.kademlia.node import rpcmethod, rpcthreaded
 
 
 class FakeNode(object):
@@ -26,6 +29,7 @@ class FakeNode(object):
     def __init__(self, id):
         self.id = id
         self.contacts = []
+        self.rpcCalls = []
         
     @rpcmethod
     def ping(self):
@@ -37,6 +41,27 @@ class FakeNode(object):
     @rpcmethod
     def echo(self, value):
         return value
+
+    @rpcmethod
+    def senderID(self, _rpcNodeID=None):
+        self.rpcCalls.append(('senderID', _rpcNodeID))
+        return _rpcNodeID
+
+    @rpcmethod
+    def deferredEcho(self, value):
+        df = defer.Deferred()
+        entangled.kademlia.protocol.reactor.callLater(0, df.callback, value)
+        return df
+
+    @rpcmethod
+    @rpcthreaded
+    def threadName(self):
+        return threading.currentThread().getName()
+
+    @rpcmethod
+    def failingCall(self, **kwargs):
+        self.rpcCalls.append(('failingCall', kwargs['_rpcNodeContact'].id))
+        raise TypeError('failing from within the RPC method')
     
     def addContact(self, contact):
         self.contacts.append(contact)
@@ -79,6 +104,23 @@ class ClientDatagramProtocol(entangled.kademlia.protocol.KademliaProtocol):
 #        print 'Datagram received: ', repr(datagram)
 #        self.sendDatagram()
 
+class CountingEncoding(entangled.kademlia.encoding.Bencode):
+    """ Bencode encoding which counts the messages it fully decodes """
+    def __init__(self):
+        self.decoded = 0
+
+    def decode(self, data):
+        self.decoded += 1
+        return entangled.kademlia.encoding.Bencode.decode(self, data)
+
+class FakeTransport(object):
+    """ Fake UDP transport; records all written datagrams instead of sending them """
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, address):
+        self.written.append((data, address))
+
         
 
 class KademliaProtocolTest(unittest.TestCase):
@@ -214,7 +256,7 @@ class KademliaProtocolTest(unittest.TestCase):
         msgID = 'abcdefghij1234567890'
         df = defer.Deferred()
         timeoutCall = entangled.kademlia.protocol.reactor.callLater(entangled.kademlia.constants.rpcTimeout, self.protocol._msgTimeout, msgID)
-        self.protocol._sentMessages[msgID] = (remoteContact.id, df, timeoutCall)
+        self.protocol._sentMessages[msgID] = (remoteContact.id, df, timeoutCall, time.time())
         # Simulate the "reply" transmission
         msg = entangled.kademlia.msgtypes.ResponseMessage(msgID, 'node2', responseData)
         msgPrimitive = self.protocol._translator.toPrimitive(msg)
@@ -231,6 +273,282 @@ class KademliaProtocolTest(unittest.TestCase):
         # The list of sent RPC messages should be empty at this stage
         #self.failUnlessEqual(len(self.protocol._sentMessages), 0, 'The protocol is still waiting for a RPC result, but the transaction is already done!')
 
+    def testSelectiveRetransmission(self):
+        """ Tests if lost fragments of a multi-datagram message are requested and retransmitted """
+        senderAddress = ('127.0.0.1', 4001)
+        receiverAddress = ('127.0.0.1', 4002)
+        sender = entangled.kademlia.protocol.KademliaProtocol(FakeNode('node2'))
+        sender.transport = FakeTransport()
+        self.protocol.transport = FakeTransport()
+        # Make the receiving protocol think it is waiting for a result from an RPC
+        msgID = 'abcdefghij1234567890'
+        df = defer.Deferred()
+        timeoutCall = entangled.kademlia.protocol.reactor.callLater(entangled.kademlia.constants.rpcTimeout, self.protocol._msgTimeout, msgID)
+        self.protocol._sentMessages[msgID] = ('node2', df, timeoutCall, time.time())
+        responseData = 3 * sender.msgSizeLimit * '0'
+        results = []
+        df.addCallback(results.append)
+        # Transmit the response, losing one of the datagrams in transit
+        msg = entangled.kademlia.msgtypes.ResponseMessage(msgID, 'node2', responseData)
+        sender._send(sender._encoder.encode(sender._translator.toPrimitive(msg)), msgID, receiverAddress)
+        fragments = sender.transport.written
+        self.failUnless(len(fragments) > 2, 'Test data should have been spread over several datagrams')
+        for seqNumber in range(len(fragments)):
+            if seqNumber != 1:
+                self.protocol.datagramReceived(fragments[seqNumber][0], senderAddress)
+        self.failUnlessEqual(len(results), 0, 'Message should not be complete yet')
+        # The receiver should have requested only the missing datagram...
+        self.failUnlessEqual(len(self.protocol.transport.written), 1, 'Retransmission of the lost datagram was not requested')
+        sender.transport.written = []
+        sender.datagramReceived(self.protocol.transport.written[0][0], receiverAddress)
+        self.failUnlessEqual(sender.transport.written, [fragments[1]], 'Only the lost datagram should have been retransmitted')
+        # ...and be able to reconstruct the message from it
+        self.protocol.datagramReceived(sender.transport.written[0][0], senderAddress)
+        self.failUnlessEqual(results, [responseData], 'Message was not reconstructed correctly after retransmission')
+
+    def testRetransmissionRequestReflection(self):
+        """ Tests if spoofed fragments do not make the protocol send (large) retransmission requests """
+        self.protocol.transport = FakeTransport()
+        spoofedAddress = ('6.6.6.6', 53)
+        msgID = 'abcdefghij1234567890'
+        def fragment(seqNumber, data):
+            return '\x00%s%s%s\x00%s' % (struct.pack('>H', 4000), struct.pack('>H', seqNumber), msgID, data)
+        # The last fragment of an unsolicited message triggers no request...
+        self.protocol.datagramReceived(fragment(3999, 'a'), spoofedAddress)
+        self.failUnless(msgID in self.protocol._partialMessages)
+        self.protocol._requestRetransmission(msgID, self.protocol._partialMessages[msgID])
+        self.failUnlessEqual(self.protocol.transport.written, [], 'Missing fragments of unsolicited messages should not be requested')
+        # ...and requests for responses to pending RPCs are no larger than the received data
+        df = defer.Deferred()
+        timeoutCall = entangled.kademlia.protocol.reactor.callLater(entangled.kademlia.constants.rpcTimeout, self.protocol._msgTimeout, msgID)
+        self.protocol._sentMessages[msgID] = ('node2', df, timeoutCall, time.time())
+        self.protocol.datagramReceived(fragment(3998, 99*'a'), spoofedAddress)
+        self.protocol._requestRetransmission(msgID, self.protocol._partialMessages[msgID])
+        self.failUnlessEqual(len(self.protocol.transport.written), 1)
+        request = self.protocol.transport.written[0][0]
+        self.failUnless((len(request) - 26) * entangled.kademlia.constants.fragmentRetransmitRequests <= 100, 'Retransmission requests should be no larger than the received data')
+        self.failUnlessEqual(struct.unpack('>H', request[3:5])[0], (len(request) - 26) / 2)
+        timeoutCall.cancel()
+
+    def testAdaptiveTimeout(self):
+        """ Tests if RPC timeouts are derived from the measured round-trip times """
+        remoteContact = entangled.kademlia.contact.Contact('node2', '127.0.0.1', 4002, self.protocol)
+        self.protocol.transport = FakeTransport()
+        self.failUnlessEqual(self.protocol.rpcTimeout(remoteContact.id), entangled.kademlia.constants.rpcTimeout)
+        self.failUnlessEqual(self.protocol.rttStatistics(remoteContact.id), None)
+        remoteContact.ping()
+        # Simulate the response to the RPC
+        msgID = self.protocol._sentMessages.keys()[0]
+        msg = entangled.kademlia.msgtypes.ResponseMessage(msgID, remoteContact.id, 'pong')
+        self.protocol.datagramReceived(self.protocol._encoder.encode(self.protocol._translator.toPrimitive(msg)), ('127.0.0.1', 4002))
+        self.failUnlessEqual(len(self.protocol._sentMessages), 0)
+        self.failUnlessEqual(self.protocol.rttStatistics(remoteContact.id).samples, 1)
+        self.failUnlessEqual(self.protocol.rpcTimeout(remoteContact.id), entangled.kademlia.constants.rpcTimeoutMin, 'RPC timeout should have been reduced for a fast node')
+
+    def testTimeoutIncludesTransmission(self):
+        """ Tests if RPC timeouts are extended by the time it takes to transmit the request """
+        remoteContact = entangled.kademlia.contact.Contact('node2', '127.0.0.1', 4002, self.protocol)
+        self.protocol.transport = FakeTransport()
+        self.protocol._rttEstimator(remoteContact.id).update(0.02)
+        rpcTimeout = self.protocol.rpcTimeout(remoteContact.id)
+        self.protocol.sendRPC(remoteContact, 'store', ['key', 1048576 * 'a'])
+        drainTime = self.protocol._sendQueue.drainTime()
+        self.failUnless(drainTime >= 0.1, 'Most of the request should still be queued')
+        timeoutCall = self.protocol._sentMessages.values()[0][2]
+        self.failUnless(timeoutCall.getTime() >= time.time() + rpcTimeout + drainTime - 0.01, 'RPC timeout should include the transmission time of the request')
+        self.protocol.stopProtocol()
+
+    def testRTTSampleContactID(self):
+        """ Tests if round-trip times are recorded for the contact an RPC was sent to, not the node ID in the response """
+        bootstrapContact = entangled.kademlia.contact.Contact('fakeID', '127.0.0.1', 4002, self.protocol)
+        self.protocol.transport = FakeTransport()
+        bootstrapContact.ping()
+        msgID = self.protocol._sentMessages.keys()[0]
+        msg = entangled.kademlia.msgtypes.ResponseMessage(msgID, 'node2', 'pong')
+        self.protocol.datagramReceived(self.protocol._encoder.encode(self.protocol._translator.toPrimitive(msg)), ('127.0.0.1', 4002))
+        self.failUnlessEqual(self.protocol.rttStatistics('fakeID').samples, 1)
+        self.failUnlessEqual(self.protocol.rttStatistics('node2'), None)
+
+    def testRPCDispatch(self):
+        """ Tests if RPC methods receive sender information only if they accept it, and are executed exactly once """
+        self.protocol.transport = FakeTransport()
+        remoteContact = entangled.kademlia.contact.Contact('node2', '127.0.0.1', 4000, self.protocol)
+        self.protocol._handleRPC(remoteContact, 'rpc1', 'senderID', [])
+        self.protocol._handleRPC(remoteContact, 'rpc2', 'failingCall', [])
+        self.protocol._handleRPC(remoteContact, 'rpc3', 'echo', ['hello'])
+        self.protocol._handleRPC(remoteContact, 'rpc4', 'pingNoRPC', [])
+        self.failUnlessEqual(self.node.rpcCalls, [('senderID', 'node2'), ('failingCall', 'node2')],
+                             'RPC methods raising TypeError should not be retried')
+        responses = [self.protocol._translator.fromPrimitive(self.protocol._encoder.decode(data)) for data, address in self.protocol.transport.written]
+        self.failUnlessEqual([msg.id for msg in responses], ['rpc1', 'rpc2', 'rpc3', 'rpc4'])
+        self.failUnlessEqual(responses[0].response, 'node2')
+        self.failUnless(isinstance(responses[1], entangled.kademlia.msgtypes.ErrorMessage))
+        self.failUnlessEqual(responses[1].exceptionType, 'exceptions.TypeError')
+        self.failUnlessEqual(responses[2].response, 'hello')
+        self.failUnlessEqual(responses[3].exceptionType, 'exceptions.AttributeError', 'Unexposed methods should not be callable')
+
+    def testInstanceRPCMethods(self):
+        """ Tests if RPC methods overridden or wrapped on the node instance are called """
+        self.protocol.transport = FakeTransport()
+        remoteContact = entangled.kademlia.contact.Contact('node2', '127.0.0.1', 4000, self.protocol)
+        originalEcho = self.node.echo
+        self.node.echo = rpcmethod(lambda value: 'wrapped %s' % originalEcho(value))
+        self.protocol._handleRPC(remoteContact, 'rpc1', 'echo', ['hello'])
+        response = self.protocol._translator.fromPrimitive(self.protocol._encoder.decode(self.protocol.transport.written[0][0]))
+        self.failUnlessEqual(response.response, 'wrapped hello')
+
+    def testAsynchronousRPCs(self):
+        """ Tests if RPC methods may return deferreds, and if blocking RPC methods are executed in worker threads """
+        transport = FakeTransport()
+        def write(data, address):
+            transport.written.append((data, address))
+            if len(transport.written) == 2:
+                entangled.kademlia.protocol.reactor.stop()
+        transport.write = write
+        self.protocol.transport = transport
+        self.node.threadedRPCs = True
+        remoteContact = entangled.kademlia.contact.Contact('node2', '127.0.0.1', 4000, self.protocol)
+        self.protocol._handleRPC(remoteContact, 'rpc1', 'deferredEcho', ['hello'])
+        self.protocol._handleRPC(remoteContact, 'rpc2', 'threadName', [])
+        self.failUnlessEqual(len(transport.written), 0, 'Responses should only be sent once the results are available')
+        entangled.kademlia.protocol.reactor.callLater(5, entangled.kademlia.protocol.reactor.stop)
+        entangled.kademlia.protocol.reactor.run()
+        self.protocol.stopProtocol()
+        responses = [self.protocol._translator.fromPrimitive(self.protocol._encoder.decode(data)) for data, address in transport.written]
+        responses = dict([(msg.id, msg.response) for msg in responses])
+        self.failUnlessEqual(responses.get('rpc1'), 'hello')
+        self.failUnless('rpc2' in responses, 'No response received from the threaded RPC method')
+        self.failIfEqual(responses['rpc2'], threading.currentThread().getName(), 'RPC method should have been executed in a worker thread')
+
+    def testBatchedRPCs(self):
+        """ Tests if RPCs sent to the same node within a short time window are coalesced into one datagram """
+        self.protocol.transport = FakeTransport()
+        address = ('127.0.0.1', 4000)
+        remoteContact = entangled.kademlia.contact.Contact('node2', address[0], address[1], self.protocol)
+        dfs = [self.protocol.sendRPC(remoteContact, 'echo', [i]) for i in range(3)]
+        self.failUnlessEqual(len(self.protocol.transport.written), 3, 'RPCs should not be coalesced for nodes not known to support it')
+        self.protocol._updatePeerCapabilities(address, self.protocol.capabilityMultiCall)
+        dfs += [self.protocol.sendRPC(remoteContact, 'echo', [i]) for i in range(3, 6)]
+        self.failUnlessEqual(len(self.protocol.transport.written), 4, 'First RPC should be sent immediately, and the rest held back')
+        self.protocol._flushBatches()
+        self.failUnlessEqual(len(self.protocol.transport.written), 5)
+        decode = lambda data: self.protocol._translator.fromPrimitive(self.protocol._encoder.decode(data))
+        batch = decode(self.protocol.transport.written[-1][0])
+        self.failUnless(isinstance(batch, entangled.kademlia.msgtypes.MultiMessage))
+        self.failUnlessEqual([msg.args for msg in batch.messages], [[4], [5]])
+        # Answer all RPCs with a single multi-call datagram
+        requests = [decode(data) for data, address in self.protocol.transport.written[:4]] + batch.messages
+        responses = [entangled.kademlia.msgtypes.ResponseMessage(msg.id, 'node2', msg.args[0]) for msg in requests]
+        responseBatch = entangled.kademlia.msgtypes.MultiMessage('node2', responses)
+        self.protocol.datagramReceived(self.protocol._encoder.encode(self.protocol._translator.toPrimitive(responseBatch)), address)
+        results = []
+        for df in dfs:
+            df.addCallback(results.append)
+        self.failUnlessEqual(results, range(6))
+        self.failUnlessEqual(len(self.protocol._sentMessages), 0)
+        self.protocol.stopProtocol()
+
+    def testRPCDeduplication(self):
+        """ Tests if identical in-flight RPCs share a single request, with the result passed to all callers """
+        self.protocol.transport = FakeTransport()
+        address = ('127.0.0.1', 4000)
+        remoteContact = entangled.kademlia.contact.Contact('node2', address[0], address[1], self.protocol)
+        dfs = [self.protocol.sendRPC(remoteContact, 'findNode', ['key1']) for i in range(3)]
+        otherDf = self.protocol.sendRPC(remoteContact, 'findNode', ['key2'])
+        self.failUnlessEqual(len(self.protocol.transport.written), 2, 'Identical in-flight RPCs should not be sent again')
+        self.failUnlessEqual(self.protocol.rpcDeduplicationRatio(), 0.5)
+        results = []
+        # Callbacks of one caller should not affect the results passed to the others
+        dfs[0].addCallback(lambda result: 'modified')
+        for df in dfs:
+            df.addCallback(results.append)
+        request = self.protocol._translator.fromPrimitive(self.protocol._encoder.decode(self.protocol.transport.written[0][0]))
+        response = entangled.kademlia.msgtypes.ResponseMessage(request.id, 'node2', 'result')
+        self.protocol.datagramReceived(self.protocol._encoder.encode(self.protocol._translator.toPrimitive(response)), address)
+        self.failUnlessEqual(results, ['modified', 'result', 'result'])
+        # Once the RPC has completed, an identical RPC should be sent again
+        self.protocol.sendRPC(remoteContact, 'findNode', ['key1'])
+        self.failUnlessEqual(len(self.protocol.transport.written), 3)
+        self.protocol.stopProtocol()
+
+    def testCompactEncodingNegotiation(self):
+        """ Tests if the compact encoding is used for nodes advertising support for it """
+        self.protocol.transport = FakeTransport()
+        address = ('127.0.0.1', 4000)
+        remoteContact = entangled.kademlia.contact.Contact('node2', address[0], address[1], self.protocol)
+        compactEncoder = entangled.kademlia.encoding.CompactEncoding()
+        self.protocol.sendRPC(remoteContact, 'findNode', ['key1'])
+        self.failIfEqual(self.protocol.transport.written[-1][0][0], compactEncoder.magic, 'Compact encoding should not be used for nodes not known to support it')
+        # The remote node advertises its capabilities in a (compactly encoded) request
+        request = entangled.kademlia.msgtypes.RequestMessage('node2', 'echo', ['hello'])
+        request.capabilities = self.protocol.capabilityCompactEncoding
+        self.protocol.datagramReceived(compactEncoder.encode(self.protocol._translator.toPrimitive(request)), address)
+        self.failUnlessEqual(len(self.protocol.transport.written), 2)
+        self.failUnlessEqual(self.protocol.transport.written[-1][0][0], compactEncoder.magic, 'Compact encoding should be used for nodes supporting it')
+        response = self.protocol._translator.fromPrimitive(compactEncoder.decode(self.protocol.transport.written[-1][0]))
+        self.failUnlessEqual(response.response, 'hello')
+        self.failUnless(response.capabilities & self.protocol.capabilityCompactEncoding, 'Support for the compact encoding should be advertised')
+        self.protocol.stopProtocol()
+        # Support for the compact encoding can be disabled
+        protocol = entangled.kademlia.protocol.KademliaProtocol(self.node, compactEncoder=None)
+        self.failIf(protocol.capabilities & protocol.capabilityCompactEncoding)
+        protocol._updatePeerCapabilities(address, self.protocol.capabilityCompactEncoding)
+        self.failIf(isinstance(protocol.payloadEncoder(remoteContact), entangled.kademlia.encoding.CompactEncoding))
+
+    def testListFormatNegotiation(self):
+        """ Tests if the list-based message format is only used for nodes advertising support for it """
+        protocol = entangled.kademlia.protocol.KademliaProtocol(self.node, msgTranslator=entangled.kademlia.msgformat.TupleFormat())
+        protocol.transport = FakeTransport()
+        address = ('127.0.0.1', 4000)
+        remoteContact = entangled.kademlia.contact.Contact('node2', address[0], address[1], protocol)
+        protocol.sendRPC(remoteContact, 'findNode', ['key1'])
+        msgPrimitive = protocol._encoder.decode(protocol.transport.written[-1][0])
+        self.failUnlessEqual(type(msgPrimitive), dict, 'The list format should not be used for nodes not known to support it')
+        self.failUnless(msgPrimitive[entangled.kademlia.msgformat.DefaultFormat.headerCapabilities] & protocol.capabilityListFormat, 'Support for the list format should be advertised')
+        # A node using the default format can translate the request, and does not advertise support for lists
+        request = self.protocol._translator.fromPrimitive(msgPrimitive)
+        self.failUnlessEqual((request.request, request.args), ('findNode', ['key1']))
+        self.failIf(self.protocol.capabilities & self.protocol.capabilityListFormat)
+        self.protocol._updatePeerCapabilities(address, request.capabilities)
+        self.protocol.transport = FakeTransport()
+        self.protocol._sendResponse(remoteContact, request.id, 'result')
+        self.failUnlessEqual(type(self.protocol.payloadEncoder(remoteContact).decode(self.protocol.transport.written[-1][0])), dict)
+        # Nodes advertising support for lists are sent lists
+        protocol._updatePeerCapabilities(address, protocol.capabilityListFormat)
+        protocol.sendRPC(remoteContact, 'findNode', ['key2'])
+        msgPrimitive = protocol._encoder.decode(protocol.transport.written[-1][0])
+        self.failUnlessEqual(type(msgPrimitive), list, 'The list format should be used for nodes supporting it')
+        self.failUnlessEqual(protocol._translator.fromPrimitive(msgPrimitive).args, ['key2'])
+        protocol.stopProtocol()
+        self.protocol.stopProtocol()
+
+    def testLateResponse(self):
+        """ Tests if responses to RPCs that have timed out are discarded without decoding their payloads """
+        encoder = CountingEncoding()
+        protocol = entangled.kademlia.protocol.KademliaProtocol(self.node, msgEncoder=encoder)
+        protocol.transport = FakeTransport()
+        address = ('127.0.0.1', 4000)
+        remoteContact = entangled.kademlia.contact.Contact('node2', address[0], address[1], protocol)
+        df = protocol.sendRPC(remoteContact, 'echo', ['hello'])
+        results = []
+        df.addCallback(results.append)
+        request = protocol._translator.fromPrimitive(encoder.decode(protocol.transport.written[0][0]))
+        encoder.decoded = 0
+        # An unexpected response...
+        response = entangled.kademlia.msgtypes.ResponseMessage('unknownID', 'node3', ['x' * 100] * 100)
+        protocol.datagramReceived(encoder.encode(protocol._translator.toPrimitive(response)), address)
+        self.failUnlessEqual(encoder.decoded, 0, 'Payload of an unexpected response should not have been decoded')
+        self.failUnlessEqual(self.node.contacts[-1].id, 'node3', 'Sender of an unexpected response should have been added as a contact')
+        # ...and the expected one
+        response = entangled.kademlia.msgtypes.ResponseMessage(request.id, 'node2', 'hello')
+        protocol.datagramReceived(encoder.encode(protocol._translator.toPrimitive(response)), address)
+        self.failUnlessEqual(encoder.decoded, 1)
+        self.failUnlessEqual(results, ['hello'])
+        # Once it is no longer expected, the response is discarded
+        protocol.datagramReceived(encoder.encode(protocol._translator.toPrimitive(response)), address)
+        self.failUnlessEqual(encoder.decoded, 1)
+        protocol.stopProtocol()
+
 
 def suite():
     suite = unittest.TestSuite()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+import unittest
+
+import entangled.kademlia.rtt
+
+class RTTEstimatorTest(unittest.TestCase):
+    """ Test case for the RTTEstimator class """
+    def setUp(self):
+        self.estimator = entangled.kademlia.rtt.RTTEstimator()
+
+    def testInitialTimeout(self):
+        """ Tests if the maximum timeout is used before any round-trip times have been measured """
+        self.failUnlessEqual(self.estimator.timeout(0.5, 5), 5)
+
+    def testSmoothing(self):
+        """ Tests the smoothed round-trip time and variance calculations """
+        self.estimator.update(0.2)
+        self.failUnlessAlmostEqual(self.estimator.srtt, 0.2)
+        self.failUnlessAlmostEqual(self.estimator.rttvar, 0.1)
+        self.failUnlessAlmostEqual(self.estimator.timeout(0.1, 5), 0.6)
+        self.estimator.update(0.4)
+        self.failUnlessAlmostEqual(self.estimator.srtt, 0.225)
+        self.failUnlessAlmostEqual(self.estimator.rttvar, 0.125)
+        self.failUnlessEqual(self.estimator.samples, 2)
+
+    def testClamping(self):
+        """ Tests if the timeout is kept within the specified bounds """
+        self.estimator.update(0.01)
+        self.failUnlessEqual(self.estimator.timeout(0.5, 5), 0.5)
+        self.estimator.update(30)
+        self.failUnlessEqual(self.estimator.timeout(0.5, 5), 5)
+
+    def testBackoff(self):
+        """ Tests if the timeout is doubled after timeouts, and reset by a new measurement """
+        self.estimator.update(0.2)
+        self.estimator.timedOut()
+        self.failUnlessAlmostEqual(self.estimator.timeout(0.1, 5), 1.2)
+        self.estimator.timedOut()
+        self.failUnlessAlmostEqual(self.estimator.timeout(0.1, 5), 2.4)
+        self.estimator.update(0.2)
+        self.failUnless(self.estimator.timeout(0.1, 5) < 1.2, 'Timeout backoff should be reset after a successful RPC')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RTTEstimatorTest))
+    return suite
+
+if __name__ == '__main__':
+    # If this module is executed from the commandline, run all its tests
+    unittest.TextTestRunner().run(suite())
@@ -7,7 +7,11 @@
 import hashlib
 import unittest
 
+import twisted.internet.defer
+import twisted.python.failure
+
 import entangled.kademlia.constants
+import entangled.kademlia.protocol
 import entangled.kademlia.routingtable
 import entangled.kademlia.contact
 
@@ -25,6 +29,16 @@ class FakeDeferred(object):
         return
 
 
+class PingRecordingProtocol(object):
+    """ Fake RPC protocol; records the RPCs sent, so that they can be answered later """
+    def __init__(self):
+        self.rpcs = []
+    def sendRPC(self, contact, method, args, **kwargs):
+        df = twisted.internet.defer.Deferred()
+        self.rpcs.append((contact, method, df))
+        return df
+
+
 class TreeRoutingTableTest(unittest.TestCase):
     """ Test case for the RoutingTable class """
     def setUp(self):
@@ -51,6 +65,25 @@ class TreeRoutingTableTest(unittest.TestCase):
         distanceTwo = self.routingTable.distance(baseIp, ipTestList[1])
 
         self.failIf(distanceOne > distanceTwo, '%s should be closer to the base ip %s than %s' % (ipTestList[0], baseIp, ipTestList[1]))
+
+        # Integer key values should give the same results
+        valKey = entangled.kademlia.routingtable.keyValue(baseIp)
+        self.failUnlessEqual(self.routingTable.distance(valKey, ipTestList[0]), distanceOne)
+
+    def testSortByDistance(self):
+        """ Tests if contacts are sorted by their distance to a key, closest first """
+        contacts = []
+        for i in range(20):
+            h = hashlib.sha1()
+            h.update('node%d' % i)
+            contacts.append(entangled.kademlia.contact.Contact(h.digest(), '127.0.0.1', 4000, self.protocol))
+        for key in (self.nodeID, contacts[5].id, entangled.kademlia.routingtable.keyValue(contacts[5].id)):
+            sortedContacts = list(contacts)
+            self.routingTable.sortByDistance(sortedContacts, key)
+            distances = [self.routingTable.distance(key, contact.id) for contact in sortedContacts]
+            self.failUnlessEqual(distances, sorted(distances))
+            self.failUnlessEqual(len(sortedContacts), len(contacts))
+        self.failUnlessEqual(sortedContacts[0], contacts[5])
     
     def testAddContact(self):
         """ Tests if a contact can be added and retrieved correctly """
@@ -103,6 +136,26 @@ class TreeRoutingTableTest(unittest.TestCase):
         self.routingTable.removeContact(contact.id)
         self.failUnlessEqual(len(self.routingTable._buckets[0]), 0, 'Contact not removed properly')
 
+    def testGeneration(self):
+        """ Tests if the routing table's generation only changes along with its contents """
+        h = hashlib.sha1()
+        h.update('node2')
+        contactID = h.digest()
+        generation = self.routingTable.generation
+        self.routingTable.addContact(entangled.kademlia.contact.Contact(contactID, '127.0.0.1', 91824, self.protocol))
+        self.failIfEqual(self.routingTable.generation, generation, 'Adding a contact should change the generation')
+        generation = self.routingTable.generation
+        self.routingTable.addContact(entangled.kademlia.contact.Contact(contactID, '127.0.0.1', 91824, self.protocol))
+        self.failUnlessEqual(self.routingTable.generation, generation, 'Refreshing a known contact should not change the generation')
+        self.routingTable.addContact(entangled.kademlia.contact.Contact(contactID, '127.0.0.1', 91825, self.protocol))
+        self.failIfEqual(self.routingTable.generation, generation, 'Changing a contact\'s address should change the generation')
+        generation = self.routingTable.generation
+        self.routingTable.removeContact(contactID)
+        self.failIfEqual(self.routingTable.generation, generation, 'Removing a contact should change the generation')
+        generation = self.routingTable.generation
+        self.routingTable.removeContact(contactID)
+        self.failUnlessEqual(self.routingTable.generation, generation, 'Removing an unknown contact should not change the generation')
+
     def testSplitBucket(self):
         """ Tests if the the routing table correctly dynamically splits k-buckets """
         self.failUnlessEqual(self.routingTable._buckets[0].rangeMax, 2**160, 'Initial k-bucket range should be 0 <= range < 2**160')
@@ -126,6 +179,48 @@ class TreeRoutingTableTest(unittest.TestCase):
         self.failUnlessEqual(self.routingTable._buckets[0].rangeMax, self.routingTable._buckets[1].rangeMin, 'K-bucket was split, but the min/max ranges were not divided properly')
         
 
+    def testKBucketIndex(self):
+        """ Tests if keys are mapped to the k-bucket covering them, after many splits """
+        for i in range(1000):
+            h = hashlib.sha1()
+            h.update('contact%d' % i)
+            self.routingTable.addContact(entangled.kademlia.contact.Contact(h.digest(), '127.0.0.1', 4000, self.protocol))
+        buckets = self.routingTable._buckets
+        self.failUnless(len(buckets) > 5, 'Adding many contacts should have split the k-buckets repeatedly')
+        keys = [self.nodeID, '\x00' * 20, '\xff' * 20]
+        for bucket in buckets:
+            keys.append(('%040x' % bucket.rangeMin).decode('hex'))
+            keys.append(('%040x' % (bucket.rangeMax - 1)).decode('hex'))
+        for i in range(100):
+            h = hashlib.sha1()
+            h.update('key%d' % i)
+            keys.append(h.digest())
+        for key in keys:
+            bucketIndex = self.routingTable._kbucketIndex(key)
+            self.failUnless(buckets[bucketIndex].keyInRange(key), 'Key %s mapped to the wrong k-bucket' % key.encode('hex'))
+
+    def testFindCloseNodesExact(self):
+        """ Tests if the contacts closest to a key are returned, closest first """
+        for i in range(500):
+            h = hashlib.sha1()
+            h.update('contact%d' % i)
+            self.routingTable.addContact(entangled.kademlia.contact.Contact(h.digest(), '127.0.0.1', 4000, self.protocol))
+        knownContacts = []
+        for bucket in self.routingTable._buckets:
+            knownContacts.extend(bucket.getContacts())
+        keys = [self.nodeID, knownContacts[0].id]
+        for i in range(50):
+            h = hashlib.sha1()
+            h.update('key%d' % i)
+            keys.append(h.digest())
+        for key in keys:
+            expected = sorted(knownContacts, key=lambda contact: self.routingTable.distance(key, contact.id))
+            self.failUnlessEqual(self.routingTable.findCloseNodes(key, entangled.kademlia.constants.k), expected[:entangled.kademlia.constants.k])
+            self.failUnlessEqual(self.routingTable.findCloseNodes(key, 3), expected[:3])
+            self.failUnlessEqual(self.routingTable.findCloseNodes(key, 2 * entangled.kademlia.constants.k), expected[:2 * entangled.kademlia.constants.k])
+            excluded = expected[0].id
+            self.failUnlessEqual(self.routingTable.findCloseNodes(key, entangled.kademlia.constants.k, excluded), expected[1:entangled.kademlia.constants.k+1])
+
     def testFullBucketNoSplit(self):
         """ Test that a bucket is not split if it full, but does not cover the range containing the parent node's ID """
         self.routingTable._parentNodeID = 21*'a' # more than 160 bits; this will not be in the range of _any_ k-bucket
@@ -148,9 +243,94 @@ class TreeRoutingTableTest(unittest.TestCase):
         self.failUnlessEqual(len(self.routingTable._buckets[0]._contacts), entangled.kademlia.constants.k, 'Bucket should have k contacts; expected %d got %d' % (entangled.kademlia.constants.k, len(self.routingTable._buckets[0]._contacts)))
         self.failIf(contact in self.routingTable._buckets[0]._contacts, 'New contact should have been discarded (since RPC is faked in this test)')
 
+    def testEvictionPings(self):
+        """ Tests if only one PING at a time is sent to the head contact of a full k-bucket """
+        k = entangled.kademlia.constants.k
+        protocol = PingRecordingProtocol()
+        self.routingTable._parentNodeID = 21*'a' # not in the range of any k-bucket
+        contacts = []
+        for i in range(3 * k):
+            h = hashlib.sha1()
+            h.update('remote node %d' % i)
+            contacts.append(entangled.kademlia.contact.Contact(h.digest(), '127.0.0.1', 4000 + i, protocol))
+        for contact in contacts[:2 * k]:
+            self.routingTable.addContact(contact)
+        bucket = self.routingTable._buckets[0]
+        self.failUnlessEqual(len(protocol.rpcs), 1, 'Only one PING should be outstanding, no matter how many new contacts arrive')
+        self.failUnless(protocol.rpcs[0][0] is contacts[0])
+        self.failUnlessEqual(protocol.rpcs[0][1], 'ping')
+        # The head contact responds; the new contacts are not added
+        protocol.rpcs.pop()[2].callback('pong')
+        self.failUnlessEqual(bucket.getContacts(), contacts[:k])
+        self.routingTable.addContact(contacts[2 * k])
+        self.failUnlessEqual(len(protocol.rpcs), 1, 'A new PING should be sent once the previous one has completed')
+        # The head contact times out; the most recently seen new contact
+        # replaces it, and the next head contact is pinged
+        generation = self.routingTable.generation
+        protocol.rpcs.pop()[2].errback(twisted.python.failure.Failure(entangled.kademlia.protocol.TimeoutError(contacts[0].id)))
+        self.failIf(contacts[0] in bucket.getContacts())
+        self.failUnless(bucket.getContacts()[-1] is contacts[2 * k])
+        self.failIfEqual(self.routingTable.generation, generation)
+        self.failUnlessEqual(len(protocol.rpcs), 1)
+        self.failUnless(protocol.rpcs[0][0] is contacts[1])
+        protocol.rpcs.pop()[2].errback(twisted.python.failure.Failure(entangled.kademlia.protocol.TimeoutError(contacts[1].id)))
+        self.failUnless(bucket.getContacts()[-1] is contacts[2 * k - 1])
+        self.failUnlessEqual(len(bucket), k)
+
+
+class OptimizedTreeRoutingTableTest(unittest.TestCase):
+    """ Test case for the OptimizedTreeRoutingTable class' replacement caches """
+    def setUp(self):
+        self.nodeID = '\x00' * 20
+        self.protocol = FakeRPCProtocol()
+        self.routingTable = entangled.kademlia.routingtable.OptimizedTreeRoutingTable(self.nodeID)
+
+    def createContact(self, prefix, i):
+        """ Returns a contact whose node ID starts with the specified byte """
+        return entangled.kademlia.contact.Contact(chr(prefix) + hashlib.sha1('contact%d' % i).digest()[1:], '127.0.0.1', 4000 + i, self.protocol)
+
+    def testReplacement(self):
+        """ Tests if stale contacts are replaced by the most recently seen replacement contacts """
+        k = entangled.kademlia.constants.k
+        contacts = [self.createContact(0xff, i) for i in range(k + entangled.kademlia.constants.replacementCacheSize + 2)]
+        for contact in contacts:
+            self.routingTable.addContact(contact)
+        bucket = self.routingTable._buckets[self.routingTable._kbucketIndex(contacts[0].id)]
+        self.failUnlessEqual(bucket.getContacts(), contacts[:k])
+        self.failUnlessEqual(bucket.getReplacements(), contacts[k+2:], 'The replacement cache should be bounded')
+        # Refreshing a replacement contact makes it the preferred replacement
+        self.routingTable.addContact(contacts[k+2])
+        generation = self.routingTable.generation
+        for i in range(5):
+            self.routingTable.removeContact(contacts[0].id)
+        self.failIf(contacts[0] in bucket.getContacts())
+        self.failUnless(bucket.getContacts()[-1] is contacts[k+2], 'The most recently seen replacement should have been promoted')
+        self.failUnlessEqual(len(bucket), k)
+        self.failIfEqual(self.routingTable.generation, generation)
+        # Replacement contacts that fail to respond are discarded
+        self.routingTable.removeContact(contacts[k+3].id)
+        self.failIf(contacts[k+3] in bucket.getReplacements())
+
+    def testSplitBucket(self):
+        """ Tests if replacement contacts follow their node IDs when a k-bucket is split """
+        k = entangled.kademlia.constants.k
+        lowReplacements = [self.createContact(0x00, i) for i in range(2)]
+        highReplacements = [self.createContact(0xff, i) for i in range(2, 4)]
+        for contact in lowReplacements + highReplacements:
+            self.routingTable._buckets[0].addReplacement(contact)
+        # Splits the k-bucket in two halves; the last contact will not fit
+        # into the upper half
+        contacts = [self.createContact(0xc0, i) for i in range(10, 11 + k)]
+        for contact in contacts:
+            self.routingTable.addContact(contact)
+        lowBucket, highBucket = self.routingTable._buckets
+        self.failUnlessEqual(lowBucket.getReplacements(), lowReplacements)
+        self.failUnlessEqual(highBucket.getReplacements(), highReplacements + contacts[-1:])
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TreeRoutingTableTest))
+    suite.addTest(unittest.makeSuite(OptimizedTreeRoutingTableTest))
     return suite
 
 if __name__ == '__main__':
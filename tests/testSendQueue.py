@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+import unittest
+
+from twisted.internet import task
+
+import entangled.kademlia.sendqueue
+
+class SendQueueTest(unittest.TestCase):
+    """ Test case for the token bucket-based SendQueue class """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.address = ('127.0.0.1', 4000)
+        # 10 packets/s, 1000 bytes/s, bursts of 0.2s (2 packets, 200 bytes)
+        self.queue = entangled.kademlia.sendqueue.SendQueue(10, 1000, 500, burstTime=0.2, clock=self.clock.seconds)
+
+    def testFIFO(self):
+        """ Tests if packets leave the queue in the order they were added """
+        self.queue.put('a', self.address)
+        self.queue.put('b', self.address)
+        self.failUnlessEqual(self.queue.pop(), ('a', self.address))
+        self.failUnlessEqual(self.queue.pop(), ('b', self.address))
+        self.failUnlessEqual(self.queue.pop(), None, 'Empty queue should not return a packet')
+        self.failUnlessEqual(self.queue.delay(), None, 'Empty queue should not have a delay')
+
+    def testPacketRate(self):
+        """ Tests if the packet rate limit is enforced """
+        for i in range(4):
+            self.queue.put('x', self.address)
+        self.failIfEqual(self.queue.pop(), None)
+        self.failIfEqual(self.queue.pop(), None)
+        self.failUnlessEqual(self.queue.pop(), None, 'Burst size exceeded; third packet should have been held back')
+        self.failUnlessAlmostEqual(self.queue.delay(), 0.1)
+        self.clock.advance(0.1)
+        self.failIfEqual(self.queue.pop(), None, 'Packet should be sent once enough tokens have accumulated')
+        self.failUnlessEqual(self.queue.pop(), None)
+        self.failUnlessEqual(len(self.queue), 1)
+
+    def testByteRate(self):
+        """ Tests if the byte rate limit is enforced """
+        self.queue.put(150*'x', self.address)
+        self.queue.put(150*'x', self.address)
+        self.failIfEqual(self.queue.pop(), None)
+        self.failUnlessEqual(self.queue.pop(), None, 'Byte budget exceeded; second packet should have been held back')
+        self.failUnlessAlmostEqual(self.queue.delay(), 0.1)
+        self.clock.advance(0.1)
+        self.failIfEqual(self.queue.pop(), None)
+
+    def testBoundedSize(self):
+        """ Tests if packets that do not fit into the queue are dropped """
+        self.failUnless(self.queue.put(400*'x', self.address))
+        self.failIf(self.queue.put(200*'x', self.address), 'Queue is full; packet should have been dropped')
+        self.failUnlessEqual(self.queue.dropped, 1)
+        self.failUnlessEqual(len(self.queue), 1)
+
+
+    def testDrainTime(self):
+        """ Tests if the time needed to transmit the queued packets is estimated from both rate limits """
+        self.failUnlessEqual(self.queue.drainTime(), 0)
+        for i in range(4):
+            self.queue.put('x', self.address)
+        self.failUnlessAlmostEqual(self.queue.drainTime(), 0.4, 'Drain time should be limited by the packet rate')
+        self.queue.clear()
+        self.queue.put(300*'x', self.address)
+        self.failUnlessAlmostEqual(self.queue.drainTime(), 0.3, 'Drain time should be limited by the byte rate')
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SendQueueTest))
+    return suite
+
+if __name__ == '__main__':
+    # If this module is executed from the commandline, run all its tests
+    unittest.TextTestRunner().run(suite())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# This library is free software, distributed under the terms of
+# the GNU Lesser General Public License Version 3, or any later version.
+# See the COPYING file included in this archive
+
+import unittest
+
+from twisted.internet import task
+from twisted.python import log
+
+import entangled.kademlia.timerwheel
+
+class TimerWheelTest(unittest.TestCase):
+    """ Test case for the TimerWheel class """
+    def setUp(self):
+        self.clock = task.Clock()
+        self.clock.advance(1000)
+        self.wheel = entangled.kademlia.timerwheel.TimerWheel(0.5, clock=self.clock.seconds)
+        self.calls = []
+
+    def testExpiry(self):
+        """ Tests if calls are made once their delay has passed, and not before """
+        self.wheel.callLater(1, self.calls.append, 'a')
+        self.wheel.callLater(2.2, self.calls.append, 'b')
+        self.wheel.callLater(0.6, self.calls.append, 'c')
+        self.failUnlessEqual(len(self.wheel), 3)
+        self.clock.advance(0.5)
+        self.failUnlessEqual(self.wheel.expire(), 0)
+        self.clock.advance(0.5)
+        self.failUnlessEqual(self.wheel.expire(), 2)
+        self.failUnlessEqual(sorted(self.calls), ['a', 'c'])
+        # Calls should be made even if the wheel is not expired on every tick
+        self.clock.advance(10)
+        self.failUnlessEqual(self.wheel.expire(), 1)
+        self.failUnlessEqual(self.calls[-1], 'b')
+        self.failUnlessEqual(len(self.wheel), 0)
+
+    def testCancel(self):
+        """ Tests if cancelled calls are not made """
+        timer = self.wheel.callLater(1, self.calls.append, 'a')
+        self.failUnless(timer.active())
+        timer.cancel()
+        timer.cancel()
+        self.failIf(timer.active())
+        self.failUnlessEqual(len(self.wheel), 0)
+        self.clock.advance(2)
+        self.failUnlessEqual(self.wheel.expire(), 0)
+        self.failUnlessEqual(self.calls, [])
+
+    def testRescheduleFromCall(self):
+        """ Tests if calls can schedule further calls while the wheel is being expired """
+        def reschedule():
+            self.calls.append(self.clock.seconds())
+            if len(self.calls) < 2:
+                self.wheel.callLater(0, reschedule)
+        self.wheel.callLater(0, reschedule)
+        self.clock.advance(0.5)
+        self.wheel.expire()
+        self.failUnlessEqual(len(self.calls), 1)
+        self.failUnlessEqual(len(self.wheel), 1, 'Call scheduled from within expire() should be pending')
+        self.clock.advance(0.5)
+        self.wheel.expire()
+        self.failUnlessEqual(len(self.calls), 2)
+
+
+    def testFailingCall(self):
+        """ Tests if a call raising an exception does not prevent the other due calls from being made """
+        def fail():
+            raise ValueError('timer failure')
+        self.wheel.callLater(1, fail)
+        self.wheel.callLater(1, self.calls.append, 'a')
+        errors = []
+        log.addObserver(errors.append)
+        try:
+            self.clock.advance(1)
+            self.failUnlessEqual(self.wheel.expire(), 2)
+        finally:
+            log.removeObserver(errors.append)
+        self.failUnlessEqual(self.calls, ['a'])
+        self.failUnlessEqual(len(self.wheel), 0)
+        self.failUnlessEqual(len([event for event in errors if event.get('isError')]), 1, 'The exception should have been logged')
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TimerWheelTest))
+    return suite
+
+if __name__ == '__main__':
+    # If this module is executed from the commandline, run all its tests
+    unittest.TextTestRunner().run(suite())